@@ -1,2 +1,2 @@
-__all__ = ['protocols', 'transport', 'endpoint']
+__all__ = ['protocols', 'envelope', 'registry', 'cache', 'futures', 'transport', 'endpoint', 'pool', 'dispatch', 'prefork', 'metrics']
 __version__ = '1.0'
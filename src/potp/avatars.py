@@ -21,7 +21,6 @@ class CannotAttachAvatar(Exception):
 def avatar_property(prop):
     '''Use @avatar_property instead of @property to get the property
        available to all proxies.'''
-    @property
     def wrapper(*args, **kwargs):
         try:
             if prop.__name__ not in args[0].avatar_properties:
@@ -30,7 +29,33 @@ def avatar_property(prop):
             _DEB('Using @avatar_property as @property')
         finally:
             return prop(*args, **kwargs)
-    return wrapper
+    wrapper.avatar_cached = getattr(prop, 'avatar_cached', False)
+    return property(wrapper)
+
+
+def avatar_oneway(method):
+    '''Use @avatar_oneway on methods whose result is not needed: proxies
+       send the call and do not wait for it (see Client.notify()).'''
+    method.avatar_oneway = True
+    return method
+
+
+def avatar_cached(method):
+    '''Use @avatar_cached on members whose result only depends on their
+       arguments: servers with a result cache reuse it until the avatar
+       calls avatar_invalidate(). Exceptions are never cached.'''
+    if isinstance(method, property):
+        method.fget.avatar_cached = True
+    else:
+        method.avatar_cached = True
+    return method
+
+
+def _cached(cls, member):
+    attribute = getattr(cls, member, None)
+    if isinstance(attribute, property):
+        attribute = attribute.fget
+    return getattr(attribute, 'avatar_cached', False)
 
 
 class Avatar(object):
@@ -43,6 +68,8 @@ class Avatar(object):
     def __init__(self):
         self.__aid = str(uuid.uuid4())
         self.avatar_class = self.__class__.__name__
+        self.avatar_oneway = []
+        self.avatar_cached = []
         # Get public members
         for member in dir(self):
             try:
@@ -52,11 +79,16 @@ class Avatar(object):
                 # Ignore avatar members
                 if member.startswith('avatar_'):
                     continue
-                _DEB('Checking member %s (%s)' % (member,
-                                                  getattr(self, member)))
+                if _cached(self.__class__, member):
+                    self.avatar_cached.append(member)
+                _DEB('Checking member %s (%s)', member,
+                     getattr(self, member))
+                if getattr(getattr(self, member), 'avatar_oneway', False):
+                    self.avatar_oneway.append(member)
+                    continue
                 self.avatar_members.append(member)
             except AttributeError:
-                _DEB('Member %s is @property' % member)
+                _DEB('Member %s is @property', member)
                 self.avatar_properties.append(member)
                 continue
             except AvatarPropertyRequiresAvatar:
@@ -67,18 +99,37 @@ class Avatar(object):
         '''Get the URI to connect to the object.'''
         return '%s/%s' % (self.__endpoint.uri, self.__aid)
     
-    def avatar_attach(self, endpoint):
-        '''Connects the object to a Server() endpoint.'''
-        _DEB('Attaching [%s] to %s' % (self.__aid, endpoint.uri))
+    def avatar_attach(self, endpoint, weak=False):
+        '''Connects the object to a Server() endpoint. If weak, endpoint
+           does not keep the object alive (detached when collected).'''
+        _DEB('Attaching [%s] to %s', self.__aid, endpoint.uri)
         self.__endpoint = endpoint
-        self.__endpoint.register_request_handler(self.__dispatch__,
-                                                 self.__aid)
-        
+        self.__endpoint.register_request_handler(
+            self.__dispatch__, self.__aid, weak=weak,
+            cache_key=self.__cache_key__ if self.avatar_cached else None)
+
+    def avatar_invalidate(self, member=None):
+        '''Forget cached results of a member (every one if None), call it
+           when the state they depend on changes.'''
+        if self.__endpoint is None:
+            return
+        _DEB('Invalidating %s of [%s]', member or 'results', self.__aid)
+        self.__endpoint.invalidate_cache(
+            self.__aid, () if member is None else (member,))
+
+    def __cache_key__(self, request):
+        if not isinstance(request, dict) or \
+           request.get('member', None) not in self.avatar_cached:
+            return None
+        return (request['member'], tuple(request['args']),
+                tuple(sorted(request['kwargs'].items())))
+
     def __avatar_attach__(self):
         _DEB('Proxy request to attach')
         return {
             'members': self.avatar_members,
             'properties': self.avatar_properties,
+            'oneway': self.avatar_oneway,
             'class': self.avatar_class
             }
 
@@ -91,17 +142,22 @@ class Avatar(object):
             return self.__avatar_attach__()
         
         # Normal request
+        if request.get('member', None) in self.avatar_cached:
+            # Exceptions are raised: not cached, proxies get them anyway
+            member = getattr(self, request['member'])
+            return {'return': member if not callable(member) else member(
+                *request['args'], **request['kwargs'])}
         ret = {}
         try:
             member_name = request['member']
             member = getattr(self, member_name)
-            _DEB('Proxy request: %s' % member_name)
+            _DEB('Proxy request: %s', member_name)
             ret.update({
                 'return': member if not callable(member) else member(
                     *request['args'], **request['kwargs'])
             })
         except Exception, e:
-            _DEB('EXCEPTION: %s (%s)' % (e, type(e)))
+            _DEB('EXCEPTION: %s (%s)', e, type(e))
             ret.update({
                 'return': e,
                 'is_exception': True
@@ -128,7 +184,7 @@ class AvatarProxy(object):
     def attach_proxy(self, aid=None):
         '''Connects local object to the remote Avatar.'''
         self.__aid = aid
-        _DEB('Requesting attachment with %s' % self.__aid)
+        _DEB('Requesting attachment with %s', self.__aid)
         result = self.__endpoint.request({'attach': self.__pid}, self.__aid)
 
         if not result:
@@ -142,32 +198,55 @@ class AvatarProxy(object):
             self.__create_member__(member)
         for prop in result['properties']:
             self.__create_member__(prop, True)
+        # Not sent by old servers
+        for member in result.get('oneway', []):
+            self.__create_member__(member, oneway=True)
         self.__avatar_class = result.get('class', 'unknown')
-        _DEB('Attached to class %s()' % self.__avatar_class)
+        _DEB('Attached to class %s()', self.__avatar_class)
         self.__attached = True
 
-    def __create_member__(self, name, is_property=False):
-        _DEB('Adding member %s%s...' % (name,
-                                        ' (property)' if is_property else ''))
+    def __create_member__(self, name, is_property=False, oneway=False):
+        _DEB('Adding member %s%s...', name,
+             ' (property)' if is_property else
+             ' (one-way)' if oneway else '')
         exec('''%(property)s
 def _%(member)s(self, *args, **kwargs):
     try:
-        return self.__dispatch__('%(member)s', *args, **kwargs)
+        return self.%(dispatch)s('%(member)s', *args, **kwargs)
     except Exception, e:
         raise e
 setattr(self.__class__, '%(member)s', _%(member)s)
             ''' % {
                 'member': name,
-                'property': '@property' if is_property else ''
+                'property': '@property' if is_property else '',
+                'dispatch': '__notify__' if oneway else '__dispatch__'
             })
 
+    def proxy_batch(self, calls):
+        '''Call several members in a single request. Calls are (member,
+           args, kwargs) tuples, returns their results (or exceptions).'''
+        _DEB('Requesting %d calls to [%s]', len(calls), self.__aid)
+        responses = self.__endpoint.request_many([{
+            'member': op,
+            'args': args,
+            'kwargs': kwargs} for op, args, kwargs in calls], self.__aid)
+        return [response if isinstance(response, Exception)
+                else response['return'] for response in responses]
+
+    def __notify__(self, op, *args, **kwargs):
+        _DEB('Notifying "%s" to [%s]', op, self.__aid)
+        self.__endpoint.notify({
+            'member': op,
+            'args': args,
+            'kwargs': kwargs}, self.__aid)
+
     def __dispatch__(self, op, *args, **kwargs):
-        _DEB('Requesting "%s" to [%s]' % (op, self.__aid))
+        _DEB('Requesting "%s" to [%s]', op, self.__aid)
         response = self.__endpoint.request({
             'member': op,
             'args': args,
             'kwargs': kwargs}, self.__aid)
-        _DEB('Response: %s' % response)
+        _DEB('Response: %s', response)
         if response.get('is_exception', False):
             if isinstance(response['return'], Exception):
                 raise response['return']
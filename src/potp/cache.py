@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# Python Object Transfer: server side result cache
+#
+
+import time
+import threading
+import collections
+import logging
+logger = logging.getLogger(__name__)
+_DEB = logger.debug
+
+
+class ResultCache(object):
+    """ Marshalled replies of idempotent handlers.
+
+    Entries are keyed by (handler ID, request key, kind) where request key
+    is a tuple given by the handler (see Server.register_request_handler())
+    and kind tells the reply format. Least recently used entries are
+    evicted over max_size, entries older than ttl seconds (if given) are
+    never returned.
+
+    Replies computed while their handler is invalidated are not stored:
+    callers read generation() before calling the handler and give it to
+    put().
+    """
+    def __init__(self, max_size=1024, ttl=None):
+        self.__max_size = max(max_size, 1)
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        # key -> (reply, expires at), least recently used first
+        self.__entries = collections.OrderedDict()
+        # Handler ID -> keys, so invalidation does not scan every entry
+        self.__keys_of = {}
+        # Handler ID -> invalidations, changed by discard() and clear()
+        self.__generations = {}
+        self.__epoch = 0
+        self.__stats = {
+            'hits': 0,
+            'misses': 0,
+            'evicted': 0,
+            'expired': 0,
+            'invalidated': 0,
+            'outdated': 0,
+            'uncacheable': 0
+            }
+
+    @property
+    def max_size(self):
+        return self.__max_size
+
+    @property
+    def ttl(self):
+        return self.__ttl
+
+    @property
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['size'] = len(self.__entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
+
+    def get(self, key):
+        """ Cached reply, None if not cached (or expired). """
+        with self.__lock:
+            try:
+                reply, expires = self.__entries.pop(key)
+            except KeyError:
+                self.__stats['misses'] += 1
+                return None
+            except TypeError:
+                # Unhashable request arguments
+                self.__stats['uncacheable'] += 1
+                return None
+            if expires is not None and expires < time.time():
+                self.__forget__(key)
+                self.__stats['expired'] += 1
+                self.__stats['misses'] += 1
+                return None
+            # Most recently used
+            self.__entries[key] = (reply, expires)
+            self.__stats['hits'] += 1
+            return reply
+
+    def generation(self, id):
+        """ Invalidation count of a handler, see put(). """
+        return self.__epoch, self.__generations.get(id, 0)
+
+    def put(self, key, reply, generation=None):
+        """ Cache a reply.
+
+        Args:
+            key: (handler ID, request key, kind) tuple.
+            reply: marshalled reply.
+            generation: generation() of the handler before the reply was
+                computed, reply is not stored if it was invalidated since.
+        """
+        expires = None if self.__ttl is None else time.time() + self.__ttl
+        with self.__lock:
+            if generation is not None and \
+               generation != self.generation(key[0]):
+                self.__stats['outdated'] += 1
+                return
+            try:
+                self.__entries.pop(key, None)
+            except TypeError:
+                return
+            self.__entries[key] = (reply, expires)
+            self.__keys_of.setdefault(key[0], set()).add(key)
+            while len(self.__entries) > self.__max_size:
+                oldest = next(iter(self.__entries))
+                del(self.__entries[oldest])
+                self.__forget__(oldest)
+                self.__stats['evicted'] += 1
+
+    def invalidate(self, id, prefix=()):
+        """ Remove cached replies of a handler.
+
+        Args:
+            id: handler ID.
+            prefix: only requests whose key starts with it (e.g. the
+                member name of avatars), every one if empty.
+
+        Returns:
+            number of removed replies.
+        """
+        prefix = tuple(prefix)
+        with self.__lock:
+            self.__generations[id] = self.__generations.get(id, 0) + 1
+            keys = [key for key in self.__keys_of.get(id, ())
+                    if key[1][:len(prefix)] == prefix]
+            for key in keys:
+                self.__entries.pop(key, None)
+                self.__forget__(key)
+            self.__stats['invalidated'] += len(keys)
+        if keys:
+            _DEB('Invalidated %d replies of %s', len(keys), id)
+        return len(keys)
+
+    def discard(self, id):
+        """ Remove cached replies of a handler that is gone. """
+        with self.__lock:
+            for key in self.__keys_of.pop(id, ()):
+                self.__entries.pop(key, None)
+            # Generation is forgotten: replies being computed are outdated
+            self.__generations.pop(id, None)
+            self.__epoch += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__keys_of.clear()
+            self.__generations.clear()
+            self.__epoch += 1
+
+    def __forget__(self, key):
+        """ Remove key from the handler index, lock must be held. """
+        keys = self.__keys_of.get(key[0], None)
+        if keys is None:
+            return
+        keys.discard(key)
+        if not keys:
+            del(self.__keys_of[key[0]])
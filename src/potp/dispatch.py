@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+#
+# Python Object Transfer: request dispatch
+#
+
+import time
+import uuid
+import Queue
+import threading
+import multiprocessing
+import logging
+logger = logging.getLogger(__name__)
+_DEB = logger.debug
+
+
+#
+# Common errors
+#
+
+class DispatchError(Exception):
+    def __init__(self, cause='unknown'):
+        self.__cause = cause
+    def __str__(self):
+        return 'Dispatch error: %s' % self.__cause
+
+
+# What to do with requests when the queue is full:
+#   reject: reply at once with the reject callback response
+#   backpressure: stop reading from the client until a worker is free
+_OVERLOAD_POLICIES = ['reject', 'backpressure']
+
+
+class WorkerPool(object):
+    """ Run requests in a fixed set of threads fed by a bounded queue.
+
+    Instances are callables, so they can be bound to any transport. Transports
+    that must not block (event loop) use submit() instead.
+    """
+    def __init__(self, callback, reject, workers=8, queue_size=64,
+                 overload='reject'):
+        if overload not in _OVERLOAD_POLICIES:
+            raise DispatchError('unknown overload policy "%s"' % overload)
+        self.__callback = callback
+        self.__reject = reject
+        self.__workers = max(workers, 1)
+        self.__queue_size = max(queue_size, 1)
+        self.__overload = overload
+        self.__queue = None
+        self.__threads = []
+        self.__lock = threading.Lock()
+        self.__busy = 0
+        self.__stats = {
+            'queued': 0,
+            'completed': 0,
+            'rejected': 0,
+            'paused': 0,
+            'max_queue_depth': 0,
+            'total_wait_time': 0.0,
+            'max_wait_time': 0.0
+            }
+
+    @property
+    def workers(self):
+        return self.__workers
+
+    @property
+    def queue_size(self):
+        return self.__queue_size
+
+    @property
+    def overload(self):
+        return self.__overload
+
+    @property
+    def running(self):
+        return self.__queue is not None
+
+    @property
+    def stats(self):
+        """ Counters, current queue depth and wait times (in seconds). """
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['busy'] = self.__busy
+        stats['queue_depth'] = self.__queue.qsize() if self.running else 0
+        started = stats['completed'] + stats['busy']
+        stats['avg_wait_time'] = (stats['total_wait_time'] / started
+                                  if started else 0.0)
+        return stats
+
+    def start(self):
+        """ Start worker threads (nothing is done if already running). """
+        if self.running:
+            return
+        self.__queue = Queue.Queue(self.__queue_size)
+        self.__threads = [threading.Thread(target=self.__work__,
+                                           args=(self.__queue,))
+                          for worker in range(self.__workers)]
+        for thread in self.__threads:
+            thread.daemon = True
+            thread.start()
+        _DEB('Dispatch started with %d workers', self.__workers)
+
+    def close(self):
+        """ Stop workers once queued requests are done. """
+        if not self.running:
+            return
+        requests, self.__queue = self.__queue, None
+        for thread in self.__threads:
+            requests.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+        _DEB('Dispatch stopped')
+
+    def submit(self, request, done, block=False):
+        """ Queue a request.
+
+        Args:
+            request: request to give to the callback.
+            done: called as done(response, error) when finished, error is
+                the exception raised by the callback, if any.
+            block: wait for room in the queue under backpressure policy.
+
+        Returns:
+            False if queue is full under backpressure policy and block was
+            not given, caller must submit it again later.
+
+        Raises:
+            DispatchError: workers are not running.
+        """
+        requests = self.__queue
+        if requests is None:
+            raise DispatchError('workers are not running')
+        job = (request, done, time.time())
+        try:
+            requests.put_nowait(job)
+        except Queue.Full:
+            if block and self.__overload == 'backpressure':
+                with self.__lock:
+                    self.__stats['paused'] += 1
+                requests.put(job)
+                return self.__queued__(requests)
+            if self.__overload == 'backpressure':
+                with self.__lock:
+                    self.__stats['paused'] += 1
+                return False
+            with self.__lock:
+                self.__stats['rejected'] += 1
+            done(self.__reject(request), None)
+            return True
+        return self.__queued__(requests)
+
+    def __queued__(self, requests):
+        with self.__lock:
+            self.__stats['queued'] += 1
+            self.__stats['max_queue_depth'] = max(
+                self.__stats['max_queue_depth'], requests.qsize())
+        return True
+
+    def __call__(self, request):
+        # Blocking callers (one thread per connection) stop reading their
+        # socket while waiting, that is the backpressure
+        finished = threading.Event()
+        result = []
+        def done(response, error):
+            result.extend([response, error])
+            finished.set()
+        self.submit(request, done, block=True)
+        finished.wait()
+        response, error = result
+        if error is not None:
+            raise error
+        return response
+
+    def __work__(self, requests):
+        while True:
+            job = requests.get()
+            if job is None:
+                break
+            request, done, queued_at = job
+            waited = time.time() - queued_at
+            with self.__lock:
+                self.__busy += 1
+                self.__stats['total_wait_time'] += waited
+                self.__stats['max_wait_time'] = max(
+                    self.__stats['max_wait_time'], waited)
+            response, error = None, None
+            try:
+                response = self.__callback(request)
+            except Exception, e:
+                logger.exception('Request dispatch failed')
+                error = e
+            with self.__lock:
+                self.__busy -= 1
+                self.__stats['completed'] += 1
+            done(response, error)
+            del job, request, response
+
+
+#
+# Process pool: handlers are inherited by forked workers, only handler IDs
+# and marshalled messages cross the process boundary
+#
+
+_PROCESS_HANDLERS = {}
+
+
+def _init_process_():
+    """ Workers are forked while server threads run: logging locks held by
+    them at fork time would never be released in the worker. """
+    logging._lock = threading.RLock()
+    for reference in logging._handlerList:
+        handler = reference()
+        if handler is not None:
+            handler.createLock()
+
+
+def _call_in_process_(pool_key, id, payload):
+    return _PROCESS_HANDLERS[pool_key][id](payload)
+
+
+class ProcessPool(object):
+    """ Run handlers in worker processes, outside of the server GIL.
+
+    Handlers take and return marshalled messages, so they must be stateless:
+    workers run a copy of them forked when the pool is started.
+    """
+    def __init__(self, processes=None):
+        self.__key = str(uuid.uuid4())
+        self.__processes = processes or multiprocessing.cpu_count()
+        self.__handlers = {}
+        self.__pool = None
+        self.__lock = threading.Lock()
+        self.__stats = {
+            'calls': 0,
+            'restarts': 0
+            }
+
+    @property
+    def processes(self):
+        return self.__processes
+
+    @property
+    def running(self):
+        return self.__pool is not None
+
+    @property
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+        stats['processes'] = self.__processes
+        stats['handlers'] = len(self.__handlers)
+        return stats
+
+    def __contains__(self, id):
+        return id in self.__handlers
+
+    def register(self, id, handler):
+        """ Add a handler, running workers are replaced to get it.
+
+        Args:
+            id: handler ID.
+            handler: callable receiving and returning marshalled messages.
+        """
+        self.__handlers[id] = handler
+        if self.running:
+            self.restart()
+
+    def unregister(self, id):
+        del(self.__handlers[id])
+        if self.running:
+            self.restart()
+
+    def start(self):
+        """ Fork worker processes (nothing is done if already running). """
+        with self.__lock:
+            if self.__pool is None:
+                _PROCESS_HANDLERS[self.__key] = self.__handlers
+                self.__pool = multiprocessing.Pool(self.__processes, _init_process_)
+                _DEB('Process pool started with %d workers',
+                     self.__processes)
+
+    def __retire__(self, pool):
+        """ Wait for the calls given to a replaced or stopped pool. """
+        if pool is not None:
+            pool.join()
+            _DEB('Process pool stopped')
+
+    def close(self):
+        """ Wait for running calls and stop workers. """
+        with self.__lock:
+            pool, self.__pool = self.__pool, None
+            if pool is not None:
+                # No call is given to a closed pool: see call()
+                pool.close()
+                _PROCESS_HANDLERS.pop(self.__key, None)
+        self.__retire__(pool)
+
+    def restart(self):
+        """ Fork new workers with the current handlers, calls given to the
+        old ones are completed by them. """
+        pool = multiprocessing.Pool(self.__processes, _init_process_)
+        with self.__lock:
+            old_pool, self.__pool = self.__pool, pool
+            self.__stats['restarts'] += 1
+            if old_pool is not None:
+                old_pool.close()
+        self.__retire__(old_pool)
+
+    def call(self, id, payload):
+        """ Run a handler in a worker process.
+
+        Args:
+            id: handler ID.
+            payload: marshalled message given to the handler.
+
+        Returns:
+            marshalled message returned by the handler.
+
+        Raises:
+            DispatchError: workers are not running or the call failed.
+        """
+        with self.__lock:
+            # Pool cannot be closed (or replaced) while the call is given
+            if self.__pool is None:
+                raise DispatchError('worker processes are not running')
+            result = self.__pool.apply_async(
+                _call_in_process_, (self.__key, id, str(payload)))
+            self.__stats['calls'] += 1
+        try:
+            return result.get()
+        except Exception, e:
+            raise DispatchError('call to worker process failed (%s)' % e)
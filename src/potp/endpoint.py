@@ -3,16 +3,23 @@
 # Python Object Transfer
 #
 
-import ssl
 import json
 import uuid
 import socket
+import threading
+import time
 import logging
 logger = logging.getLogger(__name__)
 _DEB = logger.debug
 
 import protocols
+import envelope
+import futures
+import registry
+import cache
 import transport
+import dispatch
+import pool
 
 
 #
@@ -23,13 +30,13 @@ class InvalidMessageFormat(Exception):
     def __init__(self, given_format='unknown'):
         self.__bad_format = given_format
     def __str__(self):
-        return 'Message should be a dict but "%s" given.' & self.__bad_format
+        return 'Message should be a dict but "%s" given.' % self.__bad_format
 
 class MissingMessageKey(Exception):
     def __init__(self, missing_key='unknown'):
         self.__missing_key = missing_key
     def __str__(self):
-        return 'The following key "%s" is missing in the message.' & self.__missing_key
+        return 'The following key "%s" is missing in the message.' % self.__missing_key
 
 class AnonymousMessage(Exception):
     def __str__(self):
@@ -65,13 +72,51 @@ class EndpointNotConnected(Exception):
     def __str__(self):
         return 'Endpoint is disconnected, connect first.'
 
+class UnreachableSAP(Exception):
+    def __init__(self, sap='unknown'):
+        self.__sap = sap
+    def __str__(self):
+        return 'Endpoint transport cannot reach "%s".' % self.__sap
+
+class ServerStopping(Exception):
+    def __str__(self):
+        return 'Server is stopping and does not accept new requests.'
+
+class ServerOverloaded(Exception):
+    def __str__(self):
+        return 'Server request queue is full, try again later.'
+
+class BinaryEnvelopeRequired(Exception):
+    def __str__(self):
+        return 'Handler runs in worker processes, use binary envelopes.'
+
 _ERROR = {
     'missing key': { 'error': True, 'exception': MissingMessageKey() },
     'anonymous not allowed': { 'error': True, 'exception': AnonymousMessage() },
     'unknown destination': { 'error': True, 'exception': RequestedHandlerNotFound() },
     'no error': { 'error': False },
-    'handler exception': { 'error': True, 'exception': None }
+    'handler exception': { 'error': True, 'exception': None },
+    'server stopping': { 'error': True, 'exception': ServerStopping() },
+    'server overloaded': { 'error': True, 'exception': ServerOverloaded() },
+    'invalid message': { 'error': True, 'exception': InvalidMessageFormat() },
+    'envelope required': { 'error': True,
+                           'exception': BinaryEnvelopeRequired() }
     }
+# Replies marshalled once by each server: _ERROR dict id -> name
+_CONTROL = dict((id(reply), name) for name, reply in _ERROR.items()
+                if reply.get('exception', None) is not None)
+
+# Reply of one-way requests: transports send nothing (or an empty frame)
+_NO_REPLY = ''
+# Batches are requests to this handler: servers not aware of batches reply
+# them with an unknown destination error
+_BATCH_DEST = 'potp-batch'
+
+# Marshalled errors of unknown handlers kept by each server
+_STALE_REPLIES = 256
+
+# Seconds waited for in-flight requests when a server stops
+_SHUTDOWN_TIMEOUT = 5.0
 
 class Endpoint(object):
     __protocol = None
@@ -86,7 +131,9 @@ class Endpoint(object):
         self.__allow_anonymous = False
         self.__anonymous = False
         self.__id = str(uuid.uuid4())
-        _DEB('Endpoint "%s" created' % self.__id)
+        # Optional potp.metrics.Metrics(), shared with the transport
+        self.__metrics = qos.get('metrics', None)
+        _DEB('Endpoint "%s" created', self.__id)
         
     def __marshall__(self, to_send):
         return self.__protocol.marshall(to_send)
@@ -94,6 +141,12 @@ class Endpoint(object):
     def __unmarshall__(self, received):
         return self.__protocol.unmarshall(received)
 
+    def __dump__(self, to_send, stream):
+        self.__protocol.dump(to_send, stream)
+
+    def __load__(self, stream):
+        return self.__protocol.load(stream)
+
     def __basic_message_checks__(self, message):
         if not isinstance(message, dict):
             raise InvalidMessageFormat(type(message))
@@ -108,6 +161,15 @@ class Endpoint(object):
     def transport(self):
         return self.__transport
 
+    @property
+    def metrics(self):
+        return self.__metrics
+
+    def __set_transport__(self, new_transport):
+        _DEB('Endpoint "%s" switch to %s', self.__id,
+             type(new_transport).__name__)
+        self.__transport = new_transport
+
     @property
     def uri(self):
         return 'potp://%s' % self.__transport.sap
@@ -133,92 +195,584 @@ class Endpoint(object):
 
     
 class Server(Endpoint):
-    __request_handler = {}
     __default_handler = None
-    __run_as_server = False
     
     def __init__(self, qos={}):
         Endpoint.__init__(self, qos)
-        self.transport.bind(self._dispatcher_)
-        
-    def register_request_handler(self, request_handler, id=None):
+        self.__shutdown_timeout = qos.get('shutdown_timeout',
+                                          _SHUTDOWN_TIMEOUT)
+        # Drain timeout given to stop(), only for that stop
+        self.__stop_timeout = None
+        self.__stop_request = threading.Event()
+        self.__ready = threading.Event()
+        # Requests being dispatched, guarded by the condition
+        self.__idle = threading.Condition()
+        self.__in_flight = 0
+        self.__draining = False
+        self.__server_thread = None
+        # Optional bounded worker pool between transport and dispatcher
+        self.__workers = None
+        if qos.get('dispatch', None) is not None:
+            self.__workers = dispatch.WorkerPool(
+                self._dispatcher_, self.__overloaded__, **qos['dispatch'])
+            self.transport.bind(self.__workers)
+        else:
+            self.transport.bind(self._dispatcher_)
+        # Worker processes for handlers registered with process=True
+        self.__engine = qos.get('server_engine', 'threading')
+        self.__process_options = qos.get('process_pool', {})
+        self.__processes = None
+        # Marshalled replies of handlers giving cache keys (opt-in)
+        self.__cache = None
+        if qos.get('result_cache', None) is not None:
+            self.__cache = cache.ResultCache(**qos['result_cache'])
+        # Request handlers by ID and by binary envelope handle, replies
+        # of collected handlers are discarded with them
+        self.__handlers = registry.HandlerRegistry(
+            None if self.__cache is None else self.__cache.discard)
+        # Error and control replies are the same every time: marshalled
+        # once, rejected requests cost no serialization
+        self.__control = dict((name, self.__marshall__(_ERROR[name]))
+                              for name in _CONTROL.values())
+        # Marshalled errors of unknown handler IDs (or handles)
+        self.__stale = {}
+
+    def register_request_handler(self, request_handler, id=None,
+                                 process=False, weak=False, cache_key=None):
+        """ Add a request handler.
+
+        Args:
+            request_handler: callable receiving requests, returns the reply.
+            id: handler ID, a random one is used if not given.
+            process: run the handler in worker processes (see "process_pool"
+                qos). Only stateless handlers can do it, since processes
+                run a copy of the handler. Requests must use the binary
+                envelope (see "envelope" qos): they are routed by header
+                and unmarshalled by the worker only. Event loop servers
+                need "dispatch" workers to wait for worker processes.
+            weak: do not keep the handler (or the object of a bound method)
+                alive, it is unregistered once collected.
+            cache_key: callable giving a (hashable) tuple for requests
+                whose reply can be reused, None for the rest of them. Used
+                if the "result_cache" qos is given, handler exceptions are
+                never cached.
+
+        Returns:
+            handler ID.
+        """
         id = str(uuid.uuid4()) if (id is None) else id
-        _DEB('Register handler: %s' % id)
+        if process and self.__engine == 'eventloop' and self.__workers is None:
+            # Loop would wait for every call to worker processes
+            raise dispatch.DispatchError(
+                'process handlers need "dispatch" workers in event loop')
+        _DEB('Register handler: %s', id)
+        self.__handlers.register(id, request_handler, weak, cache_key)
+        if process:
+            if self.__processes is None:
+                self.__processes = dispatch.ProcessPool(
+                    **self.__process_options)
+            self.__processes.register(
+                id, lambda request: str(self.__process_reply__(id, request)))
         # First request handler is the default
-        self.__request_handler[id] = request_handler
         if self.__default_handler is None:
             self.set_default_handler(id)
+        return id
 
     def set_default_handler(self, id):
-        if id not in self.__request_handler.keys():
+        if id not in self.__handlers:
             raise RequestedHandlerNotFound(id)
-        _DEB('Set default handler: %s' % id)
+        _DEB('Set default handler: %s', id)
         self.__default_handler = id
 
     def unregister_handler(self, id):
-        if id not in self.__request_handler.keys():
-            raise RequestedHandlerNotFound(id)
         if self.__default_handler == id:
             raise CannotUnregisterDefaultHandler()
-        _DEB('Unregister handler: %s')
-        del(self.__request_handler[id])
+        _DEB('Unregister handler: %s', id)
+        if not self.__handlers.unregister(id):
+            raise RequestedHandlerNotFound(id)
+        if self.__cache is not None:
+            self.__cache.discard(id)
+        if self.__processes is not None and id in self.__processes:
+            self.__processes.unregister(id)
+
+    def handle_of(self, id):
+        """ Binary envelope handle of a registered handler. """
+        handle = self.__handlers.handle_of(id)
+        if handle is None:
+            raise RequestedHandlerNotFound(id)
+        return handle
+
+    def invalidate_cache(self, id, prefix=()):
+        """ Forget cached replies of a handler (every one, or the ones
+        whose cache key starts with prefix). """
+        if self.__cache is not None:
+            self.__cache.invalidate(id, prefix)
+
+    @property
+    def cache_stats(self):
+        """ Result cache hits, misses, evictions... if enabled. """
+        if self.__cache is None:
+            return None
+        return self.__cache.stats
+
+    @property
+    def handler_stats(self):
+        """ Handler registry counters and occupancy. """
+        return self.__handlers.stats
+
+    @property
+    def in_flight(self):
+        return self.__in_flight
+
+    @property
+    def shutdown_timeout(self):
+        return self.__shutdown_timeout
+
+    @property
+    def process_stats(self):
+        """ Process pool stats if some handler runs in processes. """
+        if self.__processes is None:
+            return None
+        return self.__processes.stats
+
+    @property
+    def dispatch_stats(self):
+        """ Worker pool stats (queue depth, wait times...) if enabled. """
+        if self.__workers is None:
+            return None
+        return self.__workers.stats
 
     def stop_serving(self):
         _DEB('Shutdown received')
-        self.__run_as_server = False
+        self.__stop_request.set()
+
+    def serve_forever(self, sap=None):
+        """ Serve requests until stop_serving() is called.
 
-    def server_loop(self, sap=None):
+        Args:
+            sap: SAP to listen to, transport default is used if not given.
+        """
         _DEB('Starting server loop')
-        # if self.__default_handler is None:
-        #     raise NoDefaultHandlerRegistered()
         if sap is None:
             sap = self.transport.create_sap()
-        _DEB('Server SAP: %s' % sap)
+        _DEB('Server SAP: %s', sap)
+        with self.__idle:
+            self.__draining = False
+        if self.__workers is not None:
+            self.__workers.start()
+        if self.__processes is not None:
+            self.__processes.start()
         self.transport.open(sap)
-        self.__run_as_server = True        
-        while self.__run_as_server:
-            pass
-        self.transport.close()
+        self.__ready.set()
+        try:
+            # Without timeout Event.wait() cannot be interrupted in Python 2
+            while not self.__stop_request.wait(3600.0):
+                pass
+            timeout, self.__stop_timeout = self.__stop_timeout, None
+            self.__drain__(self.__shutdown_timeout if timeout is None
+                           else timeout)
+        finally:
+            self.__ready.clear()
+            self.__stop_request.clear()
+            self.__stop_timeout = None
+            self.transport.close()
+            if self.__workers is not None:
+                self.__workers.close()
+            if self.__processes is not None:
+                self.__processes.close()
+        _DEB('Server loop finished')
+
+    # Deprecated name of serve_forever()
+    server_loop = serve_forever
+
+    def start(self, sap=None):
+        """ Serve requests in a background thread.
+
+        Args:
+            sap: SAP to listen to, transport default is used if not given.
+
+        Returns:
+            server thread, use wait_ready() before connecting to it.
+        """
+        self.__server_thread = threading.Thread(target=self.serve_forever,
+                                                args=(sap,))
+        self.__server_thread.daemon = True
+        self.__server_thread.start()
+        return self.__server_thread
+
+    def wait_ready(self, timeout=None):
+        """ Block until the server is listening.
+
+        Args:
+            timeout: maximum seconds to wait, forever if not given.
+
+        Returns:
+            True if server is ready, False if timeout expired.
+        """
+        return self.__ready.wait(timeout)
+
+    def stop(self, timeout=None):
+        """ Stop serving, draining in-flight requests.
+
+        Args:
+            timeout: seconds given to in-flight requests before closing
+                the transport, shutdown_timeout qos is used if not given.
+        """
+        self.__stop_timeout = timeout
+        self.stop_serving()
+        server_thread, self.__server_thread = self.__server_thread, None
+        if server_thread is not None and \
+           server_thread is not threading.current_thread():
+            server_thread.join()
+
+    def __drain__(self, timeout):
+        """ Reject new requests and wait for the in-flight ones. """
+        with self.__idle:
+            self.__draining = True
+            if timeout is None:
+                while self.__in_flight:
+                    self.__idle.wait()
+            else:
+                deadline = time.time() + timeout
+                while self.__in_flight:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        logger.warning('Server stops with %d requests in flight'
+                                       % self.__in_flight)
+                        break
+                    self.__idle.wait(remaining)
+
+    def __overloaded__(self, request):
+        _DEB('Request rejected, dispatch queue is full')
+        return self.__reject__('server overloaded')
 
     # It is synchronous
     def _dispatcher_(self, request):
-        request = self.__unmarshall__(request)
+        metrics = self.metrics
+        if metrics is None:
+            return self.__serve_request__(request)
+        if not hasattr(request, 'read'):
+            metrics.increment('server_bytes_in', len(request))
+        metrics.gauge('server_in_flight', 1)
+        try:
+            response = self.__serve_request__(request)
+        finally:
+            metrics.gauge('server_in_flight', -1)
+        if not callable(response):
+            metrics.increment('server_bytes_out', len(response))
+        return response
+
+    def __serve_request__(self, request):
+        # Streamed request: reply is streamed too
+        streamed = hasattr(request, 'read')
+        marshalled = None
+        if streamed:
+            request = self.__load__(request)
+        elif self.__draining:
+            # Fast rejection: nothing is decoded
+            return self.__reject__('server stopping')
+        elif envelope.is_envelope(request):
+            reply = self.__tracked__(self.__dispatch_envelope__, request)
+            return reply if reply is not None else self.__reject__(
+                'server stopping')
+        else:
+            marshalled = request
+            try:
+                request = self.__unmarshall__(request)
+            except Exception:
+                # Any error can be raised decoding a malformed message
+                _DEB('Request cannot be decoded!')
+                return self.__reject__('invalid message')
+            if not isinstance(request, dict):
+                _DEB('Request is not a dict!')
+                return self.__reject__('invalid message')
+        if request.get('dest', None) == _BATCH_DEST:
+            dispatch, marshalled = self.__dispatch_batch__, None
+        else:
+            dispatch = self.__dispatch_request__
+        reply = self.__tracked__(dispatch, request, marshalled)
+        if reply is None:
+            reply = _ERROR['server stopping']
+        elif request.get('oneway', False):
+            # Reply (or exception) is counted, never marshalled
+            return _NO_REPLY
+        if streamed:
+            return lambda stream: self.__dump__(reply, stream)
+        if isinstance(reply, (str, protocols.Segments)):
+            # Already marshalled (cached or by a worker process)
+            return reply
+        if id(reply) in _CONTROL:
+            return self.__control[_CONTROL[id(reply)]]
+        return self.__marshall__(reply)
+
+    def __reject__(self, name):
+        """ Marshalled control reply of a request not dispatched. """
+        if self.metrics is not None:
+            self.metrics.increment('server_rejected', reason=name)
+        return self.__control[name]
+
+    def __tracked__(self, dispatch, *args):
+        """ Call dispatch(*args) counted as in flight, None if the server
+        is draining. """
+        with self.__idle:
+            if self.__draining:
+                return None
+            self.__in_flight += 1
+        try:
+            return dispatch(*args)
+        finally:
+            with self.__idle:
+                self.__in_flight -= 1
+                if not self.__in_flight:
+                    self.__idle.notify_all()
+
+    def __count_request__(self, handler, started, error):
+        metrics = self.metrics
+        handler = self.__default_handler if handler is None else handler
+        metrics.increment('server_requests', handler=handler)
+        metrics.observe('server_latency_seconds', time.time() - started,
+                        handler=handler)
+        if error:
+            metrics.increment('server_errors', handler=handler)
+
+    def __dispatch_request__(self, request, marshalled=None):
+        if self.metrics is None:
+            return self.__route_request__(request, marshalled)
+        started = time.time()
+        reply = self.__route_request__(request, marshalled)
+        self.__count_request__(
+            request.get('dest', None) if isinstance(request, dict) else None,
+            started, isinstance(reply, dict) and reply.get('error', False))
+        return reply
+
+    def __dispatch_batch__(self, batch, marshalled=None):
+        """ Dispatch every request of a batch, reply holds a list of
+        (error, return value or exception) pairs. """
+        try:
+            self.__check_message_request__(batch)
+        except MissingMessageKey:
+            _DEB('Missing Key in request!')
+            return _ERROR['missing key']
+        except AnonymousMessage:
+            if not self.allow_anonymous:
+                _DEB('Anonymous messages not allowed!')
+                return _ERROR['anonymous not allowed']
+        if not isinstance(batch['req'], (list, tuple)) or not all(
+                isinstance(item, (list, tuple)) and len(item) == 2 and
+                (item[0] is None or isinstance(item[0], basestring))
+                for item in batch['req']):
+            _DEB('Batch is not a list of (destination, request) pairs!')
+            return _ERROR['invalid message']
+        requests = batch['req']
+        # Message checks are done once: handlers are called directly
+        handlers, processes = self.__handlers, self.__processes
+        metrics = self.metrics
+        results = []
+        for dest, request in requests:
+            dest = self.__default_handler if dest is None else dest
+            handler = handlers.get(dest)
+            if handler is None:
+                _DEB('Message have and unknown destination "%s"!', dest)
+                results.append((True, _ERROR['unknown destination'][
+                    'exception']))
+                continue
+            started = None if metrics is None else time.time()
+            if processes is not None and dest in processes:
+                try:
+                    kind, flags, handle, name, payload = envelope.unpack(
+                        processes.call(dest, envelope.pack(
+                            envelope.REQUEST, 0, envelope.DEFAULT_HANDLE,
+                            self.__marshall__(request))))
+                    result = (bool(flags & envelope.FLAG_EXCEPTION),
+                              self.__unmarshall__(payload))
+                except dispatch.DispatchError, e:
+                    _DEB('Request causes exception "%s"!', e)
+                    result = (True, e)
+            else:
+                try:
+                    result = (False, handler(request))
+                except Exception, e:
+                    _DEB('Request causes exception "%s"!', e)
+                    result = (True, e)
+            results.append(result)
+            if metrics is not None:
+                self.__count_request__(dest, started, result[0])
+        _DEB('Batch of %d requests dispatched', len(results))
+        reply = {'src': _BATCH_DEST, 'dest': batch['src'], 'ret': results}
+        reply.update(_ERROR['no error'])
+        return reply
+
+    def __dispatch_envelope__(self, message):
+        """ Route a binary envelope request, returns the marshalled
+        reply. """
+        if self.metrics is None:
+            return self.__route_envelope__(message)[1]
+        started = time.time()
+        dest, reply = self.__route_envelope__(message)
+        self.__count_request__(dest, started, reply is not _NO_REPLY and (
+            not envelope.is_envelope(reply) or envelope.unpack(reply)[1] & (
+                envelope.FLAG_EXCEPTION | envelope.FLAG_STALE)))
+        return reply
+
+    def __route_envelope__(self, message):
+        try:
+            kind, flags, handle, name, payload = envelope.unpack(message)
+        except envelope.InvalidEnvelope:
+            _DEB('Invalid binary envelope!')
+            return None, self.__control['invalid message']
+        if flags & envelope.FLAG_ANONYMOUS and not self.allow_anonymous:
+            _DEB('Anonymous messages not allowed!')
+            return None, self.__control['anonymous not allowed']
+        target = name or handle
+        if flags & envelope.FLAG_NAMED:
+            handle = self.__handlers.handle_of(name)
+        elif handle == envelope.DEFAULT_HANDLE:
+            target = self.__default_handler
+            handle = self.__handlers.handle_of(self.__default_handler)
+        # Route by index: no handler ID is hashed
+        entry = None if handle is None else self.__handlers.resolve(handle)
+        if entry is None:
+            _DEB('Message have and unknown destination "%s"!', target)
+            return name, envelope.pack(envelope.REPLY, envelope.FLAG_STALE,
+                                       handle or 0,
+                                       self.__stale_reply__(target))
+        dest, handler = entry
+        if self.__processes is not None and dest in self.__processes:
+            # Worker gets the request as received
+            try:
+                return dest, self.__processes.call(dest, message)
+            except dispatch.DispatchError, e:
+                _DEB('Request causes exception "%s"!', e)
+                return dest, envelope.pack(envelope.REPLY,
+                                           envelope.FLAG_EXCEPTION, handle,
+                                           self.__marshall__(e))
+        request = self.__unmarshall__(payload)
+        oneway = flags & envelope.FLAG_ONEWAY
+        key = None if oneway else self.__cache_key__(dest, request, 'binary')
+        if key is None:
+            return dest, self.__envelope_reply__(handle, handler, request,
+                                                 oneway)
+        # Cached payload is the marshalled return value: hits are packed
+        ret = self.__cache.get(key)
+        if ret is not None:
+            return dest, envelope.pack(envelope.REPLY, 0, handle, ret)
+        # Not cached if handler is invalidated while running
+        generation = self.__cache.generation(dest)
+        reply = self.__envelope_reply__(handle, handler, request)
+        kind, flags, handle, name, ret = envelope.unpack(reply)
+        if not flags & envelope.FLAG_EXCEPTION:
+            self.__cache.put(key, ret, generation)
+        return dest, reply
+
+    def __stale_reply__(self, target):
+        """ Marshalled error of an unknown handler ID (or handle). """
+        reply = self.__stale.get(target, None)
+        if reply is None:
+            if len(self.__stale) >= _STALE_REPLIES:
+                # Unknown IDs are chosen by clients: keep a bounded set
+                self.__stale.clear()
+            reply = self.__marshall__(RequestedHandlerNotFound(target))
+            self.__stale[target] = reply
+        return reply
 
+    def __cache_key__(self, dest, request, kind):
+        """ Result cache key of a request, None if not cacheable. """
+        if self.__cache is None:
+            return None
+        cache_key = self.__handlers.cache_key_of(dest)
+        if cache_key is None:
+            return None
+        try:
+            key = cache_key(request)
+        except Exception, e:
+            # Malformed request: handler will raise it too
+            _DEB('Request has no cache key "%s"!', e)
+            return None
+        return None if key is None else (dest, tuple(key), kind)
+
+    def __envelope_reply__(self, handle, handler, request, oneway=False):
+        flags = 0
+        try:
+            _DEB('Request received: "%r"', request)
+            ret = handler(request)
+        except Exception, e:
+            _DEB('Request causes exception "%s"!', e)
+            flags, ret = envelope.FLAG_EXCEPTION, e
+        if oneway and not flags:
+            return _NO_REPLY
+        return envelope.pack(envelope.REPLY, flags, handle,
+                             self.__marshall__(ret))
+
+    def __process_reply__(self, dest, request):
+        """ Reply of a handler running in a worker process. """
+        kind, flags, handle, name, payload = envelope.unpack(request)
+        return self.__envelope_reply__(self.__handlers.handle_of(dest),
+                                       self.__handlers.get(dest),
+                                       self.__unmarshall__(payload),
+                                       flags & envelope.FLAG_ONEWAY)
+
+    def __route_request__(self, request, marshalled):
         try:
             self.__check_message_request__(request)
         except MissingMessageKey:
             _DEB('Missing Key in request!')
-            return self.__marshall__(_ERROR['missing key'])
+            return _ERROR['missing key']
         except AnonymousMessage:
             if not self.allow_anonymous:
                 _DEB('Anonymous messages not allowed!')
-                return self.__marshall__(_ERROR['anonymous not allowed'])
+                return _ERROR['anonymous not allowed']
             
-        src = request.get('src', None)
-
         if request['dest'] is None:
             dest = self.__default_handler
         else:
             dest = request['dest']
 
-        if dest not in self.__request_handler.keys():
-            _DEB('Message have and unknown destination "%s"!' % dest)
-            return self.__marshall__(_ERROR['unknown destination'])
+        handler = self.__handlers.get(dest)
+        if handler is None:
+            _DEB('Message have and unknown destination "%s"!', dest)
+            return _ERROR['unknown destination']
+
+        if marshalled is not None and self.__processes is not None and \
+           dest in self.__processes:
+            # Dict requests would be unmarshalled twice
+            _DEB('Process handler "%s" needs binary envelopes!', dest)
+            return _ERROR['envelope required']
+        # Only whole messages: streamed replies are not marshalled at once
+        key = None
+        if marshalled is not None and not request.get('oneway', False):
+            key = self.__cache_key__(dest, request['req'], 'dict')
+        if key is None:
+            return self.__handler_reply__(dest, handler, request)
+        reply = self.__cache.get(key)
+        if reply is not None:
+            return reply
+        # Not cached if handler is invalidated while running
+        generation = self.__cache.generation(dest)
+        reply = self.__handler_reply__(dest, handler, request)
+        if reply['error']:
+            return reply
+        # Cached replies are shared by every client: no destination
+        reply['dest'] = None
+        reply = self.__marshall__(reply)
+        self.__cache.put(key, reply, generation)
+        return reply
 
+    def __handler_reply__(self, dest, handler, request):
+        src = request.get('src', None)
         # Create reply
         reply = { 'dest': src,
                   'src': dest }
         # Callback
         try:
-            _DEB('Request received: "%s"' % repr(request['req']))
-            reply.update({'ret': self.__request_handler[dest](request['req'])})
+            _DEB('Request received: "%r"', request['req'])
+            reply.update({'ret': handler(request['req'])})
             reply.update(_ERROR['no error'])            
         except Exception, e:
-            _DEB('Request causes exception "%s"!' % str(e))
+            _DEB('Request causes exception "%s"!', e)
             reply.update(_ERROR['handler exception'])
             reply.update({'exception': e})
         # Return
-        return self.__marshall__(reply)
+        return reply
 
     def __check_message_request__(self, message):
         self.__basic_message_checks__(message)
@@ -230,9 +784,36 @@ class Server(Endpoint):
 
 class Client(Endpoint):
     __dest_handler = None
+    __pool = None
     
     def __init__(self, qos={}):
         Endpoint.__init__(self, qos)
+        self.__client_setup__(qos)
+
+    def __client_setup__(self, qos):
+        self.__qos = qos
+        self.__pool = None
+        # Stream messages instead of marshalling them at once
+        self.__streamed = qos.get('chunk_size', None) is not None
+        # Protocols negotiated by connection handshakes: name -> Protocol()
+        self.__protocols = {qos.get('protocol', 'pip'): None}
+        # Binary envelope (see potp.envelope) instead of dict messages
+        if qos.get('envelope', 'dict') not in envelope.ENVELOPES:
+            raise envelope.UnknownEnvelope(qos['envelope'])
+        self.__binary = qos.get('envelope', 'dict') == 'binary' and \
+            not isinstance(protocols.get_protocol(qos), protocols.Passthrough)
+        # Handles of remote handlers: handler ID -> handle
+        self.__handles = {}
+        # Server dispatches batches (see request_many())
+        self.__batches = True
+
+    @property
+    def client_enabled(self):
+        return self.__pool is not None or Endpoint.client_enabled.fget(self)
+
+    @property
+    def pool(self):
+        return self.__pool
         
     def __check_message_reply__(self, message):
         self.__basic_message_checks__(message)
@@ -242,42 +823,205 @@ class Client(Endpoint):
             raise MissingMessageKey('error')
     
     def connect(self, uri):
-        _DEB('Endpoint wants to connect to: %s' % uri)
+        _DEB('Endpoint wants to connect to: %s', uri)
         if not isinstance(uri, str):
             raise CannotEncodeURI(uri)
         if not uri.startswith('potp://'):
             raise CannotEncodeURI(uri)
-        uri = uri[7:]
-        if '/' in uri:
-            sap = uri.split('/')[0]
-            self.__dest_handler = uri[uri.index('/') + 1:]
-        else:
-            sap = uri
-            self.__dest_handler = None
+        sap, self.__dest_handler = transport.split_URI(uri[7:])
         sap = transport.encode_SAP(sap)
-        _DEB('Client SAP: %s' % sap)
-        _DEB('Dest=%s' % self.__dest_handler)
+        _DEB('Client SAP: %s', sap)
+        _DEB('Dest=%s', self.__dest_handler)
+        self.__handles = {}
+        self.__batches = True
+        if 'connection_pool' in self.__qos:
+            # Pooled mode: each request borrows a connection
+            qos = self.__qos
+            self.__pool = pool.get_pool(
+                sap, lambda: transport.get_transport(qos, sap),
+                transport.connection_settings(qos), **qos['connection_pool'])
+            return
+        if sap.kind != self.transport.sap_type.kind:
+            # URI selects the transport, unless it is already serving
+            if self.server_enabled:
+                raise UnreachableSAP(sap)
+            self.__set_transport__(transport.get_transport(self.__qos, sap))
         self.transport.connect(sap)
 
     def disconnect(self):
         _DEB('Endpoint wants to disconnect')
-        self.transport.disconnect()
+        if self.__pool is not None:
+            # Pool is shared with other clients of same SAP
+            self.__pool = None
+        else:
+            self.transport.disconnect()
         self.__dest_handler = None
         
-    def request(self, request, dest_handler=None):
-        if not self.client_enabled:
-            raise EndpointNotConnected()
+    def __protocol_of__(self, connection):
+        """ Protocol chosen in the connection handshake, None if it is
+        the endpoint one. """
+        negotiated = connection.negotiated
+        if negotiated is None or negotiated.get('protocol', None) is None:
+            return None
+        name = negotiated['protocol']
+        if name not in self.__protocols:
+            self.__protocols[name] = protocols.get_protocol({'protocol': name})
+        return self.__protocols[name]
+
+    def __codec_of__(self, connection):
+        """ (marshall, unmarshall, dump, load) of the connection protocol. """
+        protocol = self.__protocol_of__(connection)
+        if protocol is None:
+            return (self.__marshall__, self.__unmarshall__,
+                    self.__dump__, self.__load__)
+        return (protocol.marshall, protocol.unmarshall,
+                protocol.dump, protocol.load)
+
+    def __count_bytes__(self, request, response):
+        if self.metrics is not None:
+            self.metrics.increment('client_bytes_out', len(request))
+            self.metrics.increment('client_bytes_in', len(response))
+
+    def __exchange__(self, connection, request, binary=True):
+        marshall, unmarshall, dump, load = self.__codec_of__(connection)
+        if self.__streamed:
+            return connection.stream_request(
+                lambda stream: dump(request, stream), load)
+        if self.__binary and binary:
+            return self.__exchange_envelope__(connection, request['req'],
+                                              request['dest'], marshall,
+                                              unmarshall)
+        request = marshall(request)
+        response = connection.send_request(request)
+        self.__count_bytes__(request, response)
+        return unmarshall(response)
+
+    def __exchange_envelope__(self, connection, request, dest, marshall,
+                              unmarshall):
+        """ Send request in a binary envelope, returns the reply as the
+        dict envelope would give it. """
+        handle = (envelope.DEFAULT_HANDLE if dest is None
+                  else self.__handles.get(dest, None))
+        request = marshall(request)
+        while True:
+            message = self.__envelope_message__(request, dest, handle)
+            response = connection.send_request(message)
+            self.__count_bytes__(message, response)
+            reply = self.__envelope_response__(response, dest, handle,
+                                               unmarshall)
+            if reply is not None:
+                return reply
+            handle = None
+
+    def __envelope_message__(self, request, dest, handle, oneway=False):
+        flags = envelope.FLAG_ANONYMOUS if self.anonymous else 0
+        if oneway:
+            flags |= envelope.FLAG_ONEWAY
+        if handle is None:
+            # First request to this handler: server gives the handle
+            return envelope.pack(envelope.REQUEST,
+                                 flags | envelope.FLAG_NAMED, 0,
+                                 request, dest)
+        return envelope.pack(envelope.REQUEST, flags, handle, request)
 
+    def __envelope_response__(self, response, dest, handle, unmarshall):
+        """ Reply of a binary envelope request as the dict envelope would
+        give it, None if request must be sent again by name. """
+        if not envelope.is_envelope(response):
+            # Server errors (e.g. rejected requests) use dict envelope
+            return unmarshall(response)
+        kind, reply_flags, reply_handle, name, ret = envelope.unpack(response)
+        stale = reply_flags & envelope.FLAG_STALE
+        if stale and handle is not None and dest is not None:
+            # Handle given by another server: resolve it again
+            _DEB('Stale handle %s of "%s"', handle, dest)
+            self.__handles.pop(dest, None)
+            return None
+        error = bool(reply_flags & envelope.FLAG_EXCEPTION) or bool(stale)
+        if dest is not None and not stale:
+            self.__handles[dest] = reply_handle
+        reply = {'src': dest, 'dest': self.id, 'error': error}
+        reply['exception' if error else 'ret'] = unmarshall(ret)
+        return reply
+
+    def __submit__(self, connection, request, callback):
+        """ Send request without waiting, callback gets (reply, None) or
+        (None, exception). """
+        marshall, unmarshall, dump, load = self.__codec_of__(connection)
+        if self.__streamed:
+            # Streams hold the connection until reply is read
+            try:
+                reply = self.__exchange__(connection, request)
+            except Exception, e:
+                return callback(None, e)
+            return callback(reply, None)
+        if self.__binary:
+            dest = request['dest']
+            return self.__submit_envelope__(
+                connection, marshall(request['req']), dest,
+                (envelope.DEFAULT_HANDLE if dest is None
+                 else self.__handles.get(dest, None)), unmarshall, callback)
+        message = marshall(request)
+        def replied(response, error):
+            if error is None:
+                self.__count_bytes__(message, response)
+                try:
+                    response = unmarshall(response)
+                except Exception, e:
+                    error = e
+            callback(None if error is not None else response, error)
+        connection.submit_request(message, replied)
+
+    def __submit_envelope__(self, connection, request, dest, handle,
+                            unmarshall, callback):
+        message = self.__envelope_message__(request, dest, handle)
+        def replied(response, error):
+            if error is None:
+                self.__count_bytes__(message, response)
+                try:
+                    reply = self.__envelope_response__(response, dest,
+                                                       handle, unmarshall)
+                    if reply is None:
+                        return self.__submit_envelope__(
+                            connection, request, dest, None, unmarshall,
+                            callback)
+                except Exception, e:
+                    error = e
+            callback(None if error is not None else reply, error)
+        connection.submit_request(message, replied)
+
+    def __message__(self, request, dest_handler):
         handler = self.__dest_handler if dest_handler is None else dest_handler
-        
-        _DEB('Send request: "%s" [%s]' % (repr(request), handler))
+        _DEB('Send request: "%r" [%s]', request, handler)
         # Convert to dict
-        request = { 'req': request }
-        request.update({'src': (self.id)})
-        request.update({'dest': self.__dest_handler})
+        return {'req': request, 'src': self.id, 'dest': handler}
 
-        reply = self.transport.send_request(self.__marshall__(request))
-        reply = self.__unmarshall__(reply)
+    def __started__(self):
+        if self.metrics is None:
+            return None
+        self.metrics.gauge('client_in_flight', 1)
+        return time.time()
+
+    def __finished__(self, dest, started, reply, failed=False):
+        metrics = self.metrics
+        if metrics is None:
+            return
+        metrics.gauge('client_in_flight', -1)
+        if failed:
+            metrics.increment('client_errors', handler=dest)
+            return
+        metrics.increment('client_requests', handler=dest)
+        metrics.observe('client_latency_seconds', time.time() - started,
+                        handler=dest)
+        if isinstance(reply, dict) and reply.get('error', False):
+            metrics.increment('client_errors', handler=dest)
+
+    def __result__(self, reply):
+        """ Value returned by the remote handler, or raise its exception. """
+        # Server errors (e.g. rejected requests) have no reply keys
+        if isinstance(reply, dict) and reply.get('error', False) and \
+           reply.get('exception', None) is not None:
+            raise reply['exception']
 
         # Client raises exception to upper levels
         try:
@@ -299,6 +1043,146 @@ class Client(Endpoint):
         ### Source is: response.get('src', None), is it needed? ###
         return reply['ret']
 
+    def request(self, request, dest_handler=None):
+        if not self.client_enabled:
+            raise EndpointNotConnected()
+        request = self.__message__(request, dest_handler)
+        # Batches use dict envelope (see request_many())
+        binary = request['dest'] != _BATCH_DEST
+        started = self.__started__()
+        try:
+            if self.__pool is not None:
+                with self.__pool.connection() as connection:
+                    reply = self.__exchange__(connection, request, binary)
+            else:
+                reply = self.__exchange__(self.transport, request, binary)
+        except:
+            self.__finished__(request['dest'], started, None, failed=True)
+            raise
+        self.__finished__(request['dest'], started, reply)
+        return self.__result__(reply)
+
+    def request_many(self, requests, dest_handlers=None):
+        """ Send a list of requests in a single message.
+
+        Server dispatches them in order and replies every result in a
+        single message too. Servers not aware of batches get the requests
+        one by one.
+
+        Args:
+            requests: list of requests.
+            dest_handlers: handler ID for every request, a list with one
+                handler ID per request or None (connection handler).
+
+        Returns:
+            list with the value returned by the handler of each request,
+            or the exception it raised (exceptions are not raised).
+        """
+        if not self.client_enabled:
+            raise EndpointNotConnected()
+        requests = list(requests)
+        if dest_handlers is None or isinstance(dest_handlers, str):
+            dest_handlers = [dest_handlers] * len(requests)
+        dests = [self.__dest_handler if dest is None else dest
+                 for dest in dest_handlers]
+        if len(dests) != len(requests):
+            raise ValueError('%d handler IDs given for %d requests' % (
+                len(dests), len(requests)))
+        if self.__batches:
+            try:
+                return [ret for error, ret in self.request(
+                    zip(dests, requests), _BATCH_DEST)]
+            except RequestedHandlerNotFound:
+                _DEB('Server does not support batches')
+                self.__batches = False
+        results = []
+        for request, dest in zip(requests, dests):
+            try:
+                results.append(self.request(request, dest))
+            except Exception, e:
+                results.append(e)
+        return results
+
+    def notify(self, request, dest_handler=None):
+        """ Send a one-way request: handler is called but its reply (or
+        exception) is dropped.
+
+        Returns once the request is written if the server accepted one-way
+        requests in the connection handshake (see "handshake" qos), once
+        the server replied otherwise.
+        """
+        if not self.client_enabled:
+            raise EndpointNotConnected()
+        request = self.__message__(request, dest_handler)
+        request['oneway'] = True
+        started = self.__started__()
+        try:
+            if self.__pool is not None:
+                with self.__pool.connection() as connection:
+                    self.__post__(connection, request)
+            else:
+                self.__post__(self.transport, request)
+        except:
+            self.__finished__(request['dest'], started, None, failed=True)
+            raise
+        self.__finished__(request['dest'], started, None)
+
+    def __post__(self, connection, request):
+        marshall = self.__codec_of__(connection)[0]
+        if self.__binary:
+            dest = request['dest']
+            # No reply tells a handle is stale: always sent by name
+            message = self.__envelope_message__(
+                marshall(request['req']), dest,
+                envelope.DEFAULT_HANDLE if dest is None else None,
+                oneway=True)
+        else:
+            message = marshall(request)
+        connection.send_oneway(message)
+        if self.metrics is not None:
+            self.metrics.increment('client_bytes_out', len(message))
+
+    def request_async(self, request, dest_handler=None):
+        """ Send a request without waiting for its reply.
+
+        With pipelining transports (see "pipelining" qos) any number of
+        requests can be in flight from one thread. Pooled clients keep a
+        connection per request in flight, the rest of transports send
+        the request before returning.
+
+        Returns:
+            futures.Future() giving the value returned by the handler (or
+            raising its exception).
+        """
+        if not self.client_enabled:
+            raise EndpointNotConnected()
+        request = self.__message__(request, dest_handler)
+        future = futures.Future()
+        future.set_running_or_notify_cancel()
+        started = self.__started__()
+        connections = self.__pool
+        connection = (self.transport if connections is None
+                      else connections.acquire())
+        def replied(reply, error):
+            if connections is not None:
+                connections.release(connection, broken=error is not None)
+            self.__finished__(request['dest'], started, reply,
+                              failed=error is not None)
+            if error is None:
+                try:
+                    reply = self.__result__(reply)
+                except Exception, e:
+                    error = e
+            if error is None:
+                future.set_result(reply)
+            else:
+                future.set_exception(error)
+        try:
+            self.__submit__(connection, request, replied)
+        except Exception, e:
+            replied(None, e)
+        return future
+
 
 class Full(Server, Client):
     """ This is a POT endpoint.
@@ -306,3 +1190,4 @@ class Full(Server, Client):
     
     def __init__(self, qos={}):
         Server.__init__(self, qos)
+        self.__client_setup__(qos)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Python Object Transfer: binary message envelope
+#
+
+import zlib
+import struct
+
+from protocols import Segments
+
+# Header: magic, message type, flags and handler handle. Magic is not a
+# valid start of pickle, marshal or out of band messages, so messages
+# using the dict envelope are still understood.
+MAGIC = '\xfdPOT'
+_HEADER = struct.Struct('=4sBBQ')
+_NAME_SIZE = struct.Struct('=H')
+
+# Message types
+REQUEST = 1
+REPLY = 2
+
+# Request flags: sender is anonymous, destination is given by name (the
+# handler id follows the header) instead of by handle
+FLAG_ANONYMOUS = 0x01
+FLAG_NAMED = 0x02
+# Request flag: sender does not wait for any reply (one-way request)
+FLAG_ONEWAY = 0x10
+# Reply flags: payload is the exception raised by the handler, or handle
+# was refused (not assigned by this server)
+FLAG_EXCEPTION = 0x04
+FLAG_STALE = 0x08
+
+# Handle of the default handler of a server
+DEFAULT_HANDLE = 0
+# Envelope names of the "envelope" qos
+ENVELOPES = ('dict', 'binary')
+
+
+class UnknownEnvelope(Exception):
+    def __init__(self, name):
+        self.__name = name
+    def __str__(self):
+        return 'Unknown envelope: "%s"' % self.__name
+
+
+class InvalidEnvelope(Exception):
+    def __init__(self, cause='unknown'):
+        self.__cause = cause
+    def __str__(self):
+        return 'Invalid binary envelope (%s)' % self.__cause
+
+
+def make_handle(index, handler_id):
+    """ Handle of the handler registered in given index.
+
+    Lower 32 bits are the index, upper ones a checksum of the handler id,
+    so handles given by other servers are refused instead of routed to
+    a wrong handler.
+    """
+    return ((zlib.crc32(handler_id) & 0xffffffff) << 32) | index
+
+
+def handle_index(handle):
+    return handle & 0xffffffff
+
+
+def is_envelope(message):
+    """ True if message (as received) uses the binary envelope. """
+    segments = getattr(message, 'segments', None)
+    if segments is not None:
+        message = segments[0]
+    elif not isinstance(message, (str, bytearray, buffer)):
+        # Not serialized at all (see protocols.Passthrough)
+        return False
+    return message[:len(MAGIC)] == MAGIC
+
+
+def pack(kind, flags, handle, payload, name=None):
+    """ Message with given header and marshalled payload.
+
+    Args:
+        kind: REQUEST or REPLY.
+        flags: FLAG_* values.
+        handle: handler handle.
+        payload: marshalled request or reply.
+        name: handler id, only for FLAG_NAMED requests.
+
+    Returns:
+        Segments() instance, payload is not copied.
+    """
+    header = _HEADER.pack(MAGIC, kind, flags, handle)
+    if flags & FLAG_NAMED:
+        header += _NAME_SIZE.pack(len(name)) + name
+    return Segments([header] + list(getattr(payload, 'segments',
+                                            (payload,))))
+
+
+def unpack(message):
+    """ Split a message in its header and payload.
+
+    Returns:
+        (kind, flags, handle, name, payload) tuple, name is None unless
+        FLAG_NAMED is set and payload is a buffer over the message.
+
+    Raises:
+        InvalidEnvelope: message is not a valid envelope.
+    """
+    segments = getattr(message, 'segments', None)
+    header = message if segments is None else segments[0]
+    try:
+        magic, kind, flags, handle = _HEADER.unpack_from(header)
+        offset = _HEADER.size
+        name = None
+        if flags & FLAG_NAMED:
+            size = _NAME_SIZE.unpack_from(header, offset)[0]
+            offset += _NAME_SIZE.size
+            name = str(buffer(header, offset, size))
+            offset += size
+    except struct.error, e:
+        raise InvalidEnvelope(str(e))
+    if magic != MAGIC:
+        raise InvalidEnvelope('bad magic')
+    if segments is None:
+        return kind, flags, handle, name, buffer(message, offset)
+    # Not transmitted (in-process transport): payload segments as given
+    payload = segments[1:]
+    return kind, flags, handle, name, (payload[0] if len(payload) == 1
+                                       else Segments(payload))
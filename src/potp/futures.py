@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Python Object Transfer: results of requests in flight
+#
+
+import threading
+import logging
+logger = logging.getLogger(__name__)
+_DEB = logger.debug
+
+try:
+    from concurrent.futures import Future, TimeoutError, wait
+except ImportError:
+    Future = None
+
+
+if Future is None:
+    # Same interface than concurrent.futures ("futures" package)
+    class TimeoutError(Exception):
+        def __str__(self):
+            return 'Result not available before timeout'
+
+
+    class Future(object):
+        """ Result of a request being sent, available once replied. """
+        def __init__(self):
+            self.__done = threading.Condition()
+            self.__state = 'pending'
+            self.__result = None
+            self.__exception = None
+            self.__callbacks = []
+
+        def cancel(self):
+            with self.__done:
+                if self.__state != 'pending':
+                    return self.__state == 'cancelled'
+                self.__state = 'cancelled'
+                self.__done.notify_all()
+            self.__run_callbacks__()
+            return True
+
+        def cancelled(self):
+            return self.__state == 'cancelled'
+
+        def running(self):
+            return self.__state == 'running'
+
+        def done(self):
+            return self.__state in ('cancelled', 'finished')
+
+        def __wait__(self, timeout):
+            with self.__done:
+                if not self.done():
+                    self.__done.wait(timeout)
+                if self.__state == 'cancelled':
+                    raise CancelledError()
+                if self.__state != 'finished':
+                    raise TimeoutError()
+
+        def result(self, timeout=None):
+            self.__wait__(timeout)
+            if self.__exception is not None:
+                raise self.__exception
+            return self.__result
+
+        def exception(self, timeout=None):
+            self.__wait__(timeout)
+            return self.__exception
+
+        def add_done_callback(self, callback):
+            with self.__done:
+                if not self.done():
+                    self.__callbacks.append(callback)
+                    return
+            callback(self)
+
+        def set_running_or_notify_cancel(self):
+            with self.__done:
+                if self.__state == 'cancelled':
+                    return False
+                self.__state = 'running'
+                return True
+
+        def set_result(self, result):
+            self.__finish__(result, None)
+
+        def set_exception(self, exception):
+            self.__finish__(None, exception)
+
+        def __finish__(self, result, exception):
+            with self.__done:
+                self.__result = result
+                self.__exception = exception
+                self.__state = 'finished'
+                self.__done.notify_all()
+            self.__run_callbacks__()
+
+        def __run_callbacks__(self):
+            callbacks, self.__callbacks = self.__callbacks, []
+            for callback in callbacks:
+                try:
+                    callback(self)
+                except Exception, e:
+                    _DEB('Future callback failed: %s', e)
+
+
+    class CancelledError(Exception):
+        def __str__(self):
+            return 'Future was cancelled'
+
+
+    def wait(futures, timeout=None):
+        """ Wait until every future is done.
+
+        Returns:
+            (done, not_done) tuple of sets.
+        """
+        futures = set(futures)
+        finished = threading.Event()
+        pending = [len(futures)]
+        lock = threading.Lock()
+        def count(future):
+            with lock:
+                pending[0] -= 1
+                if pending[0] == 0:
+                    finished.set()
+        for future in futures:
+            future.add_done_callback(count)
+        if futures:
+            finished.wait(timeout)
+        done = set(future for future in futures if future.done())
+        return done, futures - done
+else:
+    from concurrent.futures import CancelledError
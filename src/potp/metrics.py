@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+# Python Object Transfer: metrics
+#
+
+import json
+import bisect
+import threading
+
+
+# Histogram upper bounds: seconds for latencies, bytes for sizes
+LATENCY_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                  0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BOUNDS = tuple(64 * 4 ** exponent for exponent in range(11))
+
+
+def __key__(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (label, labels[label])
+                                      for label in sorted(labels)))
+
+
+class Histogram(object):
+    """ Distribution of observed values over fixed buckets. """
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = tuple(bounds)
+        # Last bucket counts values over every bound
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """ Upper bound of the bucket holding the given quantile. """
+        if not self.count:
+            return None
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'avg': float(self.sum) / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': zip(self.bounds + (None,), self.buckets)
+            }
+
+
+class Metrics(object):
+    """ Counters, gauges and histograms of endpoints and transports.
+
+    Collection is enabled by giving an instance as "metrics" qos, the same
+    instance can be shared by several endpoints. Without it no metric is
+    computed at all.
+
+    Collected metrics:
+        server_requests, server_errors, server_rejected,
+        server_latency_seconds, server_bytes_in, server_bytes_out,
+        server_in_flight,
+        client_requests, client_errors, client_latency_seconds,
+        client_bytes_in, client_bytes_out, client_in_flight,
+        transport_frames, transport_bytes, transport_frame_bytes.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__gauges = {}
+        self.__histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = __key__(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def gauge(self, name, delta, **labels):
+        """ Add delta (may be negative) to a gauge. """
+        key = __key__(name, labels)
+        with self.__lock:
+            self.__gauges[key] = self.__gauges.get(key, 0) + delta
+
+    def observe(self, name, value, bounds=None, **labels):
+        """ Add a value to a histogram, "*_bytes" histograms use
+        SIZE_BOUNDS and other ones LATENCY_BOUNDS unless bounds given. """
+        key = __key__(name, labels)
+        with self.__lock:
+            histogram = self.__histograms.get(key, None)
+            if histogram is None:
+                if bounds is None:
+                    bounds = (SIZE_BOUNDS if name.endswith('_bytes')
+                              else LATENCY_BOUNDS)
+                histogram = self.__histograms[key] = Histogram(bounds)
+            histogram.observe(value)
+
+    def reset(self):
+        with self.__lock:
+            self.__counters = {}
+            self.__gauges = {}
+            self.__histograms = {}
+
+    def snapshot(self):
+        """ Copy of every metric as a dict of dicts. """
+        with self.__lock:
+            return {
+                'counters': dict(self.__counters),
+                'gauges': dict(self.__gauges),
+                'histograms': dict((key, histogram.snapshot())
+                                   for key, histogram
+                                   in self.__histograms.items())
+                }
+
+    def export(self, format='text'):
+        """ Export a snapshot.
+
+        Args:
+            format: "json" or "text" (Prometheus exposition format).
+
+        Returns:
+            string with every metric.
+        """
+        snapshot = self.snapshot()
+        if format == 'json':
+            return json.dumps(snapshot, sort_keys=True)
+        lines = []
+        for kind in ('counters', 'gauges'):
+            for key in sorted(snapshot[kind]):
+                lines.append('%s %s' % (key, snapshot[kind][key]))
+        for key in sorted(snapshot['histograms']):
+            histogram = snapshot['histograms'][key]
+            name, labels = (key.split('{', 1) + [''])[:2]
+            labels = labels.rstrip('}')
+            cumulative = 0
+            for bound, count in histogram['buckets']:
+                cumulative += count
+                bucket_labels = ','.join(
+                    [labels] * bool(labels) +
+                    ['le="%s"' % ('+Inf' if bound is None else bound)])
+                lines.append('%s_bucket{%s} %s' % (name, bucket_labels,
+                                                   cumulative))
+            suffix = '{%s}' % labels if labels else ''
+            lines.append('%s_sum%s %s' % (name, suffix, histogram['sum']))
+            lines.append('%s_count%s %s' % (name, suffix, histogram['count']))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+#
+# Python Object Transfer: client connection pools
+#
+
+import time
+import threading
+import contextlib
+import logging
+logger = logging.getLogger(__name__)
+_DEB = logger.debug
+
+import transport
+
+
+#
+# Common errors
+#
+
+class PoolExhausted(Exception):
+    def __init__(self, sap):
+        self.__sap = sap
+    def __str__(self):
+        return 'No connection to [%s] available in pool' % self.__sap
+
+
+class PoolOptionsMismatch(Exception):
+    def __init__(self, sap):
+        self.__sap = sap
+    def __str__(self):
+        return 'Pool of [%s] already created with other options' % self.__sap
+
+
+class PoolClosed(Exception):
+    def __init__(self, sap):
+        self.__sap = sap
+    def __str__(self):
+        return 'Pool of [%s] is closed' % self.__sap
+
+
+#
+# Registry: one pool per remote SAP and connection settings
+#
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(remote_sap, factory=None, settings=None, **options):
+    """ Get the pool of a remote SAP, creating it if needed.
+
+    Args:
+        remote_sap: SAP of the remote server.
+        factory: callable returning new (disconnected) transports.
+        settings: hashable description of the transports made by factory
+            (see transport.connection_settings()): callers with other
+            settings get other pools.
+        options: ConnectionPool() options.
+
+    Returns:
+        ConnectionPool() instance shared by every caller of same SAP and
+        settings.
+
+    Raises:
+        PoolOptionsMismatch: pool exists with other ConnectionPool()
+            options.
+    """
+    key = (str(remote_sap), settings)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key, None)
+        if pool is None or pool.closed:
+            pool = ConnectionPool(remote_sap, factory, **options)
+            _POOLS[key] = pool
+        elif pool.options != dict(pool.options, **options):
+            raise PoolOptionsMismatch(remote_sap)
+        return pool
+
+
+def close_pools():
+    """ Close every registered pool. """
+    with _POOLS_LOCK:
+        pools = _POOLS.values()
+        _POOLS.clear()
+    for pool in pools:
+        pool.close()
+
+
+class ConnectionPool(object):
+    """ Set of connected transports to the same remote SAP.
+
+    Connections are created on demand up to max_size, idle connections
+    over min_size are closed after idle_timeout seconds and every
+    connection is checked before being handed out.
+    """
+    def __init__(self, remote_sap, factory=None, min_size=0, max_size=8,
+                 idle_timeout=60.0, checkout_timeout=None):
+        self.__sap = remote_sap
+        self.__factory = transport.TCPTransport if factory is None else factory
+        self.__options = {
+            'min_size': min_size,
+            'max_size': max_size,
+            'idle_timeout': idle_timeout,
+            'checkout_timeout': checkout_timeout
+            }
+        self.__min_size = min_size
+        self.__max_size = max(max_size, min_size, 1)
+        self.__idle_timeout = idle_timeout
+        self.__checkout_timeout = checkout_timeout
+        self.__available = threading.Condition(threading.Lock())
+        # Idle connections as (transport, released_at), newest last
+        self.__idle = []
+        self.__size = 0
+        self.__closed = False
+        self.__stats = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'health_failures': 0,
+            'evicted': 0
+            }
+        for connection in range(self.__min_size):
+            with self.__available:
+                self.__size += 1
+            self.__idle.append((self.__open__(), time.time()))
+
+    @property
+    def sap(self):
+        return self.__sap
+
+    @property
+    def options(self):
+        """ ConnectionPool() options the pool was created with. """
+        return dict(self.__options)
+
+    @property
+    def closed(self):
+        return self.__closed
+
+    @property
+    def stats(self):
+        with self.__available:
+            stats = dict(self.__stats)
+            stats.update({
+                'size': self.__size,
+                'idle': len(self.__idle),
+                'in_use': self.__size - len(self.__idle)
+                })
+        return stats
+
+    def __open__(self):
+        connection = self.__factory()
+        try:
+            connection.connect(self.__sap)
+        except:
+            with self.__available:
+                self.__size -= 1
+                self.__available.notify()
+            raise
+        _DEB('Pool [%s] opens a new connection', self.__sap)
+        with self.__available:
+            self.__stats['created'] += 1
+        return connection
+
+    def __discard__(self, connection):
+        try:
+            connection.disconnect()
+        except Exception, e:
+            _DEB('Error closing pooled connection: %s', e)
+        with self.__available:
+            self.__stats['closed'] += 1
+
+    def __evict__(self):
+        """ Remove expired idle connections, lock must be held. """
+        if self.__idle_timeout is None:
+            return []
+        deadline = time.time() - self.__idle_timeout
+        evicted = []
+        while (self.__idle and self.__size > self.__min_size and
+               self.__idle[0][1] < deadline):
+            evicted.append(self.__idle.pop(0)[0])
+            self.__size -= 1
+            self.__stats['evicted'] += 1
+        return evicted
+
+    def acquire(self, timeout=None):
+        """ Checkout a connected transport.
+
+        Args:
+            timeout: seconds to wait for a free connection, pool
+                checkout_timeout is used if not given.
+
+        Returns:
+            connected transport, it must be given back with release().
+
+        Raises:
+            PoolExhausted: no connection released before timeout.
+            PoolClosed: pool was closed.
+        """
+        timeout = self.__checkout_timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            connection = None
+            with self.__available:
+                if self.__closed:
+                    raise PoolClosed(self.__sap)
+                evicted = self.__evict__()
+                if self.__idle:
+                    connection = self.__idle.pop()[0]
+                elif self.__size < self.__max_size:
+                    self.__size += 1
+                else:
+                    self.__stats['waits'] += 1
+                    remaining = (None if deadline is None
+                                 else deadline - time.time())
+                    if remaining is not None and remaining <= 0:
+                        raise PoolExhausted(self.__sap)
+                    self.__available.wait(remaining)
+                    continue
+                self.__stats['checkouts'] += 1
+            for expired in evicted:
+                self.__discard__(expired)
+            if connection is None:
+                return self.__open__()
+            if connection.healthy:
+                return connection
+            _DEB('Pooled connection to [%s] is broken', self.__sap)
+            with self.__available:
+                self.__stats['health_failures'] += 1
+                self.__size -= 1
+                self.__available.notify()
+            self.__discard__(connection)
+
+    def release(self, connection, broken=False):
+        """ Give back a connection obtained with acquire().
+
+        Args:
+            connection: transport to give back.
+            broken: if True connection is closed instead of reused.
+        """
+        with self.__available:
+            if not (broken or self.__closed):
+                self.__idle.append((connection, time.time()))
+                self.__available.notify()
+                return
+            self.__size -= 1
+            self.__available.notify()
+        self.__discard__(connection)
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """ Borrow a connection for the duration of a "with" block. """
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        except:
+            # Stream state is unknown after a failed exchange
+            self.release(connection, broken=True)
+            raise
+        else:
+            self.release(connection)
+
+    def close(self):
+        """ Close idle connections, busy ones are closed on release. """
+        with self.__available:
+            self.__closed = True
+            idle = [connection for connection, since in self.__idle]
+            self.__size -= len(idle)
+            self.__idle = []
+            self.__available.notify_all()
+        for connection in idle:
+            self.__discard__(connection)
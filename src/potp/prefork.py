@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+#
+# Python Object Transfer: pre-forked servers
+#
+
+import os
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import threading
+import logging
+logger = logging.getLogger(__name__)
+_DEB = logger.debug
+_INF = logger.info
+
+import transport
+import endpoint
+
+# Seconds a stats query waits for the answers of every worker
+_STATS_TIMEOUT = 5.0
+
+
+#
+# Common errors
+#
+
+class PreforkError(Exception):
+    def __init__(self, cause='unknown'):
+        self.__cause = cause
+    def __str__(self):
+        return 'Prefork server error: %s' % self.__cause
+
+
+def __server_stats__(server):
+    """ Stats of a server running in a worker process. """
+    stats = {'pid': os.getpid(), 'in_flight': server.in_flight}
+    for name, value in (('dispatch', server.dispatch_stats),
+                        ('processes', server.process_stats),
+                        ('compression', getattr(server.transport,
+                                                'compression_stats', None))):
+        if value is not None:
+            stats[name] = value
+    return stats
+
+
+def __read_answers__(channels, query, timeout, partial):
+    """ Read the answers of workers to a stats query.
+
+    Answers are "<query> <json stats>" lines. Lines of older queries (sent
+    after their query timed out) are dropped.
+
+    Args:
+        channels: pid -> worker channel.
+        query: number of the query.
+        timeout: seconds to wait for every answer.
+        partial: pid -> incomplete line, kept between queries.
+
+    Returns:
+        pid -> stats of the workers answering before the timeout.
+    """
+    answers = {}
+    waiting = dict((channel, pid) for pid, channel in channels.items())
+    deadline = time.time() + timeout
+    while waiting:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            readable = select.select(waiting.keys(), [], [], remaining)[0]
+        except (select.error, socket.error), e:
+            _DEB('Cannot wait for stats: %s', e)
+            break
+        for channel in readable:
+            pid = waiting[channel]
+            try:
+                data = channel.recv(4096)
+            except socket.error, e:
+                # Timeout sockets may wake up with nothing to read
+                if e.args[0] != errno.EAGAIN:
+                    _DEB('No stats from worker %d: %s', pid, e)
+                    del waiting[channel]
+                continue
+            if not data:
+                _DEB('Stats channel of worker %d closed', pid)
+                del waiting[channel]
+                continue
+            lines = (partial.pop(pid, '') + data).split('\n')
+            if lines[-1]:
+                partial[pid] = lines[-1]
+            for line in lines[:-1]:
+                number, answer = (line.split(' ', 1) + [''])[:2]
+                if number != str(query):
+                    _DEB('Late stats answer of worker %d dropped', pid)
+                    continue
+                try:
+                    answers[pid] = json.loads(answer)
+                except ValueError, e:
+                    _DEB('Invalid stats from worker %d: %s', pid, e)
+                waiting.pop(channel, None)
+    return answers
+
+
+def __merge_stats__(all_stats):
+    """ Combine stats of several workers: counters are added, maximums
+    and averages are kept as such. """
+    merged = {}
+    for stats in all_stats:
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                merged.setdefault(key, []).append(value)
+            elif isinstance(value, (int, long, float)):
+                merged.setdefault(key, []).append(value)
+    for key, values in merged.items():
+        if isinstance(values[0], dict):
+            merged[key] = __merge_stats__(values)
+        elif key.startswith('max_'):
+            merged[key] = max(values)
+        elif key.startswith('avg_') or key.endswith('_ratio'):
+            merged[key] = float(sum(values)) / len(values)
+        else:
+            merged[key] = sum(values)
+    return merged
+
+
+class PreforkServer(object):
+    """ Serve one TCP SAP from several worker processes.
+
+    Each worker creates its own server, calls setup(server) to register the
+    handlers and listens to the same port with SO_REUSEPORT, so the kernel
+    balances connections among them. Dead workers are restarted.
+    """
+    def __init__(self, setup, sap=None, qos={}, workers=None,
+                 server_class=endpoint.Server, check_interval=0.5):
+        self.__setup = setup
+        self.__sap = transport.TCPSAP() if sap is None else sap
+        if not isinstance(self.__sap, transport.TCPSAP):
+            raise PreforkError('only TCP SAPs can be shared')
+        self.__qos = dict(qos)
+        self.__qos['reuse_port'] = True
+        self.__workers = workers or os.sysconf('SC_NPROCESSORS_ONLN')
+        self.__server_class = server_class
+        self.__check_interval = check_interval
+        # Worker slot -> (pid, stats socket)
+        self.__children = {}
+        self.__lock = threading.Lock()
+        # Stats queries: one at a time, numbered to drop late answers
+        self.__stats_lock = threading.Lock()
+        self.__queries = 0
+        self.__partial = {}
+        self.__stopping = threading.Event()
+        self.__supervisor = None
+        self.__restarts = 0
+
+    @property
+    def sap(self):
+        return self.__sap
+
+    @property
+    def uri(self):
+        return 'potp://%s' % self.__sap
+
+    @property
+    def workers(self):
+        return self.__workers
+
+    @property
+    def pids(self):
+        with self.__lock:
+            return [pid for pid, channel in self.__children.values()]
+
+    @property
+    def running(self):
+        return self.__supervisor is not None
+
+    def __spawn__(self, slot):
+        parent_channel, child_channel = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            # Worker process: never returns
+            parent_channel.close()
+            status = 0
+            try:
+                self.__work__(child_channel)
+            except:
+                logger.exception('Worker %d failed' % slot)
+                status = 1
+            finally:
+                os._exit(status)
+        child_channel.close()
+        # A hung worker must not block stats queries
+        parent_channel.settimeout(_STATS_TIMEOUT)
+        _DEB('Worker %d started with pid %d', slot, pid)
+        self.__children[slot] = (pid, parent_channel)
+
+    def __work__(self, channel):
+        for other_pid, other_channel in self.__children.values():
+            other_channel.close()
+        server = self.__server_class(self.__qos)
+        self.__setup(server)
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: server.stop_serving())
+        reporter = threading.Thread(target=self.__report__,
+                                    args=(server, channel))
+        reporter.daemon = True
+        reporter.start()
+        server.serve_forever(self.__sap)
+
+    def __report__(self, server, channel):
+        """ Answer stats queries of the parent process, stop serving when
+        the parent closes the channel (or dies). """
+        requests = channel.makefile('r')
+        try:
+            for line in iter(requests.readline, ''):
+                query = line.split()[-1]
+                channel.sendall('%s %s\n' % (
+                    query, json.dumps(__server_stats__(server))))
+        except EnvironmentError, e:
+            _DEB('Stats channel closed: %s', e)
+        finally:
+            # Orphaned workers would keep the shared port open
+            _DEB('Parent process gone, worker %d stops', os.getpid())
+            server.stop_serving()
+
+    def __supervise__(self):
+        while not self.__stopping.wait(self.__check_interval):
+            with self.__lock:
+                for slot, (pid, channel) in self.__children.items():
+                    try:
+                        finished, status = os.waitpid(pid, os.WNOHANG)
+                    except OSError, e:
+                        if e.args[0] != errno.ECHILD:
+                            raise
+                        finished = pid
+                    if not finished or self.__stopping.is_set():
+                        continue
+                    _INF('Worker %d (pid %d) died, restarting', slot, pid)
+                    channel.close()
+                    self.__partial.pop(pid, None)
+                    self.__restarts += 1
+                    self.__spawn__(slot)
+
+    def start(self):
+        """ Fork workers and supervise them from a background thread. """
+        if self.running:
+            return
+        self.__stopping.clear()
+        with self.__lock:
+            for slot in range(self.__workers):
+                self.__spawn__(slot)
+        self.__supervisor = threading.Thread(target=self.__supervise__)
+        self.__supervisor.daemon = True
+        self.__supervisor.start()
+
+    def wait_ready(self, timeout=None):
+        """ Block until the SAP accepts connections.
+
+        Returns:
+            True if some worker is listening, False if timeout expired.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        address = ('127.0.0.1' if self.__sap.address == '0.0.0.0'
+                   else self.__sap.address)
+        while deadline is None or time.time() < deadline:
+            probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                probe.connect((address, self.__sap.port))
+                return True
+            except socket.error:
+                time.sleep(0.05)
+            finally:
+                probe.close()
+        return False
+
+    def serve_forever(self):
+        """ Run workers until stop() is called or SIGTERM is received. """
+        self.start()
+        if threading.current_thread().name == 'MainThread':
+            signal.signal(signal.SIGTERM,
+                          lambda signum, frame: self.__stopping.set())
+        while not self.__stopping.wait(3600.0):
+            pass
+        self.stop()
+
+    def stop(self, timeout=None):
+        """ Stop workers: they drain in-flight requests before exiting.
+
+        Args:
+            timeout: seconds to wait for each worker before killing it,
+                shutdown_timeout qos plus one second if not given.
+        """
+        if timeout is None:
+            timeout = self.__qos.get('shutdown_timeout',
+                                     endpoint._SHUTDOWN_TIMEOUT) + 1.0
+        self.__stopping.set()
+        supervisor, self.__supervisor = self.__supervisor, None
+        if supervisor is not None and \
+           supervisor is not threading.current_thread():
+            supervisor.join()
+        with self.__lock:
+            children, self.__children = self.__children, {}
+        for pid, channel in children.values():
+            channel.close()
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + timeout
+        for pid, channel in children.values():
+            while True:
+                try:
+                    finished, status = os.waitpid(pid, os.WNOHANG)
+                except OSError:
+                    break
+                if finished:
+                    break
+                if time.time() > deadline:
+                    logger.warning('Worker %d killed' % pid)
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                    break
+                time.sleep(0.05)
+
+    @property
+    def stats(self):
+        """ Stats of every worker combined, plus the per-worker ones. """
+        with self.__lock:
+            restarts = self.__restarts
+            channels = dict(self.__children.values())
+        # Workers are queried at once, all of them within _STATS_TIMEOUT
+        with self.__stats_lock:
+            self.__queries += 1
+            for pid, channel in channels.items():
+                try:
+                    channel.sendall('stats %d\n' % self.__queries)
+                except socket.error, e:
+                    _DEB('No stats from worker %d: %s', pid, e)
+                    del channels[pid]
+            answers = __read_answers__(channels, self.__queries,
+                                       _STATS_TIMEOUT, self.__partial)
+        workers = [answers[pid] for pid in sorted(answers)]
+        stats = __merge_stats__([dict((key, value)
+                                      for key, value in worker.items()
+                                      if key != 'pid')
+                                 for worker in workers])
+        stats.update({'workers': len(workers),
+                      'restarts': restarts,
+                      'per_worker': workers})
+        return stats
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
+import struct
+import marshal
 import pickle
+import cPickle
+import cStringIO
 
 # Python Object Transfer: protocols
 
@@ -8,7 +12,19 @@ import pickle
 # Factory
 #
 def get_protocol(qos={}):
-    return PIP()
+    if qos.get('transport', None) == 'inproc' and not qos.get('serialize',
+                                                              True):
+        return Passthrough()
+    name = qos.get('protocol', 'pip')
+    if name not in _PROTOCOLS:
+        raise UnknownProtocol(name)
+    return _PROTOCOLS[name]()
+
+
+def available_protocols():
+    """ Names of the protocols selectable with the "protocol" qos. """
+    return sorted(_PROTOCOLS.keys())
+
 
 class NotSerializable(Exception):
     def __init__(self, bad_object):
@@ -20,6 +36,33 @@ class NotSerializable(Exception):
 class NotInstantiable(Exception):
     def __str__(self):
         return 'Data not instantiable.'
+
+
+class UnknownProtocol(Exception):
+    def __init__(self, name):
+        self.__name = name
+    def __str__(self):
+        return 'Unknown protocol: "%s"' % self.__name
+
+
+class Segments(object):
+    """ Marshalled message made of several buffers.
+
+    Transports send the segments back to back, without joining them, and
+    the receiver gets them as a single buffer. len() is the whole size.
+    """
+    def __init__(self, segments):
+        self.segments = segments
+        self.__size = sum(len(segment) for segment in segments)
+
+    def __len__(self):
+        return self.__size
+
+    def __str__(self):
+        joined = bytearray()
+        for segment in self.segments:
+            joined += segment
+        return str(joined)
     
 
 class Protocol(object):
@@ -52,7 +95,9 @@ class Protocol(object):
         from a string, readed from some stream.
 
         Args:
-            object_representation: string used in the object instance.
+            object_representation: string (or any buffer object, like
+                the bytearrays received by transports) used in the
+                object instance.
 
         Returns:
             instantiated object.
@@ -61,6 +106,37 @@ class Protocol(object):
             NotInstantiable: string cannot be decoded as an object.
         """
         raise NotImplementedError()
+
+    @classmethod
+    def dump(cls, serializable_object, stream):
+        """ Writes the object representation to a file-like object.
+
+        Protocols able to produce the representation in pieces write
+        it while it is created, so it is never held in memory.
+
+        Args:
+            serializable_object: object to convert.
+            stream: object with a write() method.
+
+        Raises:
+            NotSerializable: some objects cannot be converted to a string.
+        """
+        stream.write(cls.marshall(serializable_object))
+
+    @classmethod
+    def load(cls, stream):
+        """ Return the object instance readed from a file-like object.
+
+        Args:
+            stream: object with read() and readline() methods.
+
+        Returns:
+            instantiated object.
+
+        Raises:
+            NotInstantiable: stream cannot be decoded as an object.
+        """
+        return cls.unmarshall(stream.read())
     
 
 class PIP(Protocol):
@@ -72,6 +148,184 @@ class PIP(Protocol):
     @staticmethod
     def unmarshall(object_representation):
         try:
-            return pickle.loads(object_representation)
+            if isinstance(object_representation, str):
+                return pickle.loads(object_representation)
+            # Buffers (bytearray, memoryview...) are read in place
+            return cPickle.load(cStringIO.StringIO(object_representation))
         except EOFError:
             raise NotInstantiable()
+
+    @staticmethod
+    def dump(serializable_object, stream):
+        cPickle.Pickler(stream, cPickle.HIGHEST_PROTOCOL).dump(
+            serializable_object)
+
+    @staticmethod
+    def load(stream):
+        try:
+            return cPickle.Unpickler(stream).load()
+        except EOFError:
+            raise NotInstantiable()
+
+
+# Buffers of this size or bigger are kept out of the pickle stream
+_OOB_THRESHOLD = 4096
+# Out of band kinds, persistent IDs are (segment index * 4 + kind)
+_OOB_KINDS = (str, bytearray, buffer, memoryview)
+_OOB_COUNT = struct.Struct('=I')
+_OOB_SIZE = struct.Struct('=Q')
+
+
+class OutOfBandPIP(PIP):
+    """ Pickle keeping big buffers out of band.
+
+    Strings and bytearrays of _OOB_THRESHOLD bytes or more, buffers and
+    memoryviews are not copied into the pickle stream: they are extra
+    segments of the message, written by the transport straight from the
+    original objects. Messages are a table of segment sizes, the pickle
+    stream and the out of band segments.
+
+    Received buffers and memoryviews are read-only buffers over the
+    received frame (no copy at all), strings and bytearrays are copied
+    once out of the frame. In-process transports give the original
+    objects.
+    """
+    @staticmethod
+    def marshall(serializable_object):
+        segments = []
+        def persistent_id(member):
+            kind = type(member)
+            if kind in _OOB_KINDS and (kind in (buffer, memoryview) or
+                                       len(member) >= _OOB_THRESHOLD):
+                segments.append(member)
+                return (len(segments) - 1) * 4 + _OOB_KINDS.index(kind)
+            return None
+        stream = cStringIO.StringIO()
+        pickler = cPickle.Pickler(stream, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        try:
+            pickler.dump(serializable_object)
+        except (cPickle.PicklingError, TypeError):
+            raise NotSerializable(serializable_object)
+        segments.insert(0, stream.getvalue())
+        table = bytearray(_OOB_COUNT.pack(len(segments)))
+        for segment in segments:
+            table += _OOB_SIZE.pack(len(segment))
+        return Segments([table] + segments)
+
+    @staticmethod
+    def unmarshall(object_representation):
+        try:
+            if isinstance(object_representation, Segments):
+                # Not transmitted (in-process transport)
+                segments = object_representation.segments[1:]
+            else:
+                segments = []
+                count = _OOB_COUNT.unpack_from(object_representation)[0]
+                offset = _OOB_COUNT.size + count * _OOB_SIZE.size
+                for index in range(count):
+                    size = _OOB_SIZE.unpack_from(
+                        object_representation,
+                        _OOB_COUNT.size + index * _OOB_SIZE.size)[0]
+                    segments.append(buffer(object_representation, offset,
+                                           size))
+                    offset += size
+            def persistent_load(persistent_id):
+                segment = segments[persistent_id // 4 + 1]
+                kind = _OOB_KINDS[persistent_id % 4]
+                if kind in (buffer, memoryview):
+                    return segment
+                return segment if type(segment) is kind else kind(segment)
+            unpickler = cPickle.Unpickler(cStringIO.StringIO(segments[0]))
+            unpickler.persistent_load = persistent_load
+            return unpickler.load()
+        except (EOFError, struct.error, IndexError):
+            raise NotInstantiable()
+
+
+# One byte tags of MarshalPIP messages, not used as pickle opcodes so
+# untagged (PIP) messages are still understood
+_MARSHAL_TAG = '\xfe'
+_PICKLE_TAG = '\xff'
+_MARSHAL_VERSION = 2
+_MARSHAL_SCALARS = frozenset([type(None), bool, int, long, float, complex,
+                              str, unicode])
+_MARSHAL_CONTAINERS = frozenset([tuple, list, set, frozenset, dict])
+
+
+def __marshallable__(member):
+    """ True if member (and its content) can go through marshal without
+    changing its type. """
+    kind = type(member)
+    if kind in _MARSHAL_SCALARS:
+        return True
+    if kind not in _MARSHAL_CONTAINERS:
+        return False
+    if kind is dict:
+        return (__marshallable__(member.keys()) and
+                __marshallable__(member.values()))
+    kinds = set(map(type, member))
+    if kinds <= _MARSHAL_SCALARS:
+        return True
+    if not kinds <= _MARSHAL_SCALARS | _MARSHAL_CONTAINERS:
+        return False
+    return all(__marshallable__(item) for item in member
+               if type(item) in _MARSHAL_CONTAINERS)
+
+
+class MarshalPIP(PIP):
+    """ Messages made only of primitive types (None, numbers, strings,
+    tuples, lists, sets and dicts) use "marshal", faster than pickle.
+
+    Other messages are pickled. A one byte tag tells which codec was used,
+    untagged messages are decoded as PIP ones.
+    """
+    @staticmethod
+    def marshall(serializable_object):
+        try:
+            if __marshallable__(serializable_object):
+                return _MARSHAL_TAG + marshal.dumps(serializable_object,
+                                                    _MARSHAL_VERSION)
+        except (RuntimeError, ValueError):
+            # Too deep for the check (or marshal)
+            pass
+        # Tag is sent as a segment of its own, pickle is never copied
+        return Segments([_PICKLE_TAG, cPickle.dumps(
+            serializable_object, cPickle.HIGHEST_PROTOCOL)])
+
+    @staticmethod
+    def unmarshall(object_representation):
+        if isinstance(object_representation, Segments):
+            # Not transmitted (in-process transport)
+            object_representation = str(object_representation)
+        tag = object_representation[:1]
+        try:
+            if tag == _MARSHAL_TAG:
+                return marshal.loads(buffer(object_representation, 1))
+            if tag == _PICKLE_TAG:
+                return cPickle.load(cStringIO.StringIO(
+                    buffer(object_representation, 1)))
+        except (EOFError, ValueError, TypeError):
+            raise NotInstantiable()
+        return PIP.unmarshall(object_representation)
+
+
+class Passthrough(Protocol):
+    """ No serialization at all: objects are given "as is".
+
+    Only usable with in-process transports, both endpoints share the
+    same objects so mutations are visible on the other side. """
+    @staticmethod
+    def marshall(serializable_object):
+        return serializable_object
+
+    @staticmethod
+    def unmarshall(object_representation):
+        return object_representation
+
+
+_PROTOCOLS = {
+    'pip': PIP,
+    'oob': OutOfBandPIP,
+    'marshal': MarshalPIP
+    }
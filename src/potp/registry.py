@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Python Object Transfer: request handler registry
+#
+
+import threading
+import weakref
+import collections
+import logging
+logger = logging.getLogger(__name__)
+_DEB = logger.debug
+
+import envelope
+
+
+def _reference(handler, callback):
+    """ Weak reference to a handler, returns a callable giving the handler
+    or None once it is dead.
+
+    Bound methods are created on every attribute access, so the reference
+    is kept to the object and the method is bound again when used.
+    """
+    owner = getattr(handler, 'im_self', None)
+    if owner is None:
+        return weakref.ref(handler, callback)
+    function = handler.im_func
+    owner = weakref.ref(owner, callback)
+    def bound():
+        instance = owner()
+        return None if instance is None else function.__get__(instance)
+    return bound
+
+
+class HandlerRegistry(object):
+    """ Request handlers of a server, by ID and by envelope handle.
+
+    Lookups take no lock and cost one dict access (by ID) or one list
+    access (by handle), so handlers can be registered and unregistered
+    while requests are being dispatched. Slots of unregistered handlers
+    are reused: handles embed a checksum of the ID, so old handles of a
+    reused slot are still refused.
+
+    Weak handlers do not keep their object alive: they are evicted once
+    it is collected (e.g. avatars nobody else references).
+
+    Args:
+        evicted: optional callable receiving the ID of every evicted
+            handler (called with the registry locked).
+    """
+    def __init__(self, evicted=None):
+        self.__evicted = evicted
+        self.__lock = threading.Lock()
+        # ID -> (handle, handler or weak reference, weak, cache key
+        # function or weak reference)
+        self.__entries = {}
+        # Handle index -> (handle, ID), None if free. First index is
+        # reserved (see envelope.DEFAULT_HANDLE).
+        self.__slots = [None]
+        self.__free = []
+        # IDs of dead weak handlers, evicted by next write: weakref
+        # callbacks may run inside any locked section
+        self.__dead = collections.deque()
+        self.__stats = {
+            'registered': 0,
+            'unregistered': 0,
+            'evicted': 0
+            }
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    @property
+    def stats(self):
+        """ Counters and occupancy: live handlers, weak ones and handle
+        slots (used and free). """
+        with self.__lock:
+            self.__evict__()
+            stats = dict(self.__stats)
+            stats['handlers'] = len(self.__entries)
+            stats['weak'] = sum(1 for entry in self.__entries.itervalues()
+                                if entry[2])
+            stats['slots'] = len(self.__slots) - 1
+            stats['free_slots'] = len(self.__free)
+        return stats
+
+    def register(self, id, handler, weak=False, cache_key=None):
+        """ Add a handler, replacing the one with the same ID if any.
+
+        Args:
+            id: handler ID.
+            handler: callable receiving requests.
+            weak: keep a weak reference to handler (or to its object if
+                it is a bound method).
+            cache_key: callable giving the result cache key of requests
+                (see Server.register_request_handler()), weak if handler
+                is weak.
+
+        Returns:
+            envelope handle of the handler.
+        """
+        if weak:
+            handler = _reference(handler,
+                                 lambda reference: self.__dead.append(id))
+            if cache_key is not None:
+                cache_key = _reference(cache_key, None)
+        with self.__lock:
+            self.__evict__()
+            self.__remove__(id)
+            index = self.__free.pop() if self.__free else len(self.__slots)
+            handle = envelope.make_handle(index, id)
+            if index == len(self.__slots):
+                self.__slots.append((handle, id))
+            else:
+                self.__slots[index] = (handle, id)
+            self.__entries[id] = (handle, handler, weak, cache_key)
+            self.__stats['registered'] += 1
+        return handle
+
+    def unregister(self, id):
+        """ Remove a handler, returns False if it was not registered. """
+        with self.__lock:
+            self.__evict__()
+            if self.__remove__(id):
+                self.__stats['unregistered'] += 1
+                return True
+        return False
+
+    def get(self, id):
+        """ Handler of an ID, None if not registered (or dead). """
+        entry = self.__entries.get(id, None)
+        if entry is None:
+            return None
+        return entry[1]() if entry[2] else entry[1]
+
+    def cache_key_of(self, id):
+        """ Cache key function of an ID, None if it has no one. """
+        entry = self.__entries.get(id, None)
+        if entry is None or entry[3] is None:
+            return None
+        return entry[3]() if entry[2] else entry[3]
+
+    def handle_of(self, id):
+        """ Envelope handle of an ID, None if not registered. """
+        entry = self.__entries.get(id, None)
+        return None if entry is None else entry[0]
+
+    def resolve(self, handle):
+        """ Handler of an envelope handle.
+
+        Returns:
+            (ID, handler) tuple, None if handle is unknown or stale.
+        """
+        index = envelope.handle_index(handle)
+        slot = self.__slots[index] if index < len(self.__slots) else None
+        if slot is None or slot[0] != handle:
+            return None
+        handler = self.get(slot[1])
+        return None if handler is None else (slot[1], handler)
+
+    def __remove__(self, id):
+        entry = self.__entries.pop(id, None)
+        if entry is None:
+            return False
+        index = envelope.handle_index(entry[0])
+        self.__slots[index] = None
+        self.__free.append(index)
+        return True
+
+    def __evict__(self):
+        while self.__dead:
+            id = self.__dead.popleft()
+            entry = self.__entries.get(id, None)
+            # Same ID may have been registered again with a live handler
+            if entry is not None and entry[2] and entry[1]() is None:
+                _DEB('Evict dead handler: %s', id)
+                self.__remove__(id)
+                self.__stats['evicted'] += 1
+                if self.__evicted is not None:
+                    self.__evicted(id)
@@ -3,12 +3,31 @@
 # Python Object Transfer: transport
 #
 
+import os
+import uuid
+import tempfile
+import mmap
+import errno
+import ctypes
+import fcntl
+import collections
+import cStringIO
+import zlib
+import bz2
+try:
+    import lzma
+except ImportError:
+    lzma = None
 import struct
 import select
 import socket
+import ssl
 import logging
 import threading
 import SocketServer
+import cPickle
+
+import protocols as _protocols
 
 logger = logging.getLogger(__name__)
 _DEB = logger.debug
@@ -18,15 +37,77 @@ _INF = logger.info
 #
 # Factory
 #
-def get_transport(qos={}):
-    return TCPTransport()
+def get_transport(qos={}, sap=None):
+    """ Create a transport from qos, or the one able to reach a SAP. """
+    kind = qos.get('transport', 'tcp') if sap is None else sap.kind
+    if kind not in _TRANSPORTS:
+        raise TransportError('unknown transport "%s"' % kind)
+    return _TRANSPORTS[kind](qos)
+
+
+# Client qos changing how connections behave: pools of same SAP are shared
+# only by clients with the same values
+_CONNECTION_QOS = ('pipelining', 'compression', 'compression_threshold',
+                   'chunk_size', 'handshake', 'protocol', 'protocols',
+                   'max_frame_size', 'serialize', 'shm_ring_size', 'tls')
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item))
+                            for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+def connection_settings(qos):
+    """ Hashable summary of the qos used by transports to connect. """
+    return tuple((name, _hashable(qos[name]))
+                 for name in _CONNECTION_QOS if name in qos)
+
+
+def _stream_transport(transport_class, options=lambda qos: {}):
+    return lambda qos: transport_class(
+        engine=qos.get('server_engine', 'threading'),
+        pipelining=qos.get('pipelining', False),
+        compression=qos.get('compression', None),
+        compression_threshold=qos.get('compression_threshold',
+                                      _COMPRESSION_THRESHOLD),
+        chunk_size=qos.get('chunk_size', None),
+        reuse_port=qos.get('reuse_port', False),
+        metrics=qos.get('metrics', None),
+        handshake=qos.get('handshake', False),
+        protocol=qos.get('protocol', 'pip'),
+        protocols=qos.get('protocols', None),
+        max_frame_size=qos.get('max_frame_size', None),
+        **options(qos))
 
 #
 # URI encoding/decode
 #
+def split_URI(uri):
+    """ Split "<sap>/<handler>" (potp:// already removed).
+
+    Returns (sap_str, handler) tuple, handler is None if not given.
+    """
+    if uri.startswith('unix@'):
+        # Socket path has slashes: handler follows the socket file
+        path = uri[5:]
+        socket_path = path
+        while socket_path and not os.path.exists(socket_path):
+            socket_path = os.path.dirname(socket_path)
+        if not socket_path or os.path.isdir(socket_path):
+            return uri, None
+        return 'unix@' + socket_path, path[len(socket_path) + 1:] or None
+    if '/' in uri:
+        return uri.split('/')[0], uri[uri.index('/') + 1:]
+    return uri, None
+
+
 def encode_SAP(sap_str):
     try:
-        ttype, sap = sap_str.split('@')
+        ttype, sap = sap_str.split('@', 1)
     except:
         raise CannotEncodeSAP(sap_str)
     if ttype == 'null':
@@ -39,10 +120,76 @@ def encode_SAP(sap_str):
             return TCPSAP(address, int(port))
         else:
             raise CannotEncodeSAP(sap_str)
+    elif ttype == 'tls':
+        if sap.count(':') == 0:
+            return TLSSAP(address=sap)
+        elif sap.count(':') == 1:
+            address, port = sap.split(':')
+            return TLSSAP(address, int(port))
+        else:
+            raise CannotEncodeSAP(sap_str)
+    elif ttype == 'unix':
+        if not sap.startswith('/'):
+            raise CannotEncodeSAP(sap_str)
+        return UnixSAP(sap)
+    elif ttype == 'inproc':
+        if not sap or '/' in sap:
+            raise CannotEncodeSAP(sap_str)
+        return InprocSAP(sap)
+    elif ttype == 'shm':
+        if not sap or '/' in sap:
+            raise CannotEncodeSAP(sap_str)
+        return ShmSAP(sap)
     else:
         raise CannotEncodeSAP(sap_str)
 
-_VMTU = 1024
+# Frames up to this size are sent with a single write
+_COALESCE_SIZE = 16384
+# Event loop receives bigger frames straight into their own buffer
+_DIRECT_RECV_SIZE = 65536
+_HEADER = struct.Struct('i')
+# Extended frames: legacy header holds _XFRAME_MARK instead of a size and
+# it is followed by flags, reserved, request id and 64 bits size.
+_XFRAME_MARK = -0x504f5450
+_XHEADER = struct.Struct('=iHHIQ')
+# Extended frame flags: payload is compressed, bits 8-11 are the codec
+# used or, if not compressed, the codec accepted by the sender
+_XFLAG_COMPRESSED = 0x0001
+# Payload is a chunk of a streamed message and more chunks follow
+_XFLAG_MORE = 0x0002
+# Payload is a handshake offer (or answer), not a request
+_XFLAG_HANDSHAKE = 0x0004
+# Request without reply: server must not send any frame back
+_XFLAG_ONEWAY = 0x0008
+_XFLAG_CODEC_SHIFT = 8
+_XFLAG_CODEC_MASK = 0x0f00
+
+# Compression codecs: name -> (id, module)
+_CODECS = {
+    'zlib': (1, zlib),
+    'bz2': (2, bz2)
+    }
+if lzma is not None:
+    _CODECS['lzma'] = (3, lzma)
+_CODEC_MODULES = dict(_CODECS.values())
+_CODEC_NAMES = dict((codec_id, name)
+                    for name, (codec_id, module) in _CODECS.items())
+# Smaller payloads are never compressed
+_COMPRESSION_THRESHOLD = 4096
+# Default chunk size of streamed messages
+_CHUNK_SIZE = 1024 * 1024
+# Not exported by the socket module of Python 2 (Linux value)
+_SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+# Handshake offers are requests to this handler: servers not aware of
+# handshakes reply them with an error instead of failing
+_HANDSHAKE_DEST = 'potp-handshake'
+_HANDSHAKE_VERSION = 1
+# Features of servers not configured by a TCPTransport
+_SERVER_FEATURES = {
+    'protocol': 'pip',
+    'compression': None,
+    'max_frame_size': None
+    }
 
 #
 # Interface classes
@@ -50,6 +197,8 @@ _VMTU = 1024
 
 class TransportSAP(object):
     """ This class is used to store transport configuration. """
+    kind = 'null'
+
     def __str__(self):
         """ String representation should be enought to create more
         instances. """
@@ -82,6 +231,15 @@ class Transport(object):
         This property returns if transport is ready or not. """
         return False
 
+
+    @property
+    def healthy(self):
+        """ Connection check.
+
+        This property returns if client connection can be used to send
+        requests. """
+        return self.ready
+
     
     @property
     def is_bind(self):
@@ -184,6 +342,16 @@ class Transport(object):
         raise NotImplementedError()
 
     
+    @property
+    def negotiated(self):
+        """ Features chosen with the remote peer when connecting.
+
+        Only transports doing handshakes negotiate features, the rest of
+        them return None.
+        """
+        return None
+
+
     def send_request(self, msg):
         """ Send request.
 
@@ -199,6 +367,70 @@ class Transport(object):
         raise NotImplementedError()
 
 
+    def send_oneway(self, msg):
+        """ Send request without response.
+
+        Transports able to tell the server that no response is expected
+        return once the request is written, the rest of them wait for
+        the response and drop it.
+
+        Args:
+            msg: request to send.
+
+        Raises:
+            ConnectionLost: error writing socket.
+        """
+        self.send_request(msg)
+
+
+    def submit_request(self, msg, callback):
+        """ Send request without waiting for the response.
+
+        Transports able to have several requests in flight (i.e. TCP
+        with pipelining) return at once and call back from a thread of
+        the connection (never the one reading replies, so callbacks can
+        send requests too), the rest of them send the request with
+        send_request().
+
+        Args:
+            msg: request to send.
+            callback: called with (response, None) when response is
+                received, or (None, exception) if the request failed.
+
+        Raises:
+            ConnectionLost: error writing socket.
+        """
+        try:
+            response = self.send_request(msg)
+        except Exception, e:
+            callback(None, e)
+        else:
+            callback(response, None)
+
+
+    def stream_request(self, write_request, read_reply):
+        """ Send request written to a stream.
+
+        Transports able to send and receive messages in chunks stream
+        both request and reply, the rest of them buffer messages and
+        use send_request().
+
+        Args:
+            write_request: callable writing request to a file-like object.
+            read_reply: callable reading reply from a file-like object.
+
+        Returns:
+            value returned by read_reply.
+
+        Raises:
+            ConnectionLost: error writing socket.
+        """
+        request = cStringIO.StringIO()
+        write_request(request)
+        return read_reply(cStringIO.StringIO(
+            self.send_request(request.getvalue())))
+
+
     def create_SAP(self, *args, **kwargs):
         """ Factory of SAP objects.
 
@@ -251,31 +483,446 @@ def __get_free_tcp4_port__():
     return port
 
 
-def __wait_frame__(active_socket):
-    _INF('Waiting for frame')
-    frame_size = active_socket.recv(4)
-    if len(frame_size) != 4:
-        raise TransportError('Frame header must have 4 bytes')
-    frame_size = struct.unpack('i', frame_size)[0]
-    data = ''
-    total_received = 0
-    while total_received < frame_size:
-        partial = active_socket.recv(min(_VMTU,
-                                         frame_size - total_received))
-        if not partial:
-            break
-        total_received += len(partial)
-        data += partial
-    _INF('Readed frame of %s bytes' % len(data))
-    return data
-
-
-def __send_frame__(active_socket, data):
-    _INF('Sending frame of %s bytes' % len(data))
-    header = struct.pack('i', len(data))
-    frame = header + data
-    sent = active_socket.sendall(frame)
-    _INF('Frame sended')
+class _FrameReader(object):
+    """ Receives frames from a blocking socket.
+
+    Frame payload is received with recv_into() in a buffer allocated
+    once from the header. Payloads returned by read() belong to the
+    caller: a buffer is only reused for next frames once it is given
+    back with release(). Frames bigger than max_frame_size (if given)
+    are refused.
+    """
+    def __init__(self, active_socket, max_frame_size=None):
+        self.__socket = active_socket
+        self.__header = bytearray(_XHEADER.size)
+        # Buffer given back with release()
+        self.__spare = None
+        self.__max_frame_size = max_frame_size
+
+    def __fill__(self, data, start, end):
+        view = memoryview(data)
+        received = start
+        while received < end:
+            partial = self.__socket.recv_into(view[received:end],
+                                              end - received)
+            if not partial:
+                break
+            received += partial
+        return received
+
+    def __frame_buffer__(self, frame_size):
+        spare, self.__spare = self.__spare, None
+        if spare is None or len(spare) < frame_size:
+            return bytearray(frame_size)
+        del spare[frame_size:]
+        return spare
+
+    def release(self, data):
+        """ Give back a payload returned by read() once it is consumed
+        (i.e. decompressed or copied): nothing may refer to it, or to a
+        view of it, any more. Next frame is received in its buffer. """
+        if isinstance(data, bytearray):
+            self.__spare = data
+
+    def read(self):
+        """ Read a legacy or an extended frame.
+
+        Returns a (request_id, flags, data) tuple, request_id is None
+        when the frame is a legacy one and data is a bytearray.
+        """
+        # Per frame logs: nothing is done unless debugging
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            _DEB('Waiting for frame')
+        if self.__fill__(self.__header, 0, _HEADER.size) != _HEADER.size:
+            raise TransportError('Frame header must have 4 bytes')
+        frame_size = _HEADER.unpack_from(self.__header)[0]
+        request_id, flags = None, 0
+        if frame_size == _XFRAME_MARK:
+            if (self.__fill__(self.__header, _HEADER.size, _XHEADER.size) !=
+                    _XHEADER.size):
+                raise TransportError('Truncated extended frame header')
+            (mark, flags, reserved,
+             request_id, frame_size) = _XHEADER.unpack_from(self.__header)
+        __check_frame_size__(frame_size, self.__max_frame_size)
+        data = self.__frame_buffer__(frame_size)
+        received = self.__fill__(data, 0, frame_size)
+        if received < frame_size:
+            del data[received:]
+        if debug:
+            _DEB('Readed frame of %s bytes', len(data))
+        return request_id, flags, data
+
+
+def __check_frame_size__(frame_size, max_frame_size):
+    if max_frame_size is not None and frame_size > max_frame_size:
+        raise TransportError('frame of %s bytes exceeds max frame size (%s)' %
+                             (frame_size, max_frame_size))
+
+
+def __handshake_offer__(protocols, codec, pipelining, max_frame_size):
+    """ Client side of the handshake: payload sent to the server.
+
+    Offer is a pickled request for _HANDSHAKE_DEST handler, so servers
+    not aware of handshakes reply it with an error.
+    """
+    return cPickle.dumps({
+        'src': None,
+        'dest': _HANDSHAKE_DEST,
+        'req': None,
+        'handshake': {
+            'version': _HANDSHAKE_VERSION,
+            'protocols': list(protocols),
+            'compression': ([] if codec is None else [codec]) + sorted(
+                name for name in _CODECS if name != codec),
+            'codec': codec,
+            'pipelining': pipelining,
+            'max_frame_size': max_frame_size
+            }
+        }, 2)
+
+
+def __handshake_answer__(offer, features):
+    """ Server side of the handshake: choose the features of a connection.
+
+    Args:
+        offer: received offer (see __handshake_offer__()).
+        features: dict with server "protocol", "compression" and
+            "max_frame_size".
+
+    Returns:
+        pickled dict with chosen "protocol", "compression", "pipelining"
+        and "max_frame_size", None values mean not available.
+    """
+    try:
+        offer = cPickle.loads(str(offer))['handshake']
+    except (cPickle.UnpicklingError, EOFError, ValueError, TypeError,
+            KeyError, IndexError, AttributeError):
+        raise TransportError('invalid handshake')
+    protocol = features['protocol']
+    codec = offer.get('codec', None)
+    if codec not in _CODECS:
+        # Client has no preference: server one, if client supports it
+        codec = features['compression']
+        if codec not in offer.get('compression', []):
+            codec = None
+    max_frame_size = [size for size in (offer.get('max_frame_size', None),
+                                        features['max_frame_size'])
+                      if size is not None]
+    return cPickle.dumps({
+        'version': _HANDSHAKE_VERSION,
+        'protocol': protocol if protocol in offer.get('protocols',
+                                                      []) else None,
+        'compression': codec,
+        # Both server engines handle request ids and one-way requests
+        'pipelining': bool(offer.get('pipelining', False)),
+        'oneway': True,
+        'max_frame_size': min(max_frame_size) if max_frame_size else None
+        }, 2)
+
+
+def __segments__(data):
+    """ Buffers of a payload: protocols may give messages made of several
+    segments (see potp.protocols.Segments), sent without joining them. """
+    return getattr(data, 'segments', (data,))
+
+
+def __join__(data):
+    """ Contiguous copy of a payload made of segments. """
+    segments = getattr(data, 'segments', None)
+    if segments is None:
+        return data
+    joined = bytearray()
+    for segment in segments:
+        joined += segment
+    return joined
+
+
+def __send_frame__(active_socket, data, request_id=None, flags=0):
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        _DEB('Sending frame of %s bytes', len(data))
+    if request_id is None:
+        header = _HEADER.pack(len(data))
+    else:
+        header = _XHEADER.pack(_XFRAME_MARK, flags, 0, request_id, len(data))
+    frame = bytearray(header)
+    for segment in __segments__(data):
+        if len(segment) <= _COALESCE_SIZE:
+            frame += segment
+            continue
+        # Gather write: big segments are never copied behind the header
+        if frame:
+            active_socket.sendall(frame)
+            frame = bytearray()
+        active_socket.sendall(segment)
+    if frame:
+        active_socket.sendall(frame)
+    if debug:
+        _DEB('Frame sended')
+
+
+def __no_delay__(active_socket):
+    """ Disable Nagle algorithm on TCP sockets: big segments are written
+    after their frame header (see __send_frame__()) and would wait for
+    the delayed ACK of the header. """
+    if active_socket.family == socket.AF_INET:
+        active_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def __materialize__(response):
+    """ Buffer a streamed response (callable writing to a file). """
+    if not callable(response):
+        return response
+    stream = cStringIO.StringIO()
+    response(stream)
+    return stream.getvalue()
+
+
+class _ChunkReader(object):
+    """ File-like object over the chunks of a streamed message.
+
+    Chunks are pulled from the connection only when needed, so a
+    single chunk is kept in memory.
+    """
+    def __init__(self, next_frame, request_id, flags, chunk, compression,
+                 release=None):
+        self.__next_frame = next_frame
+        # Chunks are only read as copies: their frames are given back
+        self.__release = release
+        self.__request_id = request_id
+        self.__compression = compression
+        self.__more = flags & _XFLAG_MORE
+        self.__frame = chunk
+        self.__chunk = compression.decode(flags, chunk)
+        self.__offset = 0
+
+    def __next_chunk__(self):
+        if not self.__more:
+            return False
+        self.__chunk = None
+        if self.__release is not None:
+            self.__release(self.__frame)
+        self.__frame = None
+        request_id, flags, chunk = self.__next_frame()
+        self.__frame = chunk
+        if request_id != self.__request_id:
+            raise TransportError('chunk of request %s inside request %s' % (
+                request_id, self.__request_id))
+        self.__more = flags & _XFLAG_MORE
+        self.__chunk = self.__compression.decode(flags, chunk)
+        self.__offset = 0
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            available = len(self.__chunk) - self.__offset
+            if not available:
+                if not self.__next_chunk__():
+                    break
+                continue
+            taken = available if size < 0 else min(size, available)
+            parts.append(str(buffer(self.__chunk, self.__offset, taken)))
+            self.__offset += taken
+            if size > 0:
+                size -= taken
+        return ''.join(parts)
+
+    def readline(self):
+        parts = []
+        while True:
+            end = self.__chunk.find('\n', self.__offset)
+            if end >= 0:
+                parts.append(self.read(end + 1 - self.__offset))
+                break
+            parts.append(self.read(len(self.__chunk) - self.__offset))
+            if not self.__next_chunk__():
+                break
+        return ''.join(parts)
+
+    def drain(self):
+        """ Skip unread chunks, next frame of connection is readable. """
+        while self.__next_chunk__():
+            pass
+
+
+class _ChunkWriter(object):
+    """ File-like object sending written data as chunked frames. """
+    def __init__(self, send, chunk_size, compression, codec):
+        self.__send = send
+        self.__chunk_size = chunk_size
+        self.__compression = compression
+        self.__codec = codec
+        self.__buffer = bytearray()
+
+    def __chunk__(self, data, more=True):
+        flags, payload = self.__compression.encode(data, self.__codec)
+        self.__send(payload, flags | (_XFLAG_MORE if more else 0))
+
+    def write(self, data):
+        start = 0
+        if not self.__buffer:
+            # Big writes are sent without buffering
+            while len(data) - start >= self.__chunk_size:
+                self.__chunk__(buffer(data, start, self.__chunk_size))
+                start += self.__chunk_size
+        self.__buffer += buffer(data, start)
+        if len(self.__buffer) >= self.__chunk_size:
+            self.__chunk__(self.__buffer)
+            self.__buffer = bytearray()
+
+    def close(self):
+        """ Send last chunk. """
+        self.__chunk__(self.__buffer, more=False)
+        self.__buffer = bytearray()
+
+
+class _Compression(object):
+    """ Payload compression settings and counters of a transport. """
+    def __init__(self, codec=None, threshold=_COMPRESSION_THRESHOLD):
+        if codec is not None and codec not in _CODECS:
+            raise TransportError('unknown compression codec "%s"' % codec)
+        self.codec = 0 if codec is None else _CODECS[codec][0]
+        self.threshold = threshold
+        # Optional potp.metrics.Metrics() instance
+        self.metrics = None
+        self.__lock = threading.Lock()
+        self.__stats = {
+            'sent_frames': 0,
+            'sent_compressed': 0,
+            'sent_raw_bytes': 0,
+            'sent_wire_bytes': 0,
+            'received_frames': 0,
+            'received_compressed': 0,
+            'received_raw_bytes': 0,
+            'received_wire_bytes': 0
+            }
+
+    @staticmethod
+    def codec_of(flags):
+        return (flags & _XFLAG_CODEC_MASK) >> _XFLAG_CODEC_SHIFT
+
+    def __count__(self, direction, raw, wire, compressed):
+        with self.__lock:
+            self.__stats[direction + '_frames'] += 1
+            self.__stats[direction + '_raw_bytes'] += raw
+            self.__stats[direction + '_wire_bytes'] += wire
+            if compressed:
+                self.__stats[direction + '_compressed'] += 1
+        if self.metrics is not None:
+            self.metrics.increment('transport_frames', direction=direction)
+            self.metrics.increment('transport_bytes', wire,
+                                   direction=direction)
+            self.metrics.observe('transport_frame_bytes', wire,
+                                 direction=direction)
+
+    def encode(self, data, codec):
+        """ Returns (flags, payload) of data sent with given codec. """
+        flags = codec << _XFLAG_CODEC_SHIFT
+        payload = data
+        if codec in _CODEC_MODULES and len(data) >= self.threshold:
+            joined = __join__(data)
+            compressed = _CODEC_MODULES[codec].compress(
+                joined if isinstance(joined, str) else buffer(joined))
+            # Uncompressible data is sent as is
+            if len(compressed) < len(data):
+                flags |= _XFLAG_COMPRESSED
+                payload = compressed
+        self.__count__('sent', len(data), len(payload),
+                       flags & _XFLAG_COMPRESSED)
+        return flags, payload
+
+    def decode(self, flags, payload):
+        """ Returns data of a received payload. """
+        data = payload
+        if flags & _XFLAG_COMPRESSED:
+            codec = self.codec_of(flags)
+            if codec not in _CODEC_MODULES:
+                raise TransportError('unknown compression codec %s' % codec)
+            data = _CODEC_MODULES[codec].decompress(buffer(payload))
+        self.__count__('received', len(data), len(payload),
+                       flags & _XFLAG_COMPRESSED)
+        return data
+
+    @property
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+        for direction in ('sent', 'received'):
+            wire = stats[direction + '_wire_bytes']
+            stats[direction + '_ratio'] = (
+                float(stats[direction + '_raw_bytes']) / wire if wire else 1.0)
+        return stats
+
+
+class _Poller(object):
+    """ Readiness notification over epoll, poll or select (first available). """
+    def __init__(self):
+        self.__read = set()
+        self.__write = set()
+        if hasattr(select, 'epoll'):
+            self.__poll = select.epoll()
+            self.__flags = (select.EPOLLIN, select.EPOLLOUT,
+                            select.EPOLLERR | select.EPOLLHUP)
+            self.__timeout = lambda timeout: timeout
+        elif hasattr(select, 'poll'):
+            self.__poll = select.poll()
+            self.__flags = (select.POLLIN, select.POLLOUT,
+                            select.POLLERR | select.POLLHUP | select.POLLNVAL)
+            self.__timeout = lambda timeout: int(timeout * 1000)
+        else:
+            self.__poll = None
+
+    def __mask__(self, fd):
+        read, write, error = self.__flags
+        return ((read if fd in self.__read else 0) |
+                (write if fd in self.__write else 0))
+
+    def register(self, fd, write=False):
+        self.__read.add(fd)
+        if write:
+            self.__write.add(fd)
+        if self.__poll is not None:
+            self.__poll.register(fd, self.__mask__(fd))
+
+    def modify(self, fd, read=True, write=False):
+        for (wanted, interest) in ((read, self.__read),
+                                   (write, self.__write)):
+            if wanted:
+                interest.add(fd)
+            else:
+                interest.discard(fd)
+        if self.__poll is not None:
+            self.__poll.modify(fd, self.__mask__(fd))
+
+    def unregister(self, fd):
+        self.__read.discard(fd)
+        self.__write.discard(fd)
+        if self.__poll is not None:
+            self.__poll.unregister(fd)
+
+    def poll(self, timeout):
+        """ Returns a list of (fd, readable, writable) tuples. """
+        if self.__poll is None:
+            r, w, x = select.select(list(self.__read), list(self.__write),
+                                    [], timeout)
+            return ([(fd, True, fd in w) for fd in r] +
+                    [(fd, False, True) for fd in w if fd not in r])
+        read, write, error = self.__flags
+        try:
+            events = self.__poll.poll(self.__timeout(timeout))
+        except (IOError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        # Errors are reported as readable: next recv() will notice them
+        return [(fd, bool(mask & (read | error)), bool(mask & write))
+                for fd, mask in events]
+
+    def close(self):
+        if self.__poll is not None and hasattr(self.__poll, 'close'):
+            self.__poll.close()
 
 
 #
@@ -291,41 +938,621 @@ class TCPTransport(Transport):
                                                      server)
 
         def handle(self):
+            __no_delay__(self.request)
+            self.__reader = _FrameReader(
+                self.request, self.server.features['max_frame_size'])
+            # TLS sockets may hold decrypted data select() does not see
+            pending = getattr(self.request, 'pending', lambda: 0)
             while True:
-                r, w, x = select.select([self.request], [], [])
-                if not r:
-                    break
+                if not pending():
+                    r, w, x = select.select([self.request], [], [])
+                    if not r:
+                        break
                 _DEB('Server waiting for frames...')
                 try:
-                    request = __wait_frame__(self.request)
+                    request_id, flags, request = self.__reader.read()
+                    if flags & _XFLAG_HANDSHAKE:
+                        answer = __handshake_answer__(request,
+                                                      self.server.features)
+                        __send_frame__(self.request, answer, request_id,
+                                       _XFLAG_HANDSHAKE)
+                        continue
                 except TransportError:
                     _INF('Server disconnected from client')
                     break
-                _DEB('Server received "%s"' % repr(request))
+                compression = self.server.compression
+                codec = _Compression.codec_of(flags)
+                if flags & _XFLAG_MORE:
+                    # Streamed request: handler reads chunks on demand
+                    request = _ChunkReader(self.__reader.read, request_id,
+                                           flags, request, compression,
+                                           self.__reader.release)
+                else:
+                    payload = request
+                    request = compression.decode(flags, payload)
+                    if request is not payload:
+                        # Decompressed: frame is not needed any more
+                        self.__reader.release(payload)
+                    del payload
+                _DEB('Server received "%r"', request)
                 response = self.server.request_handler(request)
-                _DEB('Server sends "%s"' % repr(response))
-                __send_frame__(self.request,
-                               '' if response is None else response)
-            
+                _DEB('Server sends "%r"', response)
+                if isinstance(request, _ChunkReader):
+                    request.drain()
+                if flags & _XFLAG_ONEWAY:
+                    _DEB('One-way request, no reply sent')
+                elif callable(response) and request_id is not None:
+                    writer = _ChunkWriter(
+                        lambda data, flags: __send_frame__(
+                            self.request, data, request_id, flags),
+                        self.server.chunk_size, compression, codec)
+                    response(writer)
+                    writer.close()
+                else:
+                    # Replies use the same framing (and codec) than request
+                    flags, response = compression.encode(
+                        '' if response is None else __materialize__(response),
+                        0 if request_id is None else codec)
+                    __send_frame__(self.request, response, request_id, flags)
+                # Frame is freed before waiting for next one
+                del request, response
+
     class _TCPBasicServer(SocketServer.ThreadingMixIn,
                          SocketServer.TCPServer):
-        def __init__(self, address, request_handler):
+        def __init__(self, address, request_handler, reuse_port=False):
+            self.reuse_port = reuse_port
             SocketServer.TCPServer.__init__(self,
                                             address, request_handler)
             self.callback = None
+            self.compression = _Compression()
+            self.chunk_size = _CHUNK_SIZE
+            # Offered in handshakes, see __handshake_answer__()
+            self.features = dict(_SERVER_FEATURES)
+
+        def server_bind(self):
+            if self.reuse_port:
+                # Every process listening on the port shares connections
+                self.socket.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+            SocketServer.TCPServer.server_bind(self)
 
         def request_handler(self, request):
             if self.callback is None:
                 _DEB('Request received but no callback stablished!')
                 return
             return self.callback(request)
-        
-    def __init__(self):
+
+    class _EventConnection(object):
+        def __init__(self, active_socket, client_address):
+            self.socket = active_socket
+            self.client_address = client_address
+            self.inbuf = bytearray()
+            # Output chunks, small frames are coalesced in bytearrays
+            self.outbuf = collections.deque()
+            self.outbuf_offset = 0
+            self.outbuf_tail = None
+            # Large frame received in place: [request_id, flags, data, size]
+            self.pending = None
+            # Streamed requests being received: request_id -> bytearray
+            self.chunks = {}
+            # Requests waiting for a dispatch worker, reads are paused
+            self.backlog = collections.deque()
+            self.closed = False
+
+        def receive(self, recv_size):
+            """ Read available data, returns 0 when peer is closed. """
+            if self.pending is not None:
+                data, received = self.pending[2], self.pending[3]
+                partial = self.socket.recv_into(memoryview(data)[received:])
+                self.pending[3] += partial
+                return partial
+            data = self.socket.recv(recv_size)
+            self.inbuf += data
+            return len(data)
+
+        def frames(self, max_frame_size=None):
+            """ Extract every complete (request_id, flags, data) frame
+            received, TransportError if one is bigger than max_frame_size.
+            """
+            if self.pending is not None:
+                request_id, flags, data, received = self.pending
+                if received < len(data):
+                    return []
+                self.pending = None
+                return [(request_id, flags, data)]
+            frames = []
+            start = 0
+            while len(self.inbuf) - start >= _HEADER.size:
+                frame_size = _HEADER.unpack_from(self.inbuf, start)[0]
+                header_size = _HEADER.size
+                request_id, flags = None, 0
+                if frame_size == _XFRAME_MARK:
+                    header_size = _XHEADER.size
+                    if len(self.inbuf) - start < header_size:
+                        break
+                    (mark, flags, reserved, request_id,
+                     frame_size) = _XHEADER.unpack_from(self.inbuf, start)
+                __check_frame_size__(frame_size, max_frame_size)
+                frame_start = start + header_size
+                available = len(self.inbuf) - frame_start
+                if available < frame_size:
+                    if frame_size >= _DIRECT_RECV_SIZE:
+                        # Receive the rest straight into the frame buffer
+                        data = bytearray(frame_size)
+                        view = memoryview(self.inbuf)
+                        data[:available] = view[frame_start:]
+                        del view
+                        self.pending = [request_id, flags, data, available]
+                        start = len(self.inbuf)
+                    break
+                start = frame_start + frame_size
+                frames.append((request_id, flags,
+                               self.inbuf[frame_start:start]))
+            del self.inbuf[:start]
+            return frames
+
+        def push_frame(self, data, request_id=None, flags=0):
+            if request_id is None:
+                header = _HEADER.pack(len(data))
+            else:
+                header = _XHEADER.pack(_XFRAME_MARK, flags, 0,
+                                       request_id, len(data))
+            if self.outbuf_tail is None:
+                self.outbuf_tail = bytearray()
+                self.outbuf.append(self.outbuf_tail)
+            self.outbuf_tail += header
+            for segment in __segments__(data):
+                if len(segment) > _COALESCE_SIZE:
+                    self.outbuf.append(segment)
+                    self.outbuf_tail = None
+                    continue
+                if self.outbuf_tail is None:
+                    self.outbuf_tail = bytearray()
+                    self.outbuf.append(self.outbuf_tail)
+                self.outbuf_tail += segment
+
+    class _TCPEventServer(object):
+        """ Single-threaded server: all connections share one poller. """
+        address_family = socket.AF_INET
+        request_queue_size = 128
+        recv_size = 65536
+
+        def __init__(self, address, reuse_port=False):
+            self.socket = socket.socket(self.address_family,
+                                        socket.SOCK_STREAM)
+            try:
+                if reuse_port:
+                    self.socket.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT,
+                                           1)
+                self.socket.bind(address)
+                self.socket.listen(self.request_queue_size)
+            except:
+                self.socket.close()
+                raise
+            self.socket.setblocking(0)
+            self.server_address = self.socket.getsockname()
+            self.callback = None
+            self.compression = _Compression()
+            self.chunk_size = _CHUNK_SIZE
+            # Offered in handshakes, see __handshake_answer__()
+            self.features = dict(_SERVER_FEATURES)
+            self.__connections = {}
+            self.__poller = _Poller()
+            self.__poller.register(self.socket.fileno())
+            # Dispatch workers hand replies back through a pipe
+            self.__completed = collections.deque()
+            self.__wakeup_lock = threading.Lock()
+            self.__wakeup = os.pipe()
+            for fd in self.__wakeup:
+                fcntl.fcntl(fd, fcntl.F_SETFL,
+                            fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self.__poller.register(self.__wakeup[0])
+            self.__shutdown_request = False
+            self.__is_shut_down = threading.Event()
+
+        def request_handler(self, request):
+            if self.callback is None:
+                _DEB('Request received but no callback stablished!')
+                return
+            return self.callback(request)
+
+        def serve_forever(self, poll_interval=0.5):
+            self.__is_shut_down.clear()
+            try:
+                while not self.__shutdown_request:
+                    for fd, readable, writable in self.__poller.poll(
+                            poll_interval):
+                        if fd == self.socket.fileno():
+                            self.__accept__()
+                            continue
+                        if fd == self.__wakeup[0]:
+                            self.__complete__()
+                            continue
+                        if fd not in self.__connections:
+                            continue
+                        if readable and not self.__connections[fd].backlog:
+                            self.__read__(self.__connections[fd])
+                        if writable and fd in self.__connections:
+                            self.__write__(self.__connections[fd])
+            finally:
+                for connection in self.__connections.values():
+                    self.__drop__(connection)
+                self.__poller.close()
+                self.socket.close()
+                with self.__wakeup_lock:
+                    for fd in self.__wakeup:
+                        os.close(fd)
+                    self.__wakeup = None
+                self.__shutdown_request = False
+                self.__is_shut_down.set()
+
+        def shutdown(self):
+            self.__shutdown_request = True
+            self.__is_shut_down.wait()
+
+        def __accept__(self):
+            try:
+                active_socket, client_address = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            _DEB('Server accepts connection from %r', client_address)
+            active_socket.setblocking(0)
+            __no_delay__(active_socket)
+            connection = TCPTransport._EventConnection(active_socket,
+                                                       client_address)
+            self.__connections[active_socket.fileno()] = connection
+            self.__poller.register(active_socket.fileno())
+
+        def __drop__(self, connection):
+            _INF('Server disconnected from client')
+            fd = connection.socket.fileno()
+            self.__poller.unregister(fd)
+            del(self.__connections[fd])
+            connection.socket.close()
+            connection.closed = True
+            connection.backlog.clear()
+
+        def __read__(self, connection):
+            try:
+                received = connection.receive(self.recv_size)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.EINTR):
+                    return
+                received = 0
+            if not received:
+                self.__drop__(connection)
+                return
+            try:
+                frames = connection.frames(self.features['max_frame_size'])
+            except TransportError, e:
+                _INF('Client frame refused: %s', e)
+                self.__drop__(connection)
+                return
+            for request_id, flags, request in frames:
+                if flags & _XFLAG_HANDSHAKE:
+                    try:
+                        answer = __handshake_answer__(request, self.features)
+                    except TransportError, e:
+                        _INF('Client handshake refused: %s', e)
+                        self.__drop__(connection)
+                        return
+                    connection.push_frame(answer, request_id,
+                                          _XFLAG_HANDSHAKE)
+                    continue
+                request = self.compression.decode(flags, request)
+                if flags & _XFLAG_MORE or request_id in connection.chunks:
+                    # Streamed requests are joined, reads never block
+                    chunks = connection.chunks.setdefault(request_id,
+                                                          bytearray())
+                    chunks += request
+                    if flags & _XFLAG_MORE:
+                        continue
+                    request = connection.chunks.pop(request_id)
+                _DEB('Server received "%r"', request)
+                if connection.backlog or not self.__dispatch__(
+                        connection, request_id, flags, request):
+                    connection.backlog.append((request_id, flags, request))
+            if connection.backlog:
+                # Backpressure: stop reading until a worker is free
+                self.__poller.modify(connection.socket.fileno(), read=False,
+                                     write=bool(connection.outbuf))
+            if connection.outbuf:
+                self.__write__(connection)
+
+        def __dispatch__(self, connection, request_id, flags, request):
+            """ Run (or queue) a request, False if it must wait. """
+            submit = getattr(self.callback, 'submit', None)
+            if submit is None:
+                self.__reply__(connection, request_id, flags,
+                               self.request_handler(request))
+                return True
+            return submit(request, lambda response, error: self.__done__(
+                connection, request_id, flags, response, error))
+
+        def __reply__(self, connection, request_id, flags, response):
+            if flags & _XFLAG_ONEWAY:
+                _DEB('One-way request, no reply sent')
+                return
+            _DEB('Server sends "%r"', response)
+            flags, response = self.compression.encode(
+                '' if response is None else __materialize__(response),
+                0 if request_id is None else _Compression.codec_of(flags))
+            connection.push_frame(response, request_id, flags)
+
+        def __done__(self, connection, request_id, flags, response, error):
+            # Called from dispatch workers: wake up the event loop
+            with self.__wakeup_lock:
+                if self.__wakeup is None:
+                    return
+                self.__completed.append((connection, request_id, flags,
+                                         response, error))
+                try:
+                    os.write(self.__wakeup[1], 'x')
+                except OSError, e:
+                    if e.args[0] != errno.EAGAIN:
+                        raise
+
+        def __complete__(self):
+            """ Send replies of finished requests, resume paused reads. """
+            try:
+                while os.read(self.__wakeup[0], 4096):
+                    pass
+            except OSError, e:
+                if e.args[0] != errno.EAGAIN:
+                    raise
+            finished = set()
+            while self.__completed:
+                (connection, request_id, flags,
+                 response, error) = self.__completed.popleft()
+                if connection.closed:
+                    continue
+                if error is not None:
+                    self.__drop__(connection)
+                    continue
+                self.__reply__(connection, request_id, flags, response)
+                finished.add(connection)
+            for connection in self.__connections.values():
+                if not connection.backlog:
+                    continue
+                while connection.backlog and self.__dispatch__(
+                        connection, *connection.backlog[0]):
+                    connection.backlog.popleft()
+                if not connection.backlog:
+                    self.__poller.modify(connection.socket.fileno(),
+                                         write=bool(connection.outbuf))
+                finished.add(connection)
+            for connection in finished:
+                if connection.outbuf and not connection.closed:
+                    self.__write__(connection)
+
+        def __write__(self, connection):
+            while connection.outbuf:
+                chunk = memoryview(connection.outbuf[0])
+                try:
+                    sent = connection.socket.send(
+                        chunk[connection.outbuf_offset:])
+                except socket.error, e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                     errno.EINTR):
+                        break
+                    self.__drop__(connection)
+                    return
+                connection.outbuf_offset += sent
+                if connection.outbuf_offset < len(chunk):
+                    break
+                if connection.outbuf.popleft() is connection.outbuf_tail:
+                    connection.outbuf_tail = None
+                connection.outbuf_offset = 0
+            self.__poller.modify(connection.socket.fileno(),
+                                 read=not connection.backlog,
+                                 write=bool(connection.outbuf))
+
+    class _Multiplexer(object):
+        """ Matches replies with the in-flight requests of one socket. """
+        def __init__(self, active_socket, compression, chunk_size,
+                     max_frame_size=None):
+            self.__socket = active_socket
+            self.__compression = compression
+            self.__chunk_size = chunk_size
+            self.__max_frame_size = max_frame_size
+            # Streamed replies being received: request_id -> bytearray
+            self.__chunks = {}
+            self.__frame_reader = _FrameReader(active_socket, max_frame_size)
+            self.__send_lock = threading.Lock()
+            self.__lock = threading.Lock()
+            # request_id -> (callback, run by the reader thread)
+            self.__pending = {}
+            self.__last_id = 0
+            self.__error = None
+            # Callbacks of submit() queued for their own thread, not run
+            # by the reader: they may send requests and wait for replies
+            self.__callbacks = collections.deque()
+            self.__callbacks_ready = threading.Condition(self.__lock)
+            self.__runner = threading.Thread(target=self.__run_callbacks__)
+            self.__runner.daemon = True
+            self.__runner.start()
+            self.__reader = threading.Thread(target=self.__read_replies__)
+            self.__reader.daemon = True
+            self.__reader.start()
+
+        def request(self, request):
+            done = threading.Event()
+            slot = [None, None]
+            def reply(response, error):
+                slot[0], slot[1] = response, error
+                done.set()
+            self.__submit__(request, reply, True)
+            done.wait()
+            if slot[1] is not None:
+                raise slot[1]
+            return slot[0]
+
+        def submit(self, request, callback):
+            """ Send a request, callback gets (reply, None) or (None,
+            TransportError()) from the callback thread of the
+            connection. """
+            self.__submit__(request, callback, False)
+
+        def __submit__(self, request, callback, inline):
+            if not callable(request):
+                flags, request = self.__compression.encode(
+                    request, self.__compression.codec)
+                __check_frame_size__(len(request), self.__max_frame_size)
+            with self.__lock:
+                if self.__error is not None:
+                    raise TransportError(self.__error)
+                self.__last_id = (self.__last_id + 1) & 0xffffffff
+                request_id = self.__last_id
+                self.__pending[request_id] = (callback, inline)
+            try:
+                if callable(request):
+                    # Streamed: chunks of other requests may be interleaved
+                    writer = _ChunkWriter(
+                        lambda data, flags: self.__send__(data, request_id,
+                                                          flags),
+                        self.__chunk_size, self.__compression,
+                        self.__compression.codec)
+                    request(writer)
+                    writer.close()
+                else:
+                    self.__send__(request, request_id, flags)
+            except socket.error, e:
+                with self.__lock:
+                    self.__pending.pop(request_id, None)
+                raise TransportError(str(e))
+
+        def send_oneway(self, request):
+            flags, request = self.__compression.encode(
+                request, self.__compression.codec)
+            __check_frame_size__(len(request), self.__max_frame_size)
+            if self.__error is not None:
+                raise TransportError(self.__error)
+            try:
+                # No reply will come: no request id needed
+                self.__send__(request, 0, flags | _XFLAG_ONEWAY)
+            except socket.error, e:
+                raise TransportError(str(e))
+
+        def __send__(self, data, request_id, flags):
+            with self.__send_lock:
+                __send_frame__(self.__socket, data, request_id, flags)
+
+        def __read_replies__(self):
+            try:
+                while True:
+                    request_id, flags, frame = self.__frame_reader.read()
+                    response = self.__compression.decode(flags, frame)
+                    if response is not frame:
+                        # Decompressed: frame is not needed any more
+                        self.__frame_reader.release(frame)
+                    del frame
+                    if flags & _XFLAG_MORE or request_id in self.__chunks:
+                        chunks = self.__chunks.setdefault(request_id,
+                                                          bytearray())
+                        chunks += response
+                        self.__frame_reader.release(response)
+                        if flags & _XFLAG_MORE:
+                            continue
+                        response = self.__chunks.pop(request_id)
+                    with self.__lock:
+                        callback = self.__pending.pop(request_id, None)
+                    if callback is None:
+                        _DEB('Reply for unknown request %s', request_id)
+                        continue
+                    self.__reply__(callback, response, None)
+                    del response, callback
+            except (TransportError, socket.error), e:
+                error = str(e)
+            except Exception, e:
+                # i.e. corrupt frame (zlib.error...): stream is out of sync
+                _INF('Cannot read reply: %s', e)
+                error = 'invalid reply (%s)' % e
+            # Connection lost: wake up every waiting request
+            with self.__lock:
+                self.__error = error
+                pending = self.__pending.values()
+                self.__pending = {}
+            for callback in pending:
+                self.__reply__(callback, None, TransportError(error))
+            with self.__lock:
+                # Callback thread ends once queued callbacks are run
+                self.__callbacks.append(None)
+                self.__callbacks_ready.notify()
+
+        def __reply__(self, entry, response, error):
+            callback, inline = entry
+            if not inline:
+                with self.__lock:
+                    self.__callbacks.append((callback, response, error))
+                    self.__callbacks_ready.notify()
+                return
+            # Reader must survive errors of callbacks
+            try:
+                callback(response, error)
+            except Exception, e:
+                _INF('Reply callback failed: %s', e)
+
+        def __run_callbacks__(self):
+            while True:
+                with self.__lock:
+                    while not self.__callbacks:
+                        self.__callbacks_ready.wait()
+                    entry = self.__callbacks.popleft()
+                if entry is None:
+                    return
+                callback, response, error = entry
+                del entry
+                self.__reply__((callback, True), response, error)
+                del callback, response, error
+
+        @property
+        def alive(self):
+            return self.__error is None
+
+        def join(self):
+            self.__reader.join()
+
+    _SERVER_ENGINES = ['threading', 'eventloop']
+
+    def __init__(self, engine='threading', pipelining=False,
+                 compression=None,
+                 compression_threshold=_COMPRESSION_THRESHOLD,
+                 chunk_size=None, reuse_port=False, metrics=None,
+                 handshake=False, protocol='pip', protocols=None,
+                 max_frame_size=None):
         Transport.__init__(self)
+        if engine not in self._SERVER_ENGINES:
+            raise TransportError('unknown server engine "%s"' % engine)
+        self.__engine = engine
+        self.__pipelining = pipelining
+        self.__compression = _Compression(compression, compression_threshold)
+        self.__compression.metrics = metrics
+        self.__codec = compression
+        # Negotiate features when connecting (see potp.transport.negotiated)
+        self.__handshake = handshake
+        # Protocol of this endpoint and protocols it can switch to
+        self.__protocol = protocol
+        if protocols is None:
+            protocols = [protocol] + sorted(
+                name for name in _protocols.available_protocols()
+                if name != protocol)
+        self.__protocols = protocols
+        # Bigger frames are refused
+        self.__max_frame_size = max_frame_size
+        self.__negotiated = None
+        # Messages are streamed in chunks of this size if given
+        self.__chunk_size = chunk_size
+        # Let other processes listen on the same port (see potp.prefork)
+        self.__reuse_port = reuse_port
         self.__local = None
         self.__remote = None
 
         self.__client_socket = None
+        self.__frame_reader = None
+        self.__client_lock = threading.Lock()
+        self.__multiplexer = None
 
         self.__server = None
         self.__server_thread = None
@@ -354,30 +1581,56 @@ class TCPTransport(Transport):
         return self.__server.callback is not None
     
     def bind(self, callback):
-        _DEB('Bind to %s' % repr(callback))
+        _DEB('Bind to %r', callback)
         self.__request_callback = callback        
         if self.__server is None:
             return
         self.__server.callback = callback
     
+    @property
+    def sap_type(self):
+        return TCPSAP
+
+    def __server__(self, local_sap):
+        addr = local_sap.address
+        port = local_sap.port
+        _DEB('Server address=%s', addr)
+        _DEB('Server port=%s', port)
+        if self.__engine == 'eventloop':
+            return self._TCPEventServer((addr, port), self.__reuse_port)
+        return self._TCPBasicServer((addr, port), self._RequestHandler,
+                                    self.__reuse_port)
+
+    def __socket__(self, remote_sap):
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # FIX: if remote is 0.0.0.0, remote could be 127.0.0.1?
+        addr = '127.0.0.1' if remote_sap.address == '0.0.0.0' else remote_sap.address
+        
+        client_socket.connect((remote_sap.address, remote_sap.port))
+        __no_delay__(client_socket)
+        return client_socket
+
     def open(self, local_sap):
-        assert(isinstance(local_sap, TCPSAP))
+        assert(isinstance(local_sap, self.sap_type))
         _DEB('Create server socket...')
         self.__local = local_sap
-        addr = self.__local.address
-        port = self.__local.port
-        _DEB('Server address=%s' % addr)
-        _DEB('Server port=%s' % port)
-        self.__server = self._TCPBasicServer((addr, port),
-                                             self._RequestHandler)
-        _DEB('Server created in %s:%s' % self.__server.server_address)
+        self.__server = self.__server__(local_sap)
+        _DEB('Server created in %r', self.__server.server_address)
+        self.__server.compression = self.__compression
+        if self.__chunk_size is not None:
+            self.__server.chunk_size = self.__chunk_size
+        self.__server.features = {
+            'protocol': self.__protocol,
+            'compression': self.__codec,
+            'max_frame_size': self.__max_frame_size
+            }
+        # If bind() is called before open()
+        if self.__request_callback is not None:
+            self.__server.callback = self.__request_callback
         self.__server_thread = threading.Thread(
             target = self.__server.serve_forever)
         self.__server_thread.daemon=True
         self.__server_thread.start()
-        # If bind() is called before open()
-        if self.__request_callback is not None:
-            self.__server.callback = self.__request_callback
         
     def close(self):
         _DEB('Terminate server socket...')
@@ -388,18 +1641,57 @@ class TCPTransport(Transport):
         self.__local = None
         
     def connect(self, remote_sap):
-        assert(isinstance(remote_sap, TCPSAP))
-        _DEB('Client wants to connect to %s' % remote_sap)
+        assert(isinstance(remote_sap, self.sap_type))
+        _DEB('Client wants to connect to %s', remote_sap)
         self.__remote = remote_sap
-        self.__client_socket = socket.socket(socket.AF_INET,
-                                             socket.SOCK_STREAM)
-        # FIX: if remote is 0.0.0.0, remote could be 127.0.0.1?
-        addr = '127.0.0.1' if self.__remote.address == '0.0.0.0' else self.__remote.address
-        
-        self.__client_socket.connect((self.__remote.address,
-                                      self.__remote.port))
+        self.__client_socket = self.__socket__(remote_sap)
         _DEB('Connected to server')
-        
+        self.__frame_reader = _FrameReader(self.__client_socket,
+                                           self.__max_frame_size)
+        self.__compression.codec = (0 if self.__codec is None
+                                    else _CODECS[self.__codec][0])
+        self.__negotiated = None
+        if self.__handshake:
+            try:
+                self.__negotiate__()
+            except:
+                self.disconnect()
+                raise
+        if self.pipelining:
+            self.__multiplexer = self._Multiplexer(
+                self.__client_socket, self.__compression,
+                self.__stream_chunk_size__(), self.max_frame_size)
+
+    def __stream_chunk_size__(self):
+        """ Size of streamed chunks, each one must fit in a frame. """
+        chunk_size = self.__chunk_size or _CHUNK_SIZE
+        if self.max_frame_size is None:
+            return chunk_size
+        return min(chunk_size, self.max_frame_size)
+
+    def __negotiate__(self):
+        """ Exchange supported features with the server.
+
+        Servers not aware of handshakes reply the offer with an error
+        message, configured features are used then.
+        """
+        __send_frame__(self.__client_socket, __handshake_offer__(
+            self.__protocols, self.__codec, self.__pipelining,
+            self.__max_frame_size), 0, _XFLAG_HANDSHAKE)
+        request_id, flags, answer = self.__frame_reader.read()
+        if not flags & _XFLAG_HANDSHAKE:
+            _DEB('Server does not support handshakes')
+            return
+        try:
+            negotiated = cPickle.loads(str(answer))
+        except (cPickle.UnpicklingError, EOFError, ValueError):
+            raise TransportError('invalid handshake answer')
+        self.__frame_reader.release(answer)
+        _DEB('Negotiated features: %r', negotiated)
+        codec = negotiated.get('compression', None)
+        self.__compression.codec = 0 if codec is None else _CODECS[codec][0]
+        self.__negotiated = negotiated
+
     def disconnect(self):
         _DEB('Terminate client socket...')
         self.__remote = None
@@ -408,17 +1700,147 @@ class TCPTransport(Transport):
             self.__client_socket.close()
         finally:
             self.__client_socket = None
+            self.__frame_reader = None
+            self.__negotiated = None
+            if self.__multiplexer is not None:
+                self.__multiplexer.join()
+                self.__multiplexer = None
+
+    @property
+    def engine(self):
+        return self.__engine
+
+    @property
+    def chunk_size(self):
+        return self.__chunk_size
+
+    @property
+    def reuse_port(self):
+        return self.__reuse_port
+
+    @property
+    def metrics(self):
+        return self.__compression.metrics
+
+    @property
+    def compression_stats(self):
+        """ Frame and byte counters, with compression ratios. """
+        return self.__compression.stats
+
+    @property
+    def pipelining(self):
+        if self.__negotiated is not None:
+            return self.__negotiated.get('pipelining', False)
+        return self.__pipelining
+
+    @property
+    def handshake(self):
+        return self.__handshake
+
+    @property
+    def max_frame_size(self):
+        """ Biggest frame sent to (or received from) the remote peer. """
+        if self.__negotiated is not None:
+            return self.__negotiated.get('max_frame_size', None)
+        return self.__max_frame_size
+
+    @property
+    def negotiated(self):
+        """ Features chosen in the handshake of the client connection
+        ("protocol", "compression", "pipelining" and "max_frame_size"),
+        None if there was no handshake. """
+        return self.__negotiated
+
+    @property
+    def healthy(self):
+        if self.__client_socket is None:
+            return False
+        if self.__multiplexer is not None:
+            return self.__multiplexer.alive
+        # Idle lockstep connection: readable means closed by peer
+        with self.__client_lock:
+            try:
+                r, w, x = select.select([self.__client_socket], [], [], 0)
+            except (select.error, socket.error):
+                return False
+        return not r
 
     def send_request(self, request):
-        _DEB('Client wants to send "%s"' % repr(request))
+        _DEB('Client wants to send "%r"', request)
         if not self.client_mode:
             raise TransportNotConnected(self)
-        __send_frame__(self.__client_socket, request)
-        _DEB('Client wait for response...')
-        response = __wait_frame__(self.__client_socket)
-        _DEB('Client received "%s"' % repr(response))
+        if self.__multiplexer is not None:
+            response = self.__multiplexer.request(request)
+            _DEB('Client received "%r"', response)
+            return response
+        with self.__client_lock:
+            flags, request = self.__compression.encode(
+                request, self.__compression.codec)
+            __check_frame_size__(len(request), self.max_frame_size)
+            # Compression needs extended frames
+            __send_frame__(self.__client_socket, request,
+                           0 if self.__compression.codec else None, flags)
+            _DEB('Client wait for response...')
+            request_id, flags, frame = self.__frame_reader.read()
+            response = self.__compression.decode(flags, frame)
+            if response is not frame:
+                # Decompressed: frame is not needed any more
+                self.__frame_reader.release(frame)
+            del frame
+        _DEB('Client received "%r"', response)
         return response
 
+    def send_oneway(self, request):
+        if not self.client_mode:
+            raise TransportNotConnected(self)
+        if self.negotiated is None or not self.negotiated.get('oneway',
+                                                               False):
+            # Server may reply: response must be read
+            return Transport.send_oneway(self, request)
+        if self.__multiplexer is not None:
+            return self.__multiplexer.send_oneway(request)
+        with self.__client_lock:
+            flags, request = self.__compression.encode(
+                request, self.__compression.codec)
+            __check_frame_size__(len(request), self.max_frame_size)
+            __send_frame__(self.__client_socket, request, 0,
+                           flags | _XFLAG_ONEWAY)
+
+    def submit_request(self, request, callback):
+        if not self.client_mode:
+            raise TransportNotConnected(self)
+        if self.__multiplexer is None:
+            # Lockstep: nothing else can be sent until reply is received
+            return Transport.submit_request(self, request, callback)
+        self.__multiplexer.submit(request, callback)
+
+    def stream_request(self, write_request, read_reply):
+        if self.__chunk_size is None:
+            return Transport.stream_request(self, write_request, read_reply)
+        if not self.client_mode:
+            raise TransportNotConnected(self)
+        if self.__multiplexer is not None:
+            # Replies are joined by the multiplexer reader
+            return read_reply(cStringIO.StringIO(
+                self.__multiplexer.request(write_request)))
+        with self.__client_lock:
+            writer = _ChunkWriter(
+                lambda data, flags: __send_frame__(self.__client_socket,
+                                                   data, 0, flags),
+                self.__stream_chunk_size__(), self.__compression,
+                self.__compression.codec)
+            write_request(writer)
+            writer.close()
+            request_id, flags, response = self.__frame_reader.read()
+            reply = _ChunkReader(self.__frame_reader.read, request_id, flags,
+                                 response, self.__compression,
+                                 self.__frame_reader.release)
+            del response
+            try:
+                return read_reply(reply)
+            finally:
+                reply.drain()
+
     def create_sap(self, *args, **kwargs):
         address = '0.0.0.0'
         port = __get_free_tcp4_port__()
@@ -437,10 +1859,12 @@ class TCPTransport(Transport):
 
 
 class TCPSAP(TransportSAP):
+    kind = 'tcp'
+
     def __init__(self, address='0.0.0.0', port=None):
         self.__address = address
         self.__port = __get_free_tcp4_port__() if (port in [None, 0]) else port
-        _DEB('TCPSAP: %s, %s' % (repr(self.__address), repr(self.__port)))
+        _DEB('TCPSAP: %r, %r', self.__address, self.__port)
         
     @property
     def address(self):
@@ -452,3 +1876,647 @@ class TCPSAP(TransportSAP):
 
     def __str__(self):
         return 'tcp@%s:%s' % (self.__address, self.__port)
+
+
+#
+# TLS implementation
+#
+
+# Contexts shared by every TLS transport: (side, options) -> SSLContext()
+_TLS_CONTEXTS = {}
+_TLS_LOCK = threading.Lock()
+
+
+def _tls_context(server_side, options):
+    """ SSLContext of given "tls" qos options, created only once. """
+    key = (server_side, tuple(sorted(options.items())))
+    with _TLS_LOCK:
+        context = _TLS_CONTEXTS.get(key, None)
+        if context is not None:
+            return context
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+        if options.get('certfile', None) is not None:
+            context.load_cert_chain(options['certfile'],
+                                    options.get('keyfile', None))
+        if options.get('cafile', None) is not None:
+            context.load_verify_locations(options['cafile'])
+        elif not server_side:
+            context.load_default_certs()
+        if server_side:
+            if options.get('verify_client', False):
+                context.verify_mode = ssl.CERT_REQUIRED
+        elif options.get('verify', True):
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.check_hostname = options.get('check_hostname', True)
+        _TLS_CONTEXTS[key] = context
+        return context
+
+
+class TLSTransport(TCPTransport):
+    """ TCP transport encrypted with TLS.
+
+    Options are given in the "tls" qos: certfile and keyfile (required by
+    servers), cafile (trusted certificates, system ones if not given),
+    verify and check_hostname (clients, True by default), server_hostname
+    (clients, remote address by default) and verify_client (servers).
+
+    SSL contexts are created once for every set of options and shared by
+    all the connections, pooled ones included. Sessions are not resumed
+    (the Python 2 ssl module cannot give a session to a client socket):
+    every connection costs a full handshake, only keeping connections
+    open (i.e. "connection_pool" qos) avoids them. Only the threading
+    server engine and lockstep clients are supported: SSL sockets cannot
+    be read and written from two threads at once.
+    """
+    class _TLSRequestHandler(TCPTransport._RequestHandler):
+        def handle(self):
+            try:
+                self.request.do_handshake()
+            except (ssl.SSLError, socket.error), e:
+                _INF('TLS handshake failed: %s', e)
+                return
+            try:
+                TCPTransport._RequestHandler.handle(self)
+            except ssl.SSLError, e:
+                # i.e. peer closed without close_notify alert
+                _INF('Server disconnected from client: %s', e)
+
+    class _TLSBasicServer(TCPTransport._TCPBasicServer):
+        context = None
+
+        def get_request(self):
+            active_socket, client_address = self.socket.accept()
+            # Handshake is done by the connection thread, not the accept one
+            return self.context.wrap_socket(
+                active_socket, server_side=True,
+                do_handshake_on_connect=False), client_address
+
+    def __init__(self, tls=None, **kwargs):
+        TCPTransport.__init__(self, **kwargs)
+        if self.engine != 'threading':
+            raise TransportError('TLS transport needs threading engine')
+        if kwargs.get('pipelining', False):
+            raise TransportError('TLS transport cannot pipeline requests')
+        self.__options = dict(tls or {})
+        self.__client_socket = None
+
+    @property
+    def secure(self):
+        return True
+
+    @property
+    def sap_type(self):
+        return TLSSAP
+
+    @property
+    def session_stats(self):
+        """ Session cache counters of the shared SSL context (accepted
+        and connected handshakes...). """
+        return _tls_context(self.server_mode, self.__options).session_stats()
+
+    def __server__(self, local_sap):
+        _DEB('Server address=%s', local_sap.address)
+        _DEB('Server port=%s', local_sap.port)
+        server = self._TLSBasicServer((local_sap.address, local_sap.port),
+                                      self._TLSRequestHandler,
+                                      self.reuse_port)
+        server.context = _tls_context(True, self.__options)
+        return server
+
+    def __socket__(self, remote_sap):
+        plain_socket = TCPTransport.__socket__(self, remote_sap)
+        # Wildcard address only reaches this host
+        hostname = ('localhost' if remote_sap.address == '0.0.0.0'
+                    else remote_sap.address)
+        try:
+            client_socket = _tls_context(False, self.__options).wrap_socket(
+                plain_socket, server_hostname=self.__options.get(
+                    'server_hostname', hostname))
+        except:
+            plain_socket.close()
+            raise
+        self.__client_socket = client_socket
+        return client_socket
+
+    def disconnect(self):
+        self.__client_socket = None
+        TCPTransport.disconnect(self)
+
+    @property
+    def healthy(self):
+        if self.__client_socket is not None:
+            self.__read_records__()
+        return TCPTransport.healthy.fget(self)
+
+    def __read_records__(self):
+        """ Process TLS records received while idle (e.g. session tickets),
+        they make the socket readable but are no data. """
+        try:
+            r, w, x = select.select([self.__client_socket], [], [], 0)
+        except (select.error, socket.error):
+            return
+        if not r:
+            return
+        self.__client_socket.settimeout(0.0)
+        try:
+            if self.__client_socket.recv(1):
+                # Data out of any request: connection is broken
+                self.__client_socket.shutdown(socket.SHUT_RDWR)
+        except ssl.SSLWantReadError:
+            pass
+        except (ssl.SSLError, socket.error):
+            return
+        finally:
+            self.__client_socket.settimeout(None)
+
+    def create_sap(self, *args, **kwargs):
+        sap = TCPTransport.create_sap(self, *args, **kwargs)
+        return TLSSAP(sap.address, sap.port)
+
+
+class TLSSAP(TCPSAP):
+    kind = 'tls'
+
+    def __str__(self):
+        return 'tls@%s:%s' % (self.address, self.port)
+
+
+#
+# Unix domain sockets implementation
+#
+
+class UnixTransport(TCPTransport):
+    """ Same host transport, frames go through Unix domain sockets. """
+    class _UnixBasicServer(TCPTransport._TCPBasicServer):
+        address_family = socket.AF_UNIX
+
+    class _UnixEventServer(TCPTransport._TCPEventServer):
+        address_family = socket.AF_UNIX
+
+    @property
+    def sap_type(self):
+        return UnixSAP
+
+    def __server__(self, local_sap):
+        _DEB('Server path=%s', local_sap.path)
+        if os.path.exists(local_sap.path):
+            __remove_stale_socket__(local_sap.path)
+        if self.engine == 'eventloop':
+            return self._UnixEventServer(local_sap.path)
+        return self._UnixBasicServer(local_sap.path, self._RequestHandler)
+
+    def __socket__(self, remote_sap):
+        client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client_socket.connect(remote_sap.path)
+        except:
+            client_socket.close()
+            raise
+        return client_socket
+
+    def close(self):
+        path = self.sap.path
+        TCPTransport.close(self)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def create_sap(self, *args, **kwargs):
+        return UnixSAP(*args, **kwargs)
+
+
+def __remove_stale_socket__(path):
+    """ Remove socket file left by a dead server. """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error, e:
+        if e.args[0] != errno.ECONNREFUSED:
+            raise
+        _DEB('Removing stale socket %s', path)
+        os.unlink(path)
+    finally:
+        probe.close()
+
+
+class UnixSAP(TransportSAP):
+    kind = 'unix'
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(),
+                                'potp-%s.sock' % uuid.uuid4())
+        self.__path = path
+        _DEB('UnixSAP: %r', self.__path)
+
+    @property
+    def path(self):
+        return self.__path
+
+    def __str__(self):
+        return 'unix@%s' % self.__path
+
+
+#
+# In-process implementation
+#
+
+# Opened in-process SAPs: name -> InprocTransport()
+_INPROC = {}
+_INPROC_LOCK = threading.Lock()
+
+
+class InprocTransport(Transport):
+    """ Transport between endpoints of the same interpreter.
+
+    Requests are handed to the server callback in the caller thread,
+    no socket is used. If serialize is False, messages are not
+    marshalled at all (see protocols.Passthrough), both sides must
+    agree on it.
+    """
+    def __init__(self, serialize=True):
+        Transport.__init__(self)
+        self.__serialize = serialize
+        self.__local = None
+        self.__remote = None
+        self.__peer = None
+        self.__request_callback = None
+
+    @property
+    def serialize(self):
+        return self.__serialize
+
+    @property
+    def client_mode(self):
+        return self.__peer is not None
+
+    @property
+    def server_mode(self):
+        return self.__local is not None
+
+    @property
+    def ready(self):
+        return self.__local or self.__remote
+
+    @property
+    def healthy(self):
+        return self.__peer is not None and self.__peer.server_mode
+
+    @property
+    def sap(self):
+        return self.__local
+
+    @property
+    def sap_type(self):
+        return InprocSAP
+
+    @property
+    def is_binded(self):
+        return self.__request_callback is not None
+
+    def bind(self, callback):
+        _DEB('Bind to %r', callback)
+        self.__request_callback = callback
+
+    def open(self, local_sap):
+        assert(isinstance(local_sap, self.sap_type))
+        with _INPROC_LOCK:
+            if local_sap.name in _INPROC:
+                raise TransportError('%s already opened' % local_sap)
+            _INPROC[local_sap.name] = self
+        self.__local = local_sap
+        _DEB('Server opened in %s', local_sap)
+
+    def close(self):
+        _DEB('Terminate in-process server...')
+        with _INPROC_LOCK:
+            _INPROC.pop(self.__local.name, None)
+        self.__local = None
+
+    def connect(self, remote_sap):
+        assert(isinstance(remote_sap, self.sap_type))
+        _DEB('Client wants to connect to %s', remote_sap)
+        with _INPROC_LOCK:
+            peer = _INPROC.get(remote_sap.name, None)
+        if peer is None:
+            raise TransportError('%s not opened' % remote_sap)
+        if peer.serialize != self.__serialize:
+            raise TransportError('%s serialization mismatch' % remote_sap)
+        self.__remote = remote_sap
+        self.__peer = peer
+
+    def disconnect(self):
+        _DEB('Terminate in-process client...')
+        self.__remote = None
+        self.__peer = None
+
+    def handle_request(self, request):
+        if self.__request_callback is None:
+            _DEB('Request received but no callback stablished!')
+            return
+        return self.__request_callback(request)
+
+    def send_request(self, request):
+        if not self.client_mode:
+            raise TransportNotConnected(self)
+        if not self.__peer.server_mode:
+            raise TransportError('%s closed' % self.__remote)
+        response = self.__peer.handle_request(request)
+        return '' if response is None else response
+
+    def create_sap(self, *args, **kwargs):
+        return InprocSAP(*args, **kwargs)
+
+
+class InprocSAP(TransportSAP):
+    kind = 'inproc'
+
+    def __init__(self, name=None):
+        self.__name = str(uuid.uuid4()) if name is None else name
+        _DEB('InprocSAP: %r', self.__name)
+
+    @property
+    def name(self):
+        return self.__name
+
+    def __str__(self):
+        return 'inproc@%s' % self.__name
+
+
+#
+# Shared memory implementation
+#
+
+# Size of each ring (one per direction) of a shared memory connection
+_SHM_RING_SIZE = 4 * 1024 * 1024
+_SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+class _Ring(object):
+    """ Single producer, single consumer byte ring in shared memory.
+
+    Layout is write counter, read counter (64 bits each) and data.
+    Counters never decrease and each one is updated by one side only,
+    so no lock is needed.
+    """
+    _COUNTER = struct.Struct('=Q')
+    header_size = 2 * _COUNTER.size
+
+    def __init__(self, view, size):
+        self.__view = view
+        self.__size = size
+        self.__data = view[self.header_size:self.header_size + size]
+
+    def __positions__(self):
+        return (self._COUNTER.unpack_from(self.__view, 0)[0],
+                self._COUNTER.unpack_from(self.__view, self._COUNTER.size)[0])
+
+    def write(self, data):
+        """ Copy as much data as fits, returns copied bytes. """
+        write_pos, read_pos = self.__positions__()
+        size = min(len(data), self.__size - (write_pos - read_pos))
+        start = write_pos % self.__size
+        first = min(size, self.__size - start)
+        self.__data[start:start + first] = data[:first]
+        self.__data[:size - first] = data[first:size]
+        self._COUNTER.pack_into(self.__view, 0, write_pos + size)
+        return size
+
+    def read_into(self, data):
+        """ Move as much available data as fits, returns moved bytes. """
+        write_pos, read_pos = self.__positions__()
+        size = min(len(data), write_pos - read_pos)
+        start = read_pos % self.__size
+        first = min(size, self.__size - start)
+        data[:first] = self.__data[start:start + first]
+        data[first:size] = self.__data[:size - first]
+        self._COUNTER.pack_into(self.__view, self._COUNTER.size,
+                                read_pos + size)
+        return size
+
+
+class _ShmChannel(object):
+    """ Frames through two shared rings, a Unix socket is the doorbell.
+
+    Only single bytes go through the socket to wake up the peer when
+    data or free space is available in a ring.
+    """
+    _LENGTH = struct.Struct('=Q')
+    _SETUP = '%s %s'
+
+    def __init__(self, doorbell, shared, ring_size, initiator):
+        self.__doorbell = doorbell
+        self.__shared = shared
+        self.__memory = (ctypes.c_char * len(shared)).from_buffer(shared)
+        view = memoryview(self.__memory)
+        middle = _Ring.header_size + ring_size
+        rings = [_Ring(view[:middle], ring_size),
+                 _Ring(view[middle:], ring_size)]
+        # Initiator (client) sends through first ring
+        self.__tx, self.__rx = rings if initiator else reversed(rings)
+        self.__length = bytearray(self._LENGTH.size)
+
+    @classmethod
+    def create(cls, doorbell, ring_size):
+        """ Client side: create shared memory and send it to server. """
+        size = 2 * (_Ring.header_size + ring_size)
+        fd, path = tempfile.mkstemp(prefix='potp-ring-', dir=_SHM_DIR)
+        try:
+            os.ftruncate(fd, size)
+            shared = mmap.mmap(fd, size)
+            os.close(fd)
+            __send_frame__(doorbell, cls._SETUP % (path, ring_size))
+            if _FrameReader(doorbell).read()[2] != 'ok':
+                shared.close()
+                raise TransportError('shared memory refused by server')
+        finally:
+            os.unlink(path)
+        return cls(doorbell, shared, ring_size, True)
+
+    @classmethod
+    def attach(cls, doorbell, setup):
+        """ Server side: map the shared memory described in setup. """
+        path, ring_size = setup.rsplit(' ', 1)
+        ring_size = int(ring_size)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            shared = mmap.mmap(fd, 2 * (_Ring.header_size + ring_size))
+        finally:
+            os.close(fd)
+        return cls(doorbell, shared, ring_size, False)
+
+    def __ring__(self):
+        self.__doorbell.sendall('\0')
+
+    def __wait__(self):
+        if not self.__doorbell.recv(4096):
+            raise TransportError('peer closed shared memory channel')
+
+    @property
+    def alive(self):
+        r, w, x = select.select([self.__doorbell], [], [], 0)
+        return not r or self.__doorbell.recv(1, socket.MSG_PEEK) != ''
+
+    def send_frame(self, data):
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            _DEB('Sending frame of %s bytes', len(data))
+        for chunk in (self._LENGTH.pack(len(data)),) + tuple(
+                __segments__(data)):
+            chunk = memoryview(chunk)
+            while chunk:
+                sent = self.__tx.write(chunk)
+                if not sent:
+                    self.__wait__()
+                    continue
+                chunk = chunk[sent:]
+                self.__ring__()
+        if debug:
+            _DEB('Frame sended')
+
+    def __fill__(self, data):
+        data = memoryview(data)
+        while data:
+            received = self.__rx.read_into(data)
+            if not received:
+                self.__wait__()
+                continue
+            data = data[received:]
+            self.__ring__()
+
+    def read_frame(self):
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            _DEB('Waiting for frame')
+        self.__fill__(self.__length)
+        data = bytearray(self._LENGTH.unpack_from(self.__length)[0])
+        self.__fill__(data)
+        if debug:
+            _DEB('Readed frame of %s bytes', len(data))
+        return data
+
+    def close(self):
+        try:
+            self.__doorbell.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.__doorbell.close()
+        self.__tx = self.__rx = self.__memory = None
+        self.__shared.close()
+
+
+class ShmTransport(UnixTransport):
+    """ Same host transport moving frames through shared memory.
+
+    Each connection maps two rings (one per direction) of ring_size
+    bytes, the Unix socket of the SAP is only used to set up the
+    connection and to wake up the peer.
+    """
+    class _ShmRequestHandler(SocketServer.BaseRequestHandler):
+        def handle(self):
+            try:
+                channel = _ShmChannel.attach(
+                    self.request, str(_FrameReader(self.request).read()[2]))
+            except (TransportError, ValueError, EnvironmentError), e:
+                _INF('Cannot attach shared memory: %s', e)
+                __send_frame__(self.request, 'error')
+                return
+            __send_frame__(self.request, 'ok')
+            try:
+                while True:
+                    try:
+                        request = channel.read_frame()
+                    except (TransportError, socket.error):
+                        _INF('Server disconnected from client')
+                        break
+                    response = self.server.request_handler(request)
+                    channel.send_frame('' if response is None else response)
+                    del request, response
+            finally:
+                channel.close()
+
+    _RequestHandler = _ShmRequestHandler
+
+    def __init__(self, ring_size=_SHM_RING_SIZE):
+        UnixTransport.__init__(self)
+        self.__ring_size = ring_size
+        self.__remote = None
+        self.__channel = None
+        self.__lock = threading.Lock()
+
+    @property
+    def client_mode(self):
+        return self.__channel is not None
+
+    @property
+    def ready(self):
+        return self.sap or self.__remote
+
+    @property
+    def healthy(self):
+        return self.__channel is not None and self.__channel.alive
+
+    @property
+    def sap_type(self):
+        return ShmSAP
+
+    def connect(self, remote_sap):
+        assert(isinstance(remote_sap, self.sap_type))
+        _DEB('Client wants to connect to %s', remote_sap)
+        doorbell = self.__socket__(remote_sap)
+        try:
+            self.__channel = _ShmChannel.create(doorbell, self.__ring_size)
+        except:
+            doorbell.close()
+            raise
+        self.__remote = remote_sap
+        _DEB('Connected to server')
+
+    def disconnect(self):
+        _DEB('Terminate client channel...')
+        self.__remote = None
+        try:
+            self.__channel.close()
+        finally:
+            self.__channel = None
+
+    def send_request(self, request):
+        if not self.client_mode:
+            raise TransportNotConnected(self)
+        with self.__lock:
+            self.__channel.send_frame(request)
+            return self.__channel.read_frame()
+
+    def create_sap(self, *args, **kwargs):
+        return ShmSAP(*args, **kwargs)
+
+
+class ShmSAP(TransportSAP):
+    kind = 'shm'
+
+    def __init__(self, name=None):
+        self.__name = str(uuid.uuid4()) if name is None else name
+        _DEB('ShmSAP: %r', self.__name)
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def path(self):
+        """ Unix socket used to set up connections. """
+        return os.path.join(tempfile.gettempdir(),
+                            'potp-shm-%s.sock' % self.__name)
+
+    def __str__(self):
+        return 'shm@%s' % self.__name
+
+
+_TRANSPORTS = {
+    'tcp': _stream_transport(TCPTransport),
+    'tls': _stream_transport(TLSTransport,
+                             lambda qos: {'tls': qos.get('tls', None)}),
+    'unix': _stream_transport(UnixTransport),
+    'inproc': lambda qos: InprocTransport(qos.get('serialize', True)),
+    'shm': lambda qos: ShmTransport(qos.get('shm_ring_size', _SHM_RING_SIZE))
+    }
@@ -3,7 +3,6 @@
 import sys
 import logging
 logging.basicConfig(level=logging.DEBUG)
-import threading
 
 import potp.avatars
 from potp.avatars import avatar_property
@@ -39,12 +38,10 @@ client = endpoint.Client()
 server_object.avatar_attach(server)
 
 # Enable server
-server_thread = threading.Thread(target=server.server_loop)
-server_thread.start()
+server.start()
 
 print 'Wait for server becames ready...'
-while not server.server_enabled:
-    pass
+server.wait_ready()
 print 'Server listening in "%s"' % server.uri
 print 'Server object: %s' % server_object.avatar_uri
 
@@ -66,5 +63,4 @@ except ZeroDivisionError:
     print 'It works!'
 
 client.disconnect()
-server.stop_serving()
-server_thread.join()
+server.stop()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import cPickle
+import logging
+logging.basicConfig(level=logging.INFO)
+
+import potp.avatars
+from potp import endpoint
+from potp import transport
+
+def double(request):
+    return request * 2
+
+def fail(request):
+    raise ValueError(request)
+
+server = endpoint.Full()
+server.register_request_handler(double, 'double')
+server.register_request_handler(fail, 'fail')
+server.start()
+server.wait_ready()
+
+for qos in [{}, {'envelope': 'binary'}, {'pipelining': True}]:
+    client = endpoint.Client(qos)
+    client.connect(server.uri)
+    assert client.request_many([1, 2, 3]) == [2, 4, 6]
+    results = client.request_many([1, 2, 3, 4],
+                                  ['double', 'fail', 'unknown', None])
+    assert results[0] == 2
+    assert isinstance(results[1], ValueError)
+    assert isinstance(results[2], endpoint.RequestedHandlerNotFound)
+    assert results[3] == 8
+    assert client.request_many([]) == []
+    # Malformed batches are refused, connection is still usable
+    for batch in [[('double', 1, 2)], [(['double'], 1)], 7]:
+        try:
+            client.request(batch, 'potp-batch')
+        except endpoint.InvalidMessageFormat:
+            pass
+        else:
+            raise AssertionError('malformed batch %r accepted' % batch)
+    assert client.request(5, 'double') == 10
+    client.disconnect()
+
+# Many small avatar calls
+class Counter(potp.avatars.Avatar):
+    def __init__(self):
+        potp.avatars.Avatar.__init__(self)
+        self.__value = 0
+
+    def increment(self, value):
+        self.__value += value
+        return self.__value
+
+counter = Counter()
+counter.avatar_attach(server)
+client = endpoint.Client()
+client.connect(counter.avatar_uri)
+proxy = potp.avatars.AvatarProxy(client)
+proxy.attach_proxy()
+# One round trip for the whole batch, counted by the frames received
+def received_frames():
+    return server.transport.compression_stats['received_frames']
+
+frames = received_frames()
+for value in range(1000):
+    proxy.increment(1)
+one_by_one = received_frames() - frames
+first = proxy.increment(0) + 1
+frames = received_frames()
+results = proxy.proxy_batch([('increment', (1,), {})] * 1000 +
+                            [('missing', (), {})])
+batched = received_frames() - frames
+assert results[:1000] == range(first, first + 1000)
+assert isinstance(results[1000], AttributeError)
+print '1000 calls: %d frames, batched: %d frames' % (one_by_one, batched)
+assert one_by_one == 1000 and batched == 1, (one_by_one, batched)
+client.disconnect()
+server.stop()
+
+# Servers not aware of batches get requests one by one
+def old_server(request):
+    request = cPickle.loads(str(request))
+    if request['dest'] == 'potp-batch':
+        return cPickle.dumps(endpoint._ERROR['unknown destination'])
+    reply = {'src': None, 'dest': request['src'], 'ret': request['req'] * 3}
+    reply.update(endpoint._ERROR['no error'])
+    return cPickle.dumps(reply)
+
+sap = transport.TCPSAP('localhost')
+legacy = transport.TCPTransport()
+legacy.open(sap)
+legacy.bind(old_server)
+client = endpoint.Client()
+client.connect('potp://%s' % sap)
+assert client.request_many([1, 2]) == [3, 6]
+assert client.request_many([3]) == [9]
+client.disconnect()
+legacy.close()
+print 'It works!'
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import gc
+import time
+import logging
+logging.basicConfig(level=logging.INFO)
+
+import potp.avatars
+from potp.avatars import avatar_property, avatar_cached
+from potp import cache
+from potp import endpoint
+
+# Cache itself: LRU and TTL eviction, invalidation by key prefix
+results = cache.ResultCache(max_size=2)
+results.put(('a', (1,), 'dict'), 'one')
+results.put(('a', (2,), 'dict'), 'two')
+assert results.get(('a', (1,), 'dict')) == 'one'
+results.put(('b', (3,), 'dict'), 'three')
+assert results.get(('a', (2,), 'dict')) is None
+assert results.get(('a', (1,), 'dict')) == 'one'
+assert results.get(('a', ([],), 'dict')) is None
+assert results.invalidate('a', (2,)) == 0
+assert results.invalidate('a') == 1
+stats = results.stats
+assert stats['size'] == 1 and stats['evicted'] == 1
+assert stats['uncacheable'] == 1
+
+# Replies computed while invalidated are not stored
+generation = results.generation('b')
+results.invalidate('b')
+results.put(('b', (4,), 'dict'), 'outdated', generation)
+assert results.get(('b', (4,), 'dict')) is None
+assert results.stats['outdated'] == 1
+
+results = cache.ResultCache(ttl=0.2)
+results.put(('a', (1,), 'dict'), 'one')
+assert results.get(('a', (1,), 'dict')) == 'one'
+time.sleep(0.3)
+assert results.get(('a', (1,), 'dict')) is None
+assert results.stats['expired'] == 1
+
+# Server: replies of handlers giving a cache key are reused
+calls = []
+def square(request):
+    calls.append(request)
+    if request < 0:
+        raise ValueError(request)
+    return request * request
+
+server = endpoint.Full({'result_cache': {'max_size': 16}})
+server.register_request_handler(
+    square, 'square', cache_key=lambda request: (request,))
+server.register_request_handler(lambda request: time.time(), 'uncached')
+# State changes (and invalidates) while the reply is being computed
+racy_calls = []
+def racy(request):
+    racy_calls.append(request)
+    server.invalidate_cache('racy')
+    return len(racy_calls)
+server.register_request_handler(racy, 'racy',
+                                cache_key=lambda request: (request,))
+server.start()
+server.wait_ready()
+
+for qos in [{}, {'envelope': 'binary'}]:
+    del calls[:]
+    server.invalidate_cache('square')
+    client = endpoint.Client(qos)
+    client.connect(server.uri)
+    for repeat in range(3):
+        for value in range(4):
+            assert client.request(value, 'square') == value * value
+    assert calls == range(4), calls
+    # Exceptions are never cached
+    for repeat in range(2):
+        try:
+            client.request(-1, 'square')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('exception not raised')
+    assert calls.count(-1) == 2
+    assert client.request(None, 'uncached') != \
+        client.request(None, 'uncached')
+    server.invalidate_cache('square', (2,))
+    assert client.request(2, 'square') == 4
+    assert calls[-1] == 2
+    del racy_calls[:]
+    assert client.request('a', 'racy') == 1
+    assert client.request('a', 'racy') == 2
+    client.disconnect()
+
+stats = server.cache_stats
+print 'Cache: %s' % stats
+assert stats['hits'] == 16, stats
+assert endpoint.Server().cache_stats is None
+
+# Cached replies of protocols marshalling to segments are sent as they are
+for protocol in ['marshal', 'oob']:
+    qos = {'protocol': protocol, 'result_cache': {'max_size': 16}}
+    protocol_server = endpoint.Full(qos)
+    protocol_server.register_request_handler(
+        lambda request: set([request]), 'echo',
+        cache_key=lambda request: (request,))
+    protocol_server.start()
+    protocol_server.wait_ready()
+    client = endpoint.Client({'protocol': protocol})
+    client.connect(protocol_server.uri)
+    for repeat in range(2):
+        assert client.request(1, 'echo') == set([1])
+    assert protocol_server.cache_stats['hits'] == 1
+    client.disconnect()
+    protocol_server.stop()
+
+# Avatars: cached members until the avatar invalidates them
+class Account(potp.avatars.Avatar):
+    def __init__(self):
+        potp.avatars.Avatar.__init__(self)
+        self.__balance = 0
+        self.reports = 0
+
+    @avatar_property
+    @avatar_cached
+    def balance(self):
+        return self.__balance
+
+    @avatar_cached
+    def report(self, months=1):
+        self.reports += 1
+        if months < 1:
+            raise ValueError(months)
+        return 'Balance %s after %d months' % (self.__balance, months)
+
+    def deposit(self, amount):
+        self.__balance += amount
+        self.avatar_invalidate()
+        return self.__balance
+
+account = Account()
+assert sorted(account.avatar_cached) == ['balance', 'report']
+account.avatar_attach(server)
+client = endpoint.Client()
+client.connect(account.avatar_uri)
+proxy = potp.avatars.AvatarProxy(client)
+proxy.attach_proxy()
+assert proxy.balance == 0
+assert proxy.report(months=3) == proxy.report(months=3)
+assert proxy.report(months=2) != proxy.report(months=3)
+assert account.reports == 2
+for repeat in range(2):
+    try:
+        proxy.report(0)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('exception not raised')
+assert account.reports == 4
+assert proxy.deposit(10) == 10
+assert proxy.balance == 10
+assert proxy.report(months=3) == 'Balance 10 after 3 months'
+assert account.reports == 5
+client.disconnect()
+
+# Replies of collected avatars are discarded with them
+weak_account = Account()
+weak_account.avatar_attach(server, weak=True)
+client.connect(weak_account.avatar_uri)
+proxy = potp.avatars.AvatarProxy(client)
+proxy.attach_proxy()
+assert proxy.balance == 0
+size = server.cache_stats['size']
+del weak_account, proxy
+gc.collect()
+# Dead handlers are evicted by the next registry access
+assert server.handler_stats['evicted'] == 1
+assert server.cache_stats['size'] == size - 1
+client.disconnect()
+server.stop()
+print 'It works!'
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.INFO)
+
+from potp import endpoint
+
+def process_request(request):
+    print 'Echo: %s items' % len(request)
+    return request
+
+big = ['item %s ' % number * 1000 for number in range(1000)]
+
+for server_qos, client_qos in [
+        ({}, {'chunk_size': 65536}),
+        ({'server_engine': 'eventloop'}, {'chunk_size': 65536}),
+        ({}, {'chunk_size': 65536, 'pipelining': True}),
+        ({}, {'chunk_size': 65536, 'compression': 'zlib'})]:
+    print 'QoS: %s -> %s' % (server_qos, client_qos)
+    server = endpoint.Full(server_qos)
+    server.register_request_handler(process_request)
+    server.start()
+    server.wait_ready()
+
+    client = endpoint.Client(client_qos)
+    client.connect(server.uri)
+    assert client.request(big) == big
+    assert client.request('small') == 'small'
+
+    client.disconnect()
+    server.stop()
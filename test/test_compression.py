@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+from potp import transport
+
+sap = transport.TCPSAP('localhost')
+
+server = transport.TCPTransport()
+legacy = transport.TCPTransport()
+zlib_client = transport.TCPTransport(compression='zlib')
+bz2_client = transport.TCPTransport(compression='bz2', pipelining=True)
+
+def process_request(request):
+    print 'Echo: %s bytes' % len(request)
+    return request
+
+server.open(sap)
+server.bind(process_request)
+
+big = 'repetitive payload ' * 100000
+for client in [legacy, zlib_client, bz2_client]:
+    client.connect(sap)
+    assert client.send_request('small') == 'small'
+    assert client.send_request(big) == big
+    print 'Client stats: %s' % client.compression_stats
+    client.disconnect()
+
+stats = zlib_client.compression_stats
+assert stats['sent_compressed'] == 1 and stats['received_compressed'] == 1
+assert stats['sent_ratio'] > 10
+print 'Server stats: %s' % server.compression_stats
+
+server.close()
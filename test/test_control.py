@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.INFO)
+
+from potp import endpoint
+from potp import metrics
+from potp import transport
+from potp import protocols
+
+collected = metrics.Metrics()
+server = endpoint.Full({'metrics': collected})
+
+def process_request(request):
+    return request
+
+server.register_request_handler(process_request, 'echo')
+server.start()
+server.wait_ready()
+
+# Malformed and misrouted requests get the same pre-marshalled replies
+raw = transport.TCPTransport()
+raw.connect(server.transport.sap)
+replies = [raw.send_request(request) for request in
+           ['', 'garbage', protocols.PIP.marshall('not a dict'), '']]
+assert replies[0] == replies[1] == replies[2] == replies[3]
+reply = protocols.PIP.unmarshall(replies[0])
+assert isinstance(reply['exception'], endpoint.InvalidMessageFormat)
+unknown = protocols.PIP.marshall({'req': 1, 'src': 'me', 'dest': 'nobody'})
+assert raw.send_request(unknown) == raw.send_request(unknown)
+assert isinstance(protocols.PIP.unmarshall(raw.send_request(unknown))[
+    'exception'], endpoint.RequestedHandlerNotFound)
+raw.disconnect()
+
+# Anonymous binary envelope requests are refused without decoding them
+client = endpoint.Client({'envelope': 'binary'})
+client.set_anonymous(True)
+client.connect(server.uri)
+try:
+    client.request('anonymous')
+except endpoint.AnonymousMessage:
+    print 'It works!'
+client.disconnect()
+server.stop()
+
+counters = collected.snapshot()['counters']
+assert counters['server_rejected{reason="invalid message"}'] == 4
+assert counters['server_errors{handler="nobody"}'] == 3
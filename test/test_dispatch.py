@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import logging
+logging.basicConfig(level=logging.DEBUG)
+import threading
+
+from potp import endpoint
+
+def slow_request(request):
+    time.sleep(0.1)
+    return request
+
+def run(engine, overload):
+    server = endpoint.Full({'server_engine': engine,
+                            'dispatch': {'workers': 2,
+                                         'queue_size': 2,
+                                         'overload': overload}})
+    server.register_request_handler(slow_request)
+    server.start()
+    server.wait_ready()
+
+    clients = [endpoint.Client() for number in range(8)]
+    for client in clients:
+        client.connect(server.uri)
+    results = []
+    def caller(client, number):
+        try:
+            results.append(client.request(number))
+        except endpoint.ServerOverloaded:
+            results.append('overloaded')
+    callers = [threading.Thread(target=caller, args=(client, number))
+               for number, client in enumerate(clients)]
+    for thread in callers:
+        thread.start()
+    for thread in callers:
+        thread.join()
+    for client in clients:
+        client.disconnect()
+    stats = server.dispatch_stats
+    server.stop()
+
+    print '%s/%s: %s' % (engine, overload, results)
+    print 'Stats: %s' % stats
+    assert len(results) == 8
+    assert stats['max_queue_depth'] <= 2
+    if overload == 'reject':
+        assert 'overloaded' in results
+        assert stats['rejected'] == results.count('overloaded')
+    else:
+        assert sorted(results) == range(8)
+        assert stats['paused'] > 0
+
+for engine in ['threading', 'eventloop']:
+    for overload in ['reject', 'backpressure']:
+        run(engine, overload)
@@ -3,7 +3,6 @@
 import sys
 import logging
 logging.basicConfig(level=logging.DEBUG)
-import threading
 
 from potp import endpoint
 
@@ -15,12 +14,10 @@ def process_request(request):
     return request
 
 server.register_request_handler(process_request)
-server_thread = threading.Thread(target=server.server_loop)
-server_thread.start()
+server.start()
 
 print 'Wait for server becames ready...'
-while not server.server_enabled:
-    pass
+server.wait_ready()
 
 print 'Server listening in "%s"' % server.uri
 client.connect(server.uri)
@@ -29,5 +26,4 @@ reply = client.request({})
 print 'Reply: %s' % reply
 
 client.disconnect()
-server.stop_serving()
-server_thread.join()
+server.stop()
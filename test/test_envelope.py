@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.INFO)
+
+import potp.avatars
+from potp import endpoint
+from potp import envelope
+
+class Counter(potp.avatars.Avatar):
+    def __init__(self):
+        potp.avatars.Avatar.__init__(self)
+        self.__count = 0
+
+    def increment(self, value):
+        self.__count += value
+        return self.__count
+
+def echo(request):
+    if request == 'raise':
+        raise KeyError(request)
+    return request
+
+for qos in [{}, {'transport': 'inproc'},
+            {'transport': 'inproc', 'serialize': False}]:
+    server = endpoint.Full(qos)
+    default = server.register_request_handler(echo)
+    counter = Counter()
+    counter.avatar_attach(server)
+    server.start()
+    server.wait_ready()
+
+    binary = dict(qos, envelope='binary')
+    # Default handler: no handler ID is sent at all
+    client = endpoint.Client(binary)
+    client.connect(server.uri)
+    assert client.request('hello') == 'hello'
+    try:
+        client.request('raise')
+    except KeyError:
+        pass
+    else:
+        raise AssertionError('handler exception not raised')
+    client.disconnect()
+
+    # Avatars: handle is learned in the attach request
+    client = endpoint.Client(binary)
+    client.connect(counter.avatar_uri)
+    proxy = potp.avatars.AvatarProxy(client)
+    proxy.attach_proxy()
+    assert proxy.increment(2) == 2
+    assert proxy.increment(3) == 5
+
+    # Messages of stale handles are refused, client resolves them again
+    handles = client._Client__handles
+    if qos.get('serialize', True):
+        handle = handles[counter.avatar_uri.split('/')[-1]]
+        assert handle == server.handle_of(counter.avatar_uri.split('/')[-1])
+        handles[handles.keys()[0]] = handle ^ (1 << 32)
+        assert proxy.increment(1) == 6
+        assert handles.values()[0] == handle
+    else:
+        # Nothing is serialized, there is no envelope at all
+        assert not handles
+    client.disconnect()
+
+    # Envelope errors of unknown handlers tell their ID
+    client = endpoint.Client(binary)
+    client.connect(server.uri)
+    for attempt in range(2):
+        try:
+            client.request(1, 'not-registered')
+        except endpoint.RequestedHandlerNotFound, e:
+            assert 'not-registered' in str(e) or \
+                not qos.get('serialize', True), str(e)
+        else:
+            raise AssertionError('unknown handler reached')
+    client.disconnect()
+
+    # Dict envelope clients are still served
+    client = endpoint.Client(qos)
+    client.connect(server.uri)
+    assert client.request('dict') == 'dict'
+    client.disconnect()
+    server.stop()
+
+# Binary envelope is smaller than the dict one
+request = {'req': 1, 'src': endpoint.Endpoint().id, 'dest': default}
+message = envelope.pack(envelope.REQUEST, 0, server.handle_of(default),
+                        endpoint.protocols.PIP.marshall(1))
+print 'Envelope: dict %s bytes, binary %s bytes' % (
+    len(endpoint.protocols.PIP.marshall(request)), len(message))
+assert len(message) < len(endpoint.protocols.PIP.marshall(request)) / 4
+print 'It works!'
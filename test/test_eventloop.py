@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+from potp import transport
+
+sap = transport.TCPSAP('localhost')
+
+server = transport.TCPTransport(engine='eventloop')
+clients = [transport.TCPTransport() for i in range(10)]
+
+def process_request(request):
+    print 'Echo: %s' % request
+    return request
+
+server.open(sap)
+server.bind(process_request)
+
+for client in clients:
+    client.connect(sap)
+
+for number, client in enumerate(clients):
+    assert client.send_request('request %s' % number) == 'request %s' % number
+
+big = 'x' * (1024 * 1024)
+assert clients[0].send_request(big) == big
+
+for client in clients:
+    client.disconnect()
+server.close()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import time
+import threading
+import logging
+logging.basicConfig(level=logging.INFO)
+
+from potp import endpoint
+from potp import futures
+from potp import pool
+
+def slow_double(request):
+    if request < 0:
+        raise ValueError(request)
+    time.sleep(0.05)
+    return request * 2
+
+server = endpoint.Full({'server_engine': 'eventloop',
+                        'dispatch': {'workers': 50, 'queue_size': 400}})
+server.register_request_handler(slow_double)
+server.start()
+server.wait_ready()
+
+# Requests in flight from one thread: no more than a few round trips
+for qos in [{'pipelining': True},
+            {'pipelining': True, 'envelope': 'binary'}]:
+    client = endpoint.Client(qos)
+    client.connect(server.uri)
+    threads = threading.active_count()
+    started = time.time()
+    pending = [client.request_async(value) for value in range(200)]
+    assert threading.active_count() == threads
+    done, not_done = futures.wait(pending, timeout=30)
+    elapsed = time.time() - started
+    print '%r: 200 requests in %.2f seconds' % (qos, elapsed)
+    assert not not_done
+    assert elapsed < 200 * 0.05 / 4
+    assert [future.result() for future in pending] == range(0, 400, 2)
+    # Handler exceptions are raised by result()
+    failed = client.request_async(-1)
+    try:
+        failed.result(timeout=5)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('exception not raised')
+    assert isinstance(failed.exception(), ValueError)
+    client.disconnect()
+
+# Callbacks may send requests on the same connection
+client = endpoint.Client({'pipelining': True})
+client.connect(server.uri)
+nested = []
+first = client.request_async(1)
+first.add_done_callback(lambda done: nested.append(client.request(10)))
+assert first.result(timeout=5) == 2
+assert client.request_async(4).result(timeout=5) == 8
+deadline = time.time() + 5
+while not nested and time.time() < deadline:
+    time.sleep(0.01)
+assert nested == [20], nested
+client.disconnect()
+
+# Lockstep clients reply before returning
+client = endpoint.Client()
+client.connect(server.uri)
+future = client.request_async(21)
+assert future.done()
+assert future.result() == 42
+replies = []
+future.add_done_callback(lambda done: replies.append(done.result()))
+assert replies == [42]
+client.disconnect()
+
+# Pooled clients borrow a connection per request in flight
+client = endpoint.Client({'connection_pool': {'max_size': 4}})
+client.connect(server.uri)
+pending = [client.request_async(value) for value in range(8)]
+assert [future.result(timeout=5) for future in pending] == range(0, 16, 2)
+assert client.pool.stats['in_use'] == 0
+client.disconnect()
+pool.close_pools()
+
+# Broken connections fail every request in flight
+client = endpoint.Client({'pipelining': True})
+client.connect(server.uri)
+pending = client.request_async(1)
+server.stop()
+try:
+    pending.result(timeout=5)
+except Exception, e:
+    print 'Failed: %r' % e
+try:
+    client.request_async(1).result(timeout=5)
+except Exception, e:
+    print 'Failed: %r' % e
+else:
+    raise AssertionError('request to stopped server succeeded')
+client.disconnect()
+print 'It works!'
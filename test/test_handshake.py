@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.INFO)
+
+from potp import transport
+from potp import endpoint
+from potp import pool
+
+# Transport level: features are chosen by the handshake
+def process_request(request):
+    return request
+
+for engine in ['threading', 'eventloop']:
+    sap = transport.TCPSAP('localhost')
+    server = transport.TCPTransport(engine=engine, compression='zlib',
+                                    protocol='marshal',
+                                    max_frame_size=1024 * 1024)
+    server.open(sap)
+    server.bind(process_request)
+
+    client = transport.TCPTransport(handshake=True, pipelining=True)
+    client.connect(sap)
+    print '%s: %s' % (engine, client.negotiated)
+    assert client.negotiated['protocol'] == 'marshal'
+    assert client.negotiated['compression'] == 'zlib'
+    assert client.negotiated['pipelining']
+    assert client.max_frame_size == 1024 * 1024
+    big = 'repetitive payload ' * 100000
+    assert client.send_request(big) == big
+    assert client.compression_stats['sent_compressed'] == 1
+    try:
+        client.send_request(os.urandom(2 * 1024 * 1024))
+    except transport.TransportError:
+        pass
+    else:
+        raise AssertionError('frame bigger than max frame size sent')
+    client.disconnect()
+
+    # Clients without handshake keep working
+    legacy = transport.TCPTransport()
+    legacy.connect(sap)
+    assert legacy.negotiated is None
+    assert legacy.send_request('legacy') == 'legacy'
+    legacy.disconnect()
+    server.close()
+
+# Servers not aware of handshakes reply offers as requests
+import socket
+import threading
+import cPickle
+
+listener = socket.socket()
+listener.bind(('localhost', 0))
+listener.listen(1)
+port = listener.getsockname()[1]
+
+def old_server():
+    connection, address = listener.accept()
+    reader = transport._FrameReader(connection)
+    while True:
+        try:
+            request_id, flags, request = reader.read()
+        except transport.TransportError:
+            break
+        if cPickle.loads(str(request)).get('dest', None) is not None:
+            request = cPickle.dumps({'error': True, 'exception': KeyError()})
+        transport.__send_frame__(connection, request, request_id)
+    connection.close()
+
+old_server_thread = threading.Thread(target=old_server)
+old_server_thread.start()
+client = transport.TCPTransport(handshake=True, pipelining=True)
+client.connect(transport.TCPSAP('localhost', port))
+assert client.negotiated is None
+assert client.pipelining
+request = cPickle.dumps({'dest': None})
+assert client.send_request(request) == request
+client.disconnect()
+old_server_thread.join()
+listener.close()
+
+# Endpoint level: client switches to the server protocol
+def echo(request):
+    return request
+
+server = endpoint.Full({'protocol': 'marshal'})
+server.register_request_handler(echo)
+server.start()
+server.wait_ready()
+
+client = endpoint.Client({'handshake': True})
+client.connect(server.uri)
+assert client.request({'a': [1, 2]}) == {'a': [1, 2]}
+assert client.transport.negotiated['protocol'] == 'marshal'
+client.disconnect()
+
+pooled = endpoint.Client({'handshake': True,
+                          'connection_pool': {'max_size': 2}})
+pooled.connect(server.uri)
+assert pooled.request('pooled') == 'pooled'
+pooled.disconnect()
+pool.close_pools()
+server.stop()
+print 'It works!'
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import potp.avatars
+from potp import endpoint
+
+class Counter(potp.avatars.Avatar):
+    def __init__(self):
+        potp.avatars.Avatar.__init__(self)
+        self.__count = 0
+
+    def increment(self, value):
+        self.__count += value
+        return self.__count
+
+for qos in [{'transport': 'inproc'},
+            {'transport': 'inproc', 'serialize': False}]:
+    print 'QoS: %s' % qos
+    server = endpoint.Full(qos)
+    client = endpoint.Client(qos)
+
+    server_object = Counter()
+    server_object.avatar_attach(server)
+
+    server.start()
+    server.wait_ready()
+    print 'Server object: %s' % server_object.avatar_uri
+
+    client.connect(server_object.avatar_uri)
+    client_object = potp.avatars.AvatarProxy(client)
+    client_object.attach_proxy()
+    print 'increment(5):', client_object.increment(5)
+    assert client_object.increment(5) == 10
+
+    client.disconnect()
+    server.stop()
+
+# Both sides must agree on serialization
+server = endpoint.Full({'transport': 'inproc', 'serialize': False})
+server.start()
+server.wait_ready()
+try:
+    endpoint.Client().connect(server.uri)
+except potp.transport.TransportError:
+    print 'It works!'
+server.stop()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import logging
+logging.basicConfig(level=logging.DEBUG)
+import threading
+
+from potp import endpoint
+
+server = endpoint.Full({'shutdown_timeout': 5.0})
+client = endpoint.Client()
+received = threading.Event()
+
+def slow_request(request):
+    received.set()
+    time.sleep(0.5)
+    return request
+
+server.register_request_handler(slow_request)
+server.start()
+assert server.wait_ready(5.0)
+print 'Server listening in "%s"' % server.uri
+client.connect(server.uri)
+
+replies = []
+caller = threading.Thread(target=lambda: replies.append(client.request('slow')))
+caller.start()
+received.wait()
+
+# In-flight request is answered before the transport is closed
+print 'Stopping with %d request(s) in flight' % server.in_flight
+server.stop()
+caller.join()
+print 'Reply: %s' % replies
+assert replies == ['slow']
+assert server.in_flight == 0
+assert not server.wait_ready(0.1)
+client.disconnect()
+
+def serve_slow_request():
+    server.start()
+    assert server.wait_ready(5.0)
+    client.connect(server.uri)
+    received.clear()
+    del replies[:]
+    caller = threading.Thread(
+        target=lambda: replies.append(client.request('slow')))
+    caller.start()
+    received.wait()
+    return caller
+
+# Timeout given to stop() is only used by that stop
+warnings = []
+class WarningsHandler(logging.Handler):
+    def emit(self, record):
+        warnings.append(record.getMessage())
+logging.getLogger('potp.endpoint').addHandler(
+    WarningsHandler(logging.WARNING))
+
+caller = serve_slow_request()
+server.stop(timeout=0.1)
+caller.join()
+client.disconnect()
+assert warnings == ['Server stops with 1 requests in flight'], warnings
+assert server.shutdown_timeout == 5.0
+
+caller = serve_slow_request()
+server.stop()
+assert server.in_flight == 0
+caller.join()
+assert replies == ['slow']
+assert len(warnings) == 1
+client.disconnect()
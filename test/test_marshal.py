@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.INFO)
+
+from potp import endpoint
+from potp import protocols
+
+protocol = protocols.get_protocol({'protocol': 'marshal'})
+assert isinstance(protocol, protocols.MarshalPIP)
+
+primitive = {'req': [1, 2L, 3.0, 'abc', u'd\xe9f', (None, True), set([1])],
+             'src': 'me', 'dest': None}
+marshalled = protocol.marshall(primitive)
+assert marshalled[:1] == '\xfe'
+assert protocol.unmarshall(bytearray(marshalled)) == primitive
+
+# Objects marshal would change (or reject) are pickled
+for other in [bytearray('abc'), {'error': True, 'exception': ValueError()},
+              [1, [2, [object.__class__]]]]:
+    marshalled = protocol.marshall(other)
+    assert str(marshalled)[:1] == '\xff'
+    unmarshalled = protocol.unmarshall(bytearray(str(marshalled)))
+    assert type(unmarshalled) is type(other)
+
+# Untagged messages are PIP ones
+assert protocol.unmarshall(protocols.PIP.marshall(primitive)) == primitive
+
+# PIP wire format is the default pickle protocol, as older peers send it
+import pickle
+assert protocols.PIP.marshall(primitive) == pickle.dumps(primitive)
+assert protocols.PIP.unmarshall(pickle.dumps(primitive)) == primitive
+
+def process_request(request):
+    if request == 'raise':
+        raise KeyError(request)
+    return request
+
+server = endpoint.Full({'protocol': 'marshal'})
+client = endpoint.Client({'protocol': 'marshal'})
+server.register_request_handler(process_request)
+server.start()
+server.wait_ready()
+client.connect(server.uri)
+
+assert client.request(primitive) == primitive
+assert client.request(bytearray('xyz')) == bytearray('xyz')
+try:
+    client.request('raise')
+except KeyError:
+    print 'It works!'
+
+client.disconnect()
+server.stop()
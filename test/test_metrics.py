@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.INFO)
+
+from potp import endpoint
+from potp import metrics
+
+collected = metrics.Metrics()
+server = endpoint.Full({'metrics': collected})
+client = endpoint.Client({'metrics': collected})
+
+def process_request(request):
+    return 1.0 / request
+
+server.register_request_handler(process_request, 'inverse')
+server.start()
+server.wait_ready()
+client.connect(server.uri)
+
+for number in range(1, 11):
+    assert client.request(number) == 1.0 / number
+try:
+    client.request(0)
+except ZeroDivisionError:
+    print 'It works!'
+
+client.disconnect()
+server.stop()
+
+snapshot = collected.snapshot()
+print collected.export()
+counters = snapshot['counters']
+assert counters['server_requests{handler="inverse"}'] == 11
+assert counters['server_errors{handler="inverse"}'] == 1
+assert counters['client_requests{handler="None"}'] == 11
+assert counters['transport_frames{direction="sent"}'] == 22
+assert counters['server_bytes_in'] == counters['client_bytes_out']
+assert snapshot['gauges']['server_in_flight'] == 0
+latency = snapshot['histograms']['server_latency_seconds{handler="inverse"}']
+assert latency['count'] == 11
+assert 'transport_frame_bytes_bucket{direction="received",le="+Inf"} 22' in \
+    collected.export()
+
+# Endpoints without metrics do not collect anything
+assert endpoint.Client().metrics is None
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import time
+import threading
+import logging
+logging.basicConfig(level=logging.INFO)
+
+import potp.avatars
+from potp.avatars import avatar_property, avatar_oneway
+from potp import transport
+from potp import endpoint
+
+# Transport level: no reply frame is sent back
+received = []
+def process_request(request):
+    received.append(str(request))
+    return 'reply of %s' % request
+
+for engine in ['threading', 'eventloop']:
+    del received[:]
+    sap = transport.TCPSAP('localhost')
+    server = transport.TCPTransport(engine=engine)
+    server.open(sap)
+    server.bind(process_request)
+    for pipelining in [False, True]:
+        client = transport.TCPTransport(handshake=True, pipelining=pipelining)
+        client.connect(sap)
+        assert client.negotiated['oneway']
+        for number in range(10):
+            client.send_oneway('oneway %s' % number)
+        # Lockstep clients would read a wrong reply if one was sent
+        assert client.send_request('last') == 'reply of last'
+        client.disconnect()
+    assert received == (['oneway %s' % number for number in range(10)] +
+                        ['last']) * 2, received
+    # Without handshake, reply is received and dropped
+    legacy = transport.TCPTransport()
+    legacy.connect(sap)
+    legacy.send_oneway('legacy')
+    assert legacy.send_request('last') == 'reply of last'
+    legacy.disconnect()
+    server.close()
+
+# Endpoint level
+events = []
+def record(request):
+    if request == 'fail':
+        raise ValueError(request)
+    events.append(request)
+    return len(events)
+
+server = endpoint.Full({'server_engine': 'eventloop'})
+server.register_request_handler(record, 'record')
+server.start()
+server.wait_ready()
+
+for qos in [{}, {'handshake': True}, {'handshake': True, 'pipelining': True},
+            {'handshake': True, 'envelope': 'binary'}]:
+    del events[:]
+    client = endpoint.Client(qos)
+    client.connect(server.uri)
+    assert client.notify('first') is None
+    client.notify('fail')
+    client.notify('second')
+    assert client.request('third') == 3, qos
+    assert events == ['first', 'second', 'third'], events
+    client.disconnect()
+
+# Handles of re-registered handlers change: one-way requests still arrive
+client = endpoint.Client({'handshake': True, 'envelope': 'binary'})
+client.connect(server.uri)
+del events[:]
+server.register_request_handler(record, 'x')
+assert client.request('learn', 'x') == 1
+server.unregister_handler('x')
+# Slot of "x" is taken by another handler
+server.register_request_handler(record, 'y')
+server.register_request_handler(record, 'x')
+for number in range(3):
+    client.notify('after %s' % number, 'x')
+assert client.request('last', 'x') == 5
+assert events == ['learn', 'after 0', 'after 1', 'after 2', 'last'], events
+client.disconnect()
+
+# One-way avatar methods
+class Counter(potp.avatars.Avatar):
+    def __init__(self, value):
+        potp.avatars.Avatar.__init__(self)
+        self.__value = value
+
+    @avatar_property
+    def value(self):
+        return self.__value
+
+    @avatar_oneway
+    def increment(self, value):
+        time.sleep(0.5)
+        self.__value += value
+        return self.__value
+
+counter = Counter(10)
+counter.avatar_attach(server)
+client = endpoint.Client({'handshake': True, 'pipelining': True})
+client.connect(counter.avatar_uri)
+proxy = potp.avatars.AvatarProxy(client)
+proxy.attach_proxy()
+started = time.time()
+assert proxy.increment(5) is None
+assert time.time() - started < 0.5
+assert proxy.value == 15
+client.disconnect()
+server.stop()
+print 'It works!'
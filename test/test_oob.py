@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.INFO)
+
+from potp import endpoint
+from potp import protocols
+
+blob = 'x' * (4 * 1024 * 1024)
+array = bytearray('y' * 65536)
+message = {'blob': blob, 'array': array, 'view': memoryview(array)[:1024],
+           'small': 'abc'}
+
+# Big buffers are segments of the message, not copies in the pickle stream
+marshalled = protocols.OutOfBandPIP.marshall(message)
+assert any(segment is blob for segment in marshalled.segments)
+assert len(marshalled.segments[1]) < 1024
+received = protocols.OutOfBandPIP.unmarshall(bytearray(str(marshalled)))
+assert received['blob'] == blob and type(received['blob']) is str
+assert received['array'] == array and type(received['array']) is bytearray
+assert str(received['view']) == str(array[:1024])
+assert type(received['view']) is buffer
+assert received['small'] == 'abc'
+
+def process_request(request):
+    return dict((key, (type(value).__name__, len(value)))
+                for key, value in request.items())
+
+for qos in [{'protocol': 'oob'},
+            {'protocol': 'oob', 'server_engine': 'eventloop'},
+            {'protocol': 'oob', 'transport': 'inproc'}]:
+    server = endpoint.Full(qos)
+    client = endpoint.Client(qos)
+    server.register_request_handler(process_request)
+    server.start()
+    server.wait_ready()
+    client.connect(server.uri)
+    reply = client.request(message)
+    print '%s: %s' % (qos, reply)
+    # In-process messages are not transmitted: views are not rebuilt
+    view = 'memoryview' if qos.get('transport') == 'inproc' else 'buffer'
+    assert reply == {'blob': ('str', len(blob)),
+                     'array': ('bytearray', len(array)),
+                     'view': (view, 1024),
+                     'small': ('str', 3)}
+    client.disconnect()
+    server.stop()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.DEBUG)
+import threading
+
+from potp import transport
+from potp import endpoint
+
+# Transport level: many threads share one connection
+sap = transport.TCPSAP('localhost')
+
+server = transport.TCPTransport(engine='eventloop')
+client = transport.TCPTransport(pipelining=True)
+
+def process_request(request):
+    print 'Echo: %s' % request
+    return request
+
+server.open(sap)
+server.bind(process_request)
+client.connect(sap)
+
+def caller(number):
+    for request in range(20):
+        request = 'thread %s request %s' % (number, request)
+        assert client.send_request(request) == request
+
+callers = [threading.Thread(target=caller, args=(number,))
+           for number in range(8)]
+for thread in callers:
+    thread.start()
+for thread in callers:
+    thread.join()
+
+client.disconnect()
+server.close()
+
+# Corrupt reply frame: waiting requests fail instead of hanging
+import time
+import socket
+listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+listener.bind(('localhost', 0))
+listener.listen(1)
+def corrupt_server():
+    connection, address = listener.accept()
+    time.sleep(0.2)
+    transport.__send_frame__(
+        connection, 'not zlib data', 1, transport._XFLAG_COMPRESSED |
+        transport._CODECS['zlib'][0] << transport._XFLAG_CODEC_SHIFT)
+    time.sleep(1)
+    connection.close()
+corrupter = threading.Thread(target=corrupt_server)
+corrupter.start()
+client = transport.TCPTransport(pipelining=True)
+client.connect(transport.TCPSAP('localhost', listener.getsockname()[1]))
+try:
+    client.send_request('corrupt')
+except transport.TransportError, e:
+    print 'Failed: %s' % e
+else:
+    raise AssertionError('corrupt reply accepted')
+assert not client.healthy
+client.disconnect()
+corrupter.join()
+listener.close()
+
+# Endpoint level: legacy and pipelined clients on the same server
+server = endpoint.Full()
+server.register_request_handler(process_request)
+server.start()
+server.wait_ready()
+
+legacy = endpoint.Client()
+pipelined = endpoint.Client({'pipelining': True})
+legacy.connect(server.uri)
+pipelined.connect(server.uri)
+print 'Reply: %s' % legacy.request('legacy')
+print 'Reply: %s' % pipelined.request('pipelined')
+
+legacy.disconnect()
+pipelined.disconnect()
+server.stop()
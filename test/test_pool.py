@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.DEBUG)
+import threading
+
+from potp import endpoint
+from potp import pool
+
+server = endpoint.Full()
+
+def process_request(request):
+    print 'Echo: %s' % request
+    return request
+
+server.register_request_handler(process_request)
+server.start()
+
+print 'Wait for server becames ready...'
+server.wait_ready()
+
+client = endpoint.Client({'connection_pool': {'min_size': 1,
+                                              'max_size': 4}})
+client.connect(server.uri)
+
+def caller(number):
+    for request in range(10):
+        request = 'thread %s request %s' % (number, request)
+        assert client.request(request) == request
+
+callers = [threading.Thread(target=caller, args=(number,))
+           for number in range(8)]
+for thread in callers:
+    thread.start()
+for thread in callers:
+    thread.join()
+
+stats = client.pool.stats
+print 'Pool stats: %s' % stats
+assert stats['size'] <= 4
+assert stats['checkouts'] == 80
+
+# Clients with other connection settings do not share the pool
+other = endpoint.Client({'connection_pool': {'min_size': 1,
+                                             'max_size': 4},
+                         'handshake': True})
+other.connect(server.uri)
+assert other.pool is not client.pool
+assert other.request('handshake') == 'handshake'
+other.disconnect()
+
+# Same settings with other pool options is refused
+other = endpoint.Client({'connection_pool': {'max_size': 2}})
+try:
+    other.connect(server.uri)
+except pool.PoolOptionsMismatch:
+    pass
+else:
+    raise AssertionError('pool options mismatch not detected')
+
+client.disconnect()
+pool.close_pools()
+server.stop()
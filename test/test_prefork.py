@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+logging.basicConfig(level=logging.INFO)
+
+from potp import endpoint
+from potp import prefork
+
+def process_request(request):
+    return os.getpid()
+
+def setup(server):
+    # Runs in every worker process
+    server.register_request_handler(process_request)
+
+server = prefork.PreforkServer(setup, workers=2)
+server.start()
+assert server.wait_ready(10.0)
+print 'Workers %s listening in "%s"' % (server.pids, server.uri)
+
+def served_by():
+    client = endpoint.Client()
+    client.connect(server.uri)
+    try:
+        return client.request(None)
+    finally:
+        client.disconnect()
+
+pids = set(served_by() for number in range(20))
+print 'Served by: %s' % pids
+assert pids <= set(server.pids)
+assert os.getpid() not in pids
+
+stats = server.stats
+print 'Stats: %s' % stats
+assert stats['workers'] == 2
+
+# Late answers of timed out queries are dropped, waits are bounded
+parent, worker = socket.socketpair()
+partial = {}
+worker.sendall('1 {"late": true}\n2 {"in_fli')
+started = time.time()
+assert prefork.__read_answers__({42: parent}, 2, 0.5, partial) == {}
+assert time.time() - started < 1.0
+assert partial == {42: '2 {"in_fli'}
+worker.sendall('ght": 0}\n2 {"in_flight": 1}\n3 {"in_flight": 2}\n')
+assert prefork.__read_answers__({42: parent}, 3, 0.5, partial) == {
+    42: {'in_flight': 2}}
+parent.close()
+worker.close()
+
+# Dead workers are restarted
+os.kill(server.pids[0], signal.SIGKILL)
+while server.stats['restarts'] == 0:
+    time.sleep(0.1)
+assert server.wait_ready(10.0)
+assert served_by() in server.pids
+print 'Workers after restart: %s' % server.pids
+
+server.stop()
+
+# Workers exit when their parent dies without stopping them
+def running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    try:
+        # Zombies are not reaped until their new parent waits for them
+        with open('/proc/%d/stat' % pid) as stat:
+            return stat.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+reader, writer = os.pipe()
+parent_pid = os.fork()
+if parent_pid == 0:
+    os.close(reader)
+    orphans = prefork.PreforkServer(setup, workers=2)
+    orphans.start()
+    orphans.wait_ready(10.0)
+    os.write(writer, ' '.join(str(pid) for pid in orphans.pids) + '\n')
+    while True:
+        time.sleep(1.0)
+os.close(writer)
+orphans = [int(pid) for pid in os.fdopen(reader).readline().split()]
+assert len(orphans) == 2 and all(running(pid) for pid in orphans)
+os.kill(parent_pid, signal.SIGKILL)
+os.waitpid(parent_pid, 0)
+deadline = time.time() + 10.0
+while any(running(pid) for pid in orphans) and time.time() < deadline:
+    time.sleep(0.1)
+assert not any(running(pid) for pid in orphans), orphans
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import threading
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+from potp import endpoint
+from potp import dispatch
+
+def local_request(request):
+    return os.getpid()
+
+def cpu_request(request):
+    # Stateless and CPU bound: runs in worker processes
+    total = sum(number * number for number in xrange(request))
+    return os.getpid(), total
+
+def unmarshallable_request(request):
+    # Reply cannot be marshalled by the worker process
+    return lambda: request
+
+server = endpoint.Full({'process_pool': {'processes': 2}})
+server.register_request_handler(local_request, 'local')
+server.register_request_handler(cpu_request, 'cpu', process=True)
+server.register_request_handler(unmarshallable_request, 'broken',
+                                process=True)
+server.start()
+server.wait_ready()
+
+client = endpoint.Client()
+client.connect(server.uri)
+assert client.request(None) == os.getpid()
+
+# Process handlers are routed by binary envelope header only
+client.disconnect()
+client.connect(server.uri + '/cpu')
+try:
+    client.request(1000)
+except endpoint.BinaryEnvelopeRequired:
+    pass
+else:
+    raise AssertionError('dict request routed to worker process')
+
+client.disconnect()
+client = endpoint.Client({'envelope': 'binary'})
+client.connect(server.uri + '/cpu')
+pid, total = client.request(1000)
+print 'Handler ran in process %s (server is %s)' % (pid, os.getpid())
+assert pid != os.getpid()
+assert total == sum(number * number for number in xrange(1000))
+pid, total = client.request(10)
+assert pid != os.getpid() and total == 285
+
+# Batches ship every request to the worker in its own envelope
+client.disconnect()
+client = endpoint.Client()
+client.connect(server.uri)
+results = client.request_many([10, None, 'x'], ['cpu', 'local', 'cpu'])
+assert results[0][1] == 285 and results[1] == os.getpid()
+assert isinstance(results[2], TypeError)
+
+print 'Stats: %s' % server.process_stats
+assert server.process_stats['calls'] == 4
+
+# Failed calls to worker processes are error replies
+client.disconnect()
+client = endpoint.Client({'envelope': 'binary'})
+client.connect(server.uri + '/broken')
+try:
+    client.request(None)
+except dispatch.DispatchError:
+    pass
+else:
+    raise AssertionError('worker process failure not replied')
+client.disconnect()
+client.connect(server.uri + '/cpu')
+assert client.request(10)[1] == 285
+
+# Workers are replaced while handlers are registered, calls go on
+errors = []
+def call_cpu():
+    caller = endpoint.Client({'envelope': 'binary'})
+    caller.connect(server.uri + '/cpu')
+    try:
+        for number in range(20):
+            assert caller.request(10)[1] == 285
+    except Exception, e:
+        errors.append(e)
+    finally:
+        caller.disconnect()
+
+callers = [threading.Thread(target=call_cpu) for number in range(4)]
+for caller in callers:
+    caller.start()
+for number in range(5):
+    server.register_request_handler(cpu_request, 'spare', process=True)
+    server.unregister_handler('spare')
+for caller in callers:
+    caller.join()
+assert not errors, errors
+assert server.process_stats['restarts'] == 10
+
+client.disconnect()
+server.stop()
+# Stopped pools leave no handlers behind
+assert not dispatch._PROCESS_HANDLERS
+
+# Event loop would wait for worker processes: dispatch workers are needed
+server = endpoint.Full({'server_engine': 'eventloop',
+                        'process_pool': {'processes': 1}})
+try:
+    server.register_request_handler(cpu_request, 'cpu', process=True)
+except dispatch.DispatchError:
+    pass
+else:
+    raise AssertionError('event loop blocked by worker processes')
+
+server = endpoint.Full({'server_engine': 'eventloop',
+                        'dispatch': {'workers': 2},
+                        'process_pool': {'processes': 1}})
+server.register_request_handler(cpu_request, 'cpu', process=True)
+server.start()
+server.wait_ready()
+client = endpoint.Client({'envelope': 'binary'})
+client.connect(server.uri)
+assert client.request(10)[1] == 285
+client.disconnect()
+server.stop()
+print 'It works!'
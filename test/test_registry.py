@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import gc
+import logging
+logging.basicConfig(level=logging.INFO)
+
+import potp.avatars
+from potp import endpoint
+from potp import envelope
+from potp import registry
+
+# Handlers of a server are not seen by other servers
+first = endpoint.Server()
+second = endpoint.Server()
+first.register_request_handler(lambda request: 'first', 'only-first')
+try:
+    second.handle_of('only-first')
+except endpoint.RequestedHandlerNotFound:
+    pass
+else:
+    raise AssertionError('handler registered in every server')
+
+# Slots are reused, old handles are refused
+handlers = registry.HandlerRegistry()
+old = handlers.register('a', len)
+handlers.unregister('a')
+new = handlers.register('b', len)
+assert envelope.handle_index(old) == envelope.handle_index(new)
+assert handlers.resolve(old) is None
+assert handlers.resolve(new) == ('b', len)
+assert not handlers.unregister('a')
+assert handlers.stats['slots'] == 1
+
+# Weak handlers are evicted when collected
+class Counter(potp.avatars.Avatar):
+    def __init__(self, value):
+        potp.avatars.Avatar.__init__(self)
+        self.value = value
+
+    def get(self):
+        return self.value
+
+server = endpoint.Full()
+server.register_request_handler(lambda request: request, 'echo')
+server.start()
+server.wait_ready()
+
+client = endpoint.Client({'envelope': 'binary'})
+kept = Counter(-1)
+kept.avatar_attach(server, weak=True)
+for value in range(1000):
+    Counter(value).avatar_attach(server, weak=True)
+gc.collect()
+stats = server.handler_stats
+print 'Handlers: %s' % stats
+assert stats['handlers'] == 2
+assert stats['evicted'] == 1000
+assert stats['slots'] <= 3
+
+client.connect(kept.avatar_uri)
+proxy = potp.avatars.AvatarProxy(client)
+proxy.attach_proxy()
+assert proxy.get() == -1
+aid = kept.avatar_uri.rsplit('/', 1)[1]
+del kept, proxy
+gc.collect()
+try:
+    client.request({'member': 'get', 'args': (), 'kwargs': {}}, aid)
+except endpoint.RequestedHandlerNotFound:
+    pass
+else:
+    raise AssertionError('dead avatar still reachable')
+client.disconnect()
+server.stop()
+print 'It works!'
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+from potp import transport
+from potp import endpoint
+
+# Transport level, rings smaller than frames
+sap = transport.ShmSAP()
+
+server = transport.ShmTransport()
+client = transport.ShmTransport(ring_size=64 * 1024)
+
+def process_request(request):
+    print 'Echo: %s bytes' % len(request)
+    return request
+
+server.open(sap)
+server.bind(process_request)
+
+client.connect(sap)
+assert client.send_request('test string') == 'test string'
+big = 'x' * (1024 * 1024)
+assert client.send_request(big) == big
+
+client.disconnect()
+server.close()
+
+# Endpoint level
+server = endpoint.Full({'transport': 'shm'})
+server.register_request_handler(process_request)
+server.start()
+
+print 'Wait for server becames ready...'
+server.wait_ready()
+
+print 'Server listening in "%s"' % server.uri
+client = endpoint.Client({'transport': 'shm'})
+client.connect(server.uri)
+print 'Reply: %s' % client.request('hello')
+
+client.disconnect()
+server.stop()
@@ -12,7 +12,7 @@ server = transport.TCPTransport()
 client = transport.TCPTransport()
 
 def process_request(request):
-    print 'Echo: %s' % request
+    print 'Echo: %s bytes' % len(request)
     return request
 
 server.open(sap)
@@ -23,5 +23,34 @@ client.connect(sap)
 client.send_request('test string')
 client.send_request('another request')
 
+big = 'x' * (8 * 1024 * 1024)
+assert client.send_request(big) == big
+
 client.disconnect()
 server.close()
+
+# Payloads belong to the reader caller until released
+import socket
+sender, receiver = socket.socketpair()
+reader = transport._FrameReader(receiver)
+for payload in ['first', 'other', 'third']:
+    transport.__send_frame__(sender, payload)
+first = reader.read()[2]
+view = memoryview(first)
+second = reader.read()[2]
+assert second is not first and view.tobytes() == 'first'
+del view
+reader.release(second)
+assert reader.read()[2] is second and second == 'third'
+sender.close()
+receiver.close()
+
+# Nagle is off: big segments follow their header without waiting an ACK
+sap = transport.TCPSAP('localhost')
+server = transport.TCPTransport()
+server.open(sap)
+server.bind(process_request)
+nodelay = transport.TCPTransport().__socket__(sap)
+assert nodelay.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+nodelay.close()
+server.close()
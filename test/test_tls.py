@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import os
+import logging
+logging.basicConfig(level=logging.INFO)
+
+from potp import transport
+from potp import endpoint
+from potp import pool
+
+# Self-signed certificate of "localhost" (see tls/)
+CERTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tls')
+SERVER_TLS = {'certfile': os.path.join(CERTS, 'localhost.pem'),
+              'keyfile': os.path.join(CERTS, 'localhost.key')}
+CLIENT_TLS = {'cafile': os.path.join(CERTS, 'localhost.pem')}
+
+# Transport level
+def process_request(request):
+    return request
+
+sap = transport.encode_SAP('tls@localhost')
+assert isinstance(sap, transport.TLSSAP)
+server = transport.TLSTransport(tls=SERVER_TLS)
+server.open(sap)
+server.bind(process_request)
+
+for attempt in range(3):
+    client = transport.TLSTransport(tls=CLIENT_TLS)
+    assert client.secure
+    client.connect(sap)
+    assert client.send_request('secret %s' % attempt) == 'secret %s' % attempt
+    assert client.send_request('x' * 100000) == 'x' * 100000
+    assert client.healthy
+    client.disconnect()
+print 'Server sessions: %s' % server.session_stats
+assert server.session_stats['accept'] == 3
+
+# Certificate not trusted: connection is refused
+untrusted = transport.TLSTransport(tls={'cafile': None})
+try:
+    untrusted.connect(sap)
+except Exception, e:
+    print 'Refused: %s' % e
+else:
+    raise AssertionError('untrusted certificate accepted')
+
+# Event loop engine and pipelining are not supported
+for qos in [{'engine': 'eventloop'}, {'pipelining': True}]:
+    try:
+        transport.TLSTransport(tls=CLIENT_TLS, **qos)
+    except transport.TransportError:
+        pass
+    else:
+        raise AssertionError('TLS transport created with %r' % qos)
+server.close()
+
+# Endpoint level, pooled connections included
+def echo(request):
+    return request
+
+server = endpoint.Full({'transport': 'tls', 'tls': SERVER_TLS})
+server.register_request_handler(echo)
+server.start()
+server.wait_ready()
+assert server.uri.startswith('potp://tls@')
+
+client = endpoint.Client({'tls': CLIENT_TLS, 'handshake': True})
+client.connect(server.uri)
+assert client.request({'a': [1, 2]}) == {'a': [1, 2]}
+client.disconnect()
+
+pooled = endpoint.Client({'tls': CLIENT_TLS,
+                          'connection_pool': {'max_size': 2}})
+pooled.connect(server.uri)
+accepted = server.transport.session_stats['accept']
+for attempt in range(5):
+    assert pooled.request(attempt) == attempt
+# No session resumption: pooled connections are the ones saving handshakes
+assert server.transport.session_stats['accept'] - accepted == 1
+pooled.disconnect()
+
+# Pools are not shared by clients with other TLS options
+unverified = endpoint.Client({'tls': {'verify': False},
+                              'connection_pool': {'max_size': 2}})
+unverified.connect(server.uri)
+assert unverified.request('unverified') == 'unverified'
+untrusted = endpoint.Client({'tls': {'cafile': None},
+                             'connection_pool': {'max_size': 2}})
+untrusted.connect(server.uri)
+assert untrusted.pool is not unverified.pool
+try:
+    untrusted.request('untrusted')
+except Exception, e:
+    print 'Refused: %s' % e
+else:
+    raise AssertionError('pooled connection skipped certificate checks')
+unverified.disconnect()
+untrusted.disconnect()
+pool.close_pools()
+server.stop()
+print 'It works!'
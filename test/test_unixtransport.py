@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+from potp import transport
+from potp import endpoint
+
+# Transport level
+sap = transport.UnixSAP()
+
+server = transport.UnixTransport()
+client = transport.UnixTransport()
+
+def process_request(request):
+    print 'Echo: %s' % request
+    return request
+
+server.open(sap)
+server.bind(process_request)
+
+client.connect(sap)
+print client.send_request('test string')
+print client.send_request('another request')
+
+client.disconnect()
+server.close()
+
+# Endpoint level: URI selects the transport
+server = endpoint.Full({'transport': 'unix'})
+server.register_request_handler(process_request, 'echo')
+server.start()
+
+print 'Wait for server becames ready...'
+server.wait_ready()
+
+print 'Server listening in "%s"' % server.uri
+client = endpoint.Client()
+client.connect('%s/echo' % server.uri)
+assert isinstance(client.transport, transport.UnixTransport)
+print 'Reply: %s' % client.request('hello')
+
+client.disconnect()
+server.stop()